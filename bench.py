@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+from clock import VirtualClock
+from engine import RUN_ANALYSIS_WINDOW_HOURS
+
+# Benchmark of the message-ingest path. It imports main.py and drives the shipped code: /run
+# starts the attempt, synthetic messages go through main.on_message (counts_lock, the engine,
+# the run journal and the metrics), and the minute sampler, run timer, inactivity watcher,
+# autosave and journal flush run as main.py starts them. main.clock is swapped for a
+# clock.VirtualClock, so a simulated 24h attempt takes seconds. Needs discord.py (see
+# requirements.txt) but never connects; the only thing set from outside is bot.loop. Each
+# workload runs in a fresh process, in a scratch directory for main.py's log and data files.
+#
+#   python bench.py                          all workloads, 24 simulated hours each
+#   python bench.py -w two_runners --hours 2 one workload, shorter run
+#   python bench.py --json out.json          save results
+#   python bench.py --compare base.json      print the change against a saved result
+
+# -------- SETUP --------
+WRONG_NUMBER_RATE = 0.005    # share of counts posted with a wrong number
+RUN_START = 1_700_000_000.0
+
+def bench_setup(main):
+    # channels, users and mistake bots as configured in main.py
+    channels = sorted(main.TRACK_CHANNELS)
+    return types.SimpleNamespace(
+        channels=channels,
+        other_channel=main.COMMANDS_CHANNEL_ID,
+        users=sorted(main.user_team_mapping)[:30],
+        mistake_bot_channel_id=main.MISTAKE_BOT_CHANNEL_ID,
+        mistake_bot_ruined_id=main.MISTAKE_BOT_RUINED_ID,
+    )
+
+_message_ids = itertools.count(1)
+
+def fake_message(ch: int, uid: int, content: str, bot: bool = False):
+    return types.SimpleNamespace(
+        id=next(_message_ids),
+        channel=types.SimpleNamespace(id=ch),
+        author=types.SimpleNamespace(id=uid, bot=bot, system=False),
+        content=content,
+    )
+
+class FakeChannel:
+    # where /run answers and the run timer posts the summary; nothing is sent anywhere
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.guild = None
+
+    async def send(self, *args, **kwargs):
+        return types.SimpleNamespace(id=next(_message_ids), pinned=False, pin=_noop, edit=_noop)
+
+async def _noop(*args, **kwargs):
+    pass
+
+def fake_interaction(channel: FakeChannel):
+    # /run from outside a guild, so no permission edits are planned
+    return types.SimpleNamespace(
+        guild=None,
+        channel=channel,
+        channel_id=channel.id,
+        user=types.SimpleNamespace(id=0),
+        response=types.SimpleNamespace(send_message=_noop),
+    )
+
+# -------- WORKLOADS --------
+# each workload yields (virtual seconds since the run start, message) in time order, using
+# the channels and users of bench_setup
+
+def numbers(rng):
+    # next number to post per channel; now and then someone posts a wrong one, which
+    # sequence validation charges and the channel resyncs on the next right number
+    next_number = {}
+    def number(ch):
+        n = next_number.get(ch, 1)
+        if rng.random() < WRONG_NUMBER_RATE:
+            return n + rng.choice((-1, 1, 10))
+        next_number[ch] = n + 1
+        return n
+    return number
+
+def two_runners(rng, duration, setup):
+    # one pair alternating in one channel, about 2 counts per second
+    number = numbers(rng)
+    ch, pair = setup.channels[0], setup.users[:2]
+    t, n = 0.0, 0
+    while t < duration:
+        n += 1
+        yield t, fake_message(ch, pair[n % 2], f"{number(ch)}")
+        t += rng.uniform(0.3, 0.7)
+
+def rotating_users(rng, duration, setup):
+    # 30 users taking turns in random order over both channels, with some chatter
+    users = setup.users
+    number = numbers(rng)
+    t, n = 0.0, 0
+    while t < duration:
+        n += 1
+        ch = setup.channels[n % 2]
+        if rng.random() < 0.1:
+            yield t, fake_message(ch, rng.choice(users), "nice one")
+        elif rng.random() < 0.05:
+            yield t, fake_message(setup.other_channel, rng.choice(users), f"{n}")
+        else:
+            yield t, fake_message(ch, rng.choice(users), f"{number(ch)} ")
+        t += rng.expovariate(1.5)
+
+def mistake_bursts(rng, duration, setup):
+    # a pair counting, with bursts of mistake-bot messages every few minutes
+    number = numbers(rng)
+    ch, pair = setup.channels[0], setup.users[:2]
+    bots = (setup.mistake_bot_channel_id, setup.mistake_bot_ruined_id)
+    t, n = 0.0, 0
+    next_burst = rng.uniform(60, 600)
+    while t < duration:
+        n += 1
+        yield t, fake_message(ch, pair[n % 2], f"{number(ch)}")
+        if t >= next_burst:
+            for _ in range(rng.randint(3, 20)):
+                bot = rng.choice(bots)
+                text = "RUINED IT at 10" if bot == setup.mistake_bot_ruined_id else "10 of 11"
+                yield t, fake_message(ch, bot, text, bot=True)
+            next_burst = t + rng.uniform(60, 600)
+        t += rng.uniform(0.4, 0.8)
+
+def pair_handovers(rng, duration, setup):
+    # pairs taking over each other's run every 20-90 minutes in both channels, with idle gaps
+    number = numbers(rng)
+    t, n = 0.0, 0
+    users = setup.users
+    pairs = [(users[i], users[i + 1]) for i in range(0, len(users) - 1, 2)]
+    pair = {ch: rng.choice(pairs) for ch in setup.channels}
+    handover = {ch: rng.uniform(1200, 5400) for ch in setup.channels}
+    while t < duration:
+        n += 1
+        ch = setup.channels[n % 2]
+        if t >= handover[ch]:
+            pair[ch] = rng.choice(pairs)
+            handover[ch] = t + rng.uniform(1200, 5400)
+            if rng.random() < 0.3:
+                # the next pair shows up after the run ended for inactivity
+                t += rng.uniform(600, 900)
+        yield t, fake_message(ch, pair[ch][n % 4 < 2], f"{number(ch)}")
+        t += rng.uniform(0.2, 0.5)
+
+WORKLOADS = {
+    "two_runners": two_runners,
+    "rotating_users": rotating_users,
+    "mistake_bursts": mistake_bursts,
+    "pair_handovers": pair_handovers,
+}
+
+# -------- MEASUREMENT --------
+def percentiles(samples_ns):
+    # p50 / p99 / max in microseconds
+    if not samples_ns:
+        return {"p50_us": 0.0, "p99_us": 0.0, "max_us": 0.0}
+    samples_ns.sort()
+    n = len(samples_ns)
+    return {
+        "p50_us": samples_ns[n // 2] / 1000,
+        "p99_us": samples_ns[min(n - 1, n * 99 // 100)] / 1000,
+        "max_us": samples_ns[-1] / 1000,
+    }
+
+def histogram_stats(histogram):
+    # count, mean and p99 (upper bound of its bucket) in microseconds of an unlabelled
+    # metrics.Histogram, as the /metrics endpoint would report them
+    state = histogram.values.get(())
+    if state is None:
+        return {"count": 0, "mean_us": 0.0, "p99_le_us": 0.0}
+    counts, total, n = state
+    rank, cumulative = n * 0.99, 0
+    for bound, c in zip(histogram.buckets + (float("inf"),), counts):
+        cumulative += c
+        if cumulative >= rank:
+            break
+    return {"count": n, "mean_us": round(total / n * 1e6, 3), "p99_le_us": bound * 1e6}
+
+def run_workload(name: str, hours: float, seed: int, memory: bool) -> dict:
+    # main.py keeps its run, files and metrics in module state, so every workload gets a
+    # fresh interpreter
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(_run_workload, name, hours, seed, memory).result()
+
+def _run_workload(name: str, hours: float, seed: int, memory: bool) -> dict:
+    with tempfile.TemporaryDirectory(prefix="counting-bench-") as scratch:
+        os.chdir(scratch)
+        import main
+        return asyncio.run(drive_main(main, name, hours, seed, memory))
+
+async def drive_main(main, name: str, hours: float, seed: int, memory: bool) -> dict:
+    rng = random.Random(seed)
+    setup = bench_setup(main)
+    clock = main.clock = VirtualClock(RUN_START)
+    main.bot.loop = asyncio.get_running_loop()
+    main.storage = main.open_storage()
+    main.load_data()
+    duration = min(hours, RUN_ANALYSIS_WINDOW_HOURS) * 3600
+
+    # the always-on tasks on_ready starts (announcements have no channel to post to here)
+    tasks = [
+        asyncio.ensure_future(task())
+        for task in (main.autosave_loop, main.journal_flush_loop, main.inactivity_watcher)
+    ]
+    await main.start_run.callback(fake_interaction(FakeChannel(setup.channels[0])))
+
+    latency = []
+    messages = 0
+    perf = time.perf_counter_ns
+
+    if memory:
+        tracemalloc.start()
+        mem_start = tracemalloc.get_traced_memory()[0]
+    wall0 = time.perf_counter()
+
+    for offset, message in WORKLOADS[name](rng, duration, setup):
+        await clock.advance_to(RUN_START + offset)
+        t0 = perf()
+        await main.on_message(message)
+        latency.append(perf() - t0)
+        messages += 1
+
+    # end the run as /end_run does, so runs shorter than 24h are summarized the same way
+    main.run_timer_task.cancel()
+    await clock.advance_to(RUN_START + duration)
+    ingest_s = time.perf_counter() - wall0
+    await asyncio.to_thread(main.run_journal.write, *main.run_journal.take_pending())
+    journal_bytes = os.path.getsize(main.JOURNAL_FILE)
+
+    t0 = perf()
+    summary = await main.finalize_current_run()
+    finalize_ms = (perf() - t0) / 1e6
+    await main.apply_run_end_permissions(None)
+    for task in tasks:
+        task.cancel()
+
+    outcomes = {"count": sum(main.counts_metric.values.values())}
+    for (_, kind), n in main.mistakes_metric.values.items():
+        outcomes[kind] = outcomes.get(kind, 0) + n
+    result = {
+        "messages": messages,
+        "simulated_hours": duration / 3600,
+        "wall_seconds": round(ingest_s, 3),
+        "messages_per_second": round(messages / ingest_s) if ingest_s else 0,
+        "latency": percentiles(latency),
+        "lock_wait": histogram_stats(main.lock_wait),
+        "lock_hold": histogram_stats(main.lock_hold),
+        "finalize_ms": round(finalize_ms, 3),
+        "outcomes": outcomes,
+        "correct": summary["correct"],
+        "incorrect": summary["incorrect"],
+        "journal_bytes": journal_bytes,
+    }
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["memory_growth_kb"] = round((current - mem_start) / 1024)
+        result["memory_peak_kb"] = round((peak - mem_start) / 1024)
+    return result
+
+# -------- REPORT --------
+def git_revision():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_result(name: str, res: dict, base: dict = None):
+    def delta(value, old, lower_is_better=True):
+        if old in (None, 0):
+            return ""
+        change = (value - old) / old * 100
+        better = change < 0 if lower_is_better else change > 0
+        return f" ({change:+.1f}%{'' if abs(change) < 5 else ' better' if better else ' worse'})"
+
+    base = base or {}
+    print(f"{name}: {res['messages']:,} messages over {res['simulated_hours']:g}h in {res['wall_seconds']}s")
+    print(f"  throughput   {res['messages_per_second']:,} msg/s"
+          f"{delta(res['messages_per_second'], base.get('messages_per_second'), lower_is_better=False)}")
+    lat, base_lat = res["latency"], base.get("latency", {})
+    print(f"  latency      p50 {lat['p50_us']:.1f}us{delta(lat['p50_us'], base_lat.get('p50_us'))}"
+          f"  p99 {lat['p99_us']:.1f}us{delta(lat['p99_us'], base_lat.get('p99_us'))}"
+          f"  max {lat['max_us']:.1f}us")
+    for kind in ("lock_wait", "lock_hold"):
+        stats, base_stats = res[kind], base.get(kind, {})
+        print(f"  {kind.replace('_', ' '):<12} {stats['count']:,}x  mean {stats['mean_us']:.1f}us"
+              f"{delta(stats['mean_us'], base_stats.get('mean_us'))}  p99 <= {stats['p99_le_us']:g}us")
+    print(f"  finalize     {res['finalize_ms']:.1f}ms{delta(res['finalize_ms'], base.get('finalize_ms'))}")
+    if "memory_growth_kb" in res:
+        print(f"  memory       +{res['memory_growth_kb']:,} KiB (peak +{res['memory_peak_kb']:,} KiB)"
+              f"{delta(res['memory_growth_kb'], base.get('memory_growth_kb'))}")
+    print(f"  outcomes     {res['outcomes']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the counting ingest path on synthetic workloads.")
+    parser.add_argument("-w", "--workload", action="append", choices=sorted(WORKLOADS),
+                        help="workload to run (repeatable, default: all)")
+    parser.add_argument("--hours", type=float, default=RUN_ANALYSIS_WINDOW_HOURS, help="simulated run length")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (keep it fixed to compare commits)")
+    parser.add_argument("--memory", action="store_true", help="track memory growth (slower)")
+    parser.add_argument("--json", metavar="PATH", help="write results to PATH")
+    parser.add_argument("--compare", metavar="PATH", help="compare against results saved with --json")
+    args = parser.parse_args(argv)
+
+    base = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        print(f"comparing against {base.get('revision')} ({args.compare})")
+        if (base.get("seed"), base.get("hours"), base.get("memory", False)) != (args.seed, args.hours, args.memory):
+            print("warning: seed, hours or --memory differ from the saved run, numbers are not comparable")
+
+    results = {}
+    for name in args.workload or list(WORKLOADS):
+        results[name] = run_workload(name, args.hours, args.seed, args.memory)
+        print_result(name, results[name], base.get("workloads", {}).get(name))
+
+    # the workloads run in child processes
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    report = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "seed": args.seed,
+        "hours": args.hours,
+        "memory": args.memory,
+        "max_rss_kb": usage.ru_maxrss,
+        "workloads": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
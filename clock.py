@@ -0,0 +1,92 @@
+import asyncio
+import heapq
+import time
+
+# Time source for everything that schedules run work (run timer, sampler, inactivity
+# deadlines, autosave). main.py reads the time and sleeps through its `clock`; replacing it
+# with a VirtualClock lets a test or benchmark drive a whole 24h attempt in seconds.
+
+class Clock:
+    # wall-clock time and asyncio sleeps
+    def time(self) -> float:
+        return time.time()
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(max(0.0, seconds))
+
+    async def sleep_until(self, ts: float):
+        await asyncio.sleep(max(0.0, ts - self.time()))
+
+    async def wait(self, event: asyncio.Event, timeout: float = None) -> bool:
+        # waits for event for at most timeout seconds; returns whether it was set
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+class VirtualClock(Clock):
+    # time only moves when advance()/advance_to() is called. sleepers are woken in time
+    # order with the clock set to their wake-up time, and each gets to run until it blocks
+    # again before the next one, so tasks observe the same ordering as in real time.
+    SETTLE_STEPS = 20    # event-loop passes given to woken tasks before moving on
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+        self._sleepers = []    # (when, seq, future)
+        self._seq = 0
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        await self.sleep_until(self.now + max(0.0, seconds))
+
+    async def sleep_until(self, ts: float):
+        if ts <= self.now:
+            await asyncio.sleep(0)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._sleepers, (ts, self._seq, fut))
+        await fut
+
+    async def wait(self, event: asyncio.Event, timeout: float = None) -> bool:
+        if timeout is None:
+            await event.wait()
+            return True
+        if event.is_set():
+            return True
+        waiter = asyncio.ensure_future(event.wait())
+        sleeper = asyncio.ensure_future(self.sleep(timeout))
+        done, pending = await asyncio.wait((waiter, sleeper), return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        return waiter in done
+
+    def next_wakeup(self):
+        # earliest pending wake-up time (None if nothing is sleeping)
+        while self._sleepers and self._sleepers[0][2].done():
+            heapq.heappop(self._sleepers)
+        return self._sleepers[0][0] if self._sleepers else None
+
+    async def _settle(self):
+        for _ in range(self.SETTLE_STEPS):
+            await asyncio.sleep(0)
+
+    async def advance_to(self, ts: float):
+        # moves the clock to ts, waking every sleeper due on the way
+        # (one loop pass first, so tasks created since the last call reach their first sleep)
+        await asyncio.sleep(0)
+        while True:
+            when = self.next_wakeup()
+            if when is None or when > ts:
+                break
+            _, _, fut = heapq.heappop(self._sleepers)
+            self.now = max(self.now, when)
+            fut.set_result(None)
+            await self._settle()
+        self.now = max(self.now, ts)
+
+    async def advance(self, seconds: float):
+        await self.advance_to(self.now + seconds)
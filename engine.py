@@ -0,0 +1,1193 @@
+import heapq
+from array import array
+from bisect import bisect_right, insort
+from collections import defaultdict, deque, namedtuple
+from operator import sub
+from types import MappingProxyType
+
+# Counting engine: everything that decides what a message means for a run (valid counts,
+# team resolution, mistake attribution, two-person detection, inactivity, window analysis,
+# attempt records). It consumes plain events and returns outcomes; it never imports
+# discord.py and never does I/O, so it can be driven directly by tests and benchmarks.
+# main.py adapts Discord messages to it and turns its outcomes into journal records and
+# announcements.
+
+# -------- CONSTANTS --------
+# two-person run thresholds
+TWO_PERSON_DETECTION_WINDOW = 40     # how many recent messages to inspect to detect a 2-person pair
+TWO_PERSON_MIN_COUNT = 95            # changed from 100 -> 95 (numbers in last 10 minutes required)
+TWO_PERSON_WARNING_MINUTES = 9       # send warning if last 9 minutes < TWO_PERSON_MIN_COUNT
+TWO_PERSON_CHECK_MINUTES = 10        # check inactivity over last 10 minutes
+TWO_PERSON_PEOPLE = 2                # distinct senders that make up a run
+
+# For fastest 1-hour sliding window analysis
+RUN_ANALYSIS_WINDOW_HOURS = 24   # total run duration
+FASTEST_WINDOW_SECONDS = 3600   # 1 hour window
+# every window length analysed when an attempt is finalized (5 min, 1 hour, 6 hours)
+ANALYSIS_WINDOW_SECONDS = (300, FASTEST_WINDOW_SECONDS, 6 * 3600)
+SAMPLE_INTERVAL_SECONDS = 10    # keep this (sampling resolution)
+# numbers counted per bucket of this many seconds, rolled up from the snapshots and stored
+# with each attempt record for post-run rate charts (see RateRollup)
+ROLLUP_BUCKET_SECONDS = 600
+
+# in-process sequence checking (see CountingEngine sequence_validation)
+DOUBLE_POST_MODES = ("allow", "mistake", "ignore")   # same user counting twice in a row
+SEQUENCE_RESET_MODES = ("resync", "restart")         # after a wrong number
+MAX_COUNT_DIGITS = 18                                # longer numbers are not counts
+
+# accepted counts remembered per channel so a mistake bot's reply can be traced back to them
+RECENT_COUNTS_PER_CHANNEL = 256
+
+# -------- EVENTS / OUTCOMES --------
+# a message as the engine sees it
+# (message_id / reference_id: the message and the message it replies to, when known)
+MessageEvent = namedtuple(
+    "MessageEvent", "channel_id author_id author_bot content ts message_id reference_id",
+    defaults=(None, None)
+)
+
+# what handling an event did. kind / data:
+#   "count"        uid credited with a count
+#   "mistake"      uid charged with a mistake reported by a mistake bot (their count is taken back)
+#   "wrong"        uid charged with a wrong number caught by sequence validation (never counted)
+#   "run_started"  runners tuple of a two-person run that just started
+#   "run_ended"    history record { "runners", "start", "end", "duration" } of a run that ended
+#   "run_warning"  None, the channel's run is close to ending for inactivity
+Outcome = namedtuple("Outcome", "kind channel_id data")
+
+def message_event(message, ts: float) -> MessageEvent:
+    # duck-typed: anything with .channel.id, .author.id/.bot/.system and .content
+    # (.id and .reference.message_id are optional)
+    author = message.author
+    reference = getattr(message, "reference", None)
+    return MessageEvent(
+        message.channel.id,
+        author.id,
+        bool(author.bot or author.system),
+        message.content or "",
+        ts,
+        getattr(message, "id", None),
+        reference.message_id if reference is not None else None,
+    )
+
+# -------- HELPERS --------
+def parse_count(content: str):
+    # the number a message starts with: optional leading whitespace, ASCII digits, then
+    # whitespace or the end of the message. walks the string in place rather than
+    # splitting it; None if the message is not a count
+    n = len(content)
+    i = 0
+    while i < n and content[i].isspace():
+        i += 1
+    start = i
+    value = 0
+    while i < n:
+        d = ord(content[i]) - 48
+        if d < 0 or d > 9:
+            break
+        value = value * 10 + d
+        i += 1
+    if i == start or i - start > MAX_COUNT_DIGITS:
+        return None
+    if i < n and not content[i].isspace():
+        return None
+    return value
+
+def is_valid_count_message(content: str) -> bool:
+    return parse_count(content) is not None
+
+def format_accuracy_value(correct: int, incorrect: int):
+    total = correct + incorrect
+    if total == 0:
+        return None
+    acc = (correct / total) * 100
+    return acc
+
+# -------- SNAPSHOT STORE --------
+# per-user cumulative counters sampled every SAMPLE_INTERVAL_SECONDS.
+# a counter is only stored at the ticks where it changed (tick index + value in two
+# parallel array('I')), so a user costs nothing on ticks where they did not count.
+# series[i] is the user's counter at channel tick i (0 before their first count).
+class UserSnapshotSeries:
+    __slots__ = ("store", "ticks", "values")
+
+    def __init__(self, store):
+        self.store = store
+        self.ticks = array("I")
+        self.values = array("I")
+
+    def record(self, tick: int, value: int):
+        if self.ticks and self.ticks[-1] == tick:
+            self.values[-1] = value
+        elif not self.values or self.values[-1] != value:
+            self.ticks.append(tick)
+            self.values.append(value)
+
+    def __len__(self):
+        return self.store.length
+
+    def __getitem__(self, i: int) -> int:
+        n = self.store.length
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("snapshot index out of range")
+        pos = bisect_right(self.ticks, i) - 1
+        return self.values[pos] if pos >= 0 else 0
+
+class UserSnapshotStore:
+    # uid -> UserSnapshotSeries for one channel; every series shares the channel tick count
+    def __init__(self):
+        self.length = 0
+        self.series = {}
+        self.dirty = set()
+
+    def mark(self, uid: int):
+        self.dirty.add(uid)
+
+    def sample(self, counts):
+        # append one tick, touching only the users whose counter changed since the last one
+        tick = self.length
+        for uid in self.dirty:
+            s = self.series.get(uid)
+            if s is None:
+                s = self.series[uid] = UserSnapshotSeries(self)
+            s.record(tick, counts.get(uid, 0))
+        self.dirty.clear()
+        self.length = tick + 1
+
+    def get(self, uid: int, default=None):
+        return self.series.get(uid, default)
+
+    def to_json(self):
+        # arrays are copied; json serialization lists them (see main._json_default)
+        return {
+            "length": self.length,
+            "series": {str(uid): [s.ticks[:], s.values[:]] for uid, s in self.series.items()},
+            "dirty": list(self.dirty),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        store = cls()
+        store.length = data["length"]
+        for uid, (ticks, values) in data["series"].items():
+            s = store.series[int(uid)] = UserSnapshotSeries(store)
+            s.ticks.extend(ticks)
+            s.values.extend(values)
+        store.dirty.update(data.get("dirty", ()))
+        return store
+
+    def items(self):
+        return self.series.items()
+
+    def keys(self):
+        return self.series.keys()
+
+class RateRollup:
+    # numbers counted per ROLLUP_BUCKET_SECONDS of run time. fed with the snapshot deltas as
+    # ticks are sampled, so the attempt record gets its rates without walking the 10 s snapshots
+    __slots__ = ("counts",)
+
+    def __init__(self):
+        self.counts = array("I")
+
+    def add(self, tick: int, delta: int):
+        # the numbers counted up to tick (since the previous one) go into the bucket holding
+        # the interval before it; tick 0 holds whatever was counted at the very start
+        buckets = self.counts
+        i = max(0, tick - 1) * SAMPLE_INTERVAL_SECONDS // ROLLUP_BUCKET_SECONDS
+        while len(buckets) <= i:
+            buckets.append(0)
+        if delta >= 0:
+            buckets[i] += delta
+            return
+        # counts taken back by a mistake come off the latest buckets that had counts
+        taken = -delta
+        while taken and i >= 0:
+            step = min(taken, buckets[i])
+            buckets[i] -= step
+            taken -= step
+            i -= 1
+
+    @classmethod
+    def from_snapshots(cls, snapshots):
+        rollup = cls()
+        prev = 0
+        for tick, value in enumerate(snapshots):
+            rollup.add(tick, value - prev)
+            prev = value
+        return rollup
+
+    def buckets(self) -> list:
+        return self.counts.tolist()
+
+# -------- WINDOW ANALYSIS --------
+# snapshots are cumulative counters, i.e. prefix sums of the counts per tick, so the
+# number counted in any window is the difference of two snapshots.
+def best_window(snapshots, window_samples: int):
+    # best (delta, start_index) over all windows of window_samples ticks; start is None if too short
+    n = len(snapshots)
+    if n <= window_samples:
+        return 0, None
+    deltas = list(map(sub, snapshots[window_samples:], snapshots[:n - window_samples]))
+    best = max(deltas)
+    return best, deltas.index(best)
+
+def best_series_window(series, window_samples: int):
+    # same as best_window for a UserSnapshotSeries, visiting only its change ticks: the
+    # delta of a window can only change when one of its edges crosses a change tick.
+    # candidate starts and both window edges only move forward, so the change ticks are
+    # walked with pointers in one linear pass instead of a bisect per lookup
+    n = len(series)
+    if n <= window_samples:
+        return 0, None
+    last_start = n - 1 - window_samples
+    ticks, values = series.ticks, series.values
+    m = len(ticks)
+    a = b = 0    # ticks[:a] are <= the window start, ticks[:b] <= the window end
+    j = k = 0    # next tick that is a candidate start as a start edge / as an end edge
+    best, best_start = 0, None
+    i = 0
+    while True:
+        while a < m and ticks[a] <= i:
+            a += 1
+        end = i + window_samples
+        while b < m and ticks[b] <= end:
+            b += 1
+        delta = (values[b - 1] if b else 0) - (values[a - 1] if a else 0)
+        if best_start is None or delta > best:
+            best, best_start = delta, i
+
+        # next candidate start: a change tick, or a change tick minus the window
+        while j < m and ticks[j] <= i:
+            j += 1
+        while k < m and ticks[k] - window_samples <= i:
+            k += 1
+        nxt = last_start + 1
+        if j < m and ticks[j] < nxt:
+            nxt = ticks[j]
+        if k < m and ticks[k] - window_samples < nxt:
+            nxt = ticks[k] - window_samples
+        if nxt > last_start:
+            return best, best_start
+        i = nxt
+
+def analyze_run_windows(snapshots_per_channel, user_snapshots_per_channel, window_seconds=None,
+                        *, per_user: bool = False):
+    # returns window_seconds -> {
+    #   "delta", "channel", "start_index", "start_seconds": best window over all channels,
+    #   "participants": [(delta, uid), ...] users who counted in that window, most first,
+    #   "per_channel": ch -> (delta, start_index),
+    #   "per_user": uid -> (delta, channel, start_index) best window of each user, only
+    #               filled with per_user=True (a scan of every user's series; finalization
+    #               doesn't need it)
+    # }
+    if window_seconds is None:
+        window_seconds = ANALYSIS_WINDOW_SECONDS
+    results = {}
+    for secs in window_seconds:
+        w = max(1, secs // SAMPLE_INTERVAL_SECONDS)
+        res = {
+            "delta": 0,
+            "channel": None,
+            "start_index": 0,
+            "start_seconds": 0,
+            "participants": [],
+            "per_channel": {},
+            "per_user": {},
+        }
+
+        for ch, snapshots in snapshots_per_channel.items():
+            delta, start = best_window(snapshots, w)
+            if start is None:
+                continue
+            res["per_channel"][ch] = (delta, start)
+            if delta > res["delta"]:
+                res["delta"] = delta
+                res["channel"] = ch
+                res["start_index"] = start
+
+        if per_user:
+            user_bests = res["per_user"]
+            for ch, store in user_snapshots_per_channel.items():
+                for uid, series in store.items():
+                    delta, start = best_series_window(series, w)
+                    if start is not None and delta > user_bests.get(uid, (0,))[0]:
+                        user_bests[uid] = (delta, ch, start)
+
+        if res["channel"] is not None:
+            res["start_seconds"] = res["start_index"] * SAMPLE_INTERVAL_SECONDS
+            start_idx = res["start_index"]
+            end_idx = start_idx + w
+            participants = []
+            for uid, series in user_snapshots_per_channel.get(res["channel"], {}).items():
+                delta = series[end_idx] - series[start_idx]
+                if delta > 0:
+                    participants.append((delta, uid))
+            participants.sort(key=lambda x: -x[0])
+            res["participants"] = participants
+
+        results[secs] = res
+    return results
+
+# -------- RUN DETECTION --------
+class SenderWindow:
+    # the last `size` senders of a channel plus a live count per sender, updated as
+    # senders enter and leave the window, so the distinct senders are known in O(1)
+    __slots__ = ("size", "people", "senders", "counts")
+
+    def __init__(self, size: int, people: int):
+        self.size = size
+        self.people = people
+        self.senders = deque()
+        self.counts = {}
+
+    def append(self, uid: int):
+        if len(self.senders) == self.size:
+            old = self.senders.popleft()
+            n = self.counts[old] - 1
+            if n:
+                self.counts[old] = n
+            else:
+                del self.counts[old]
+        self.senders.append(uid)
+        self.counts[uid] = self.counts.get(uid, 0) + 1
+
+    def extend(self, uids):
+        for uid in uids:
+            self.append(uid)
+
+    def clear(self):
+        self.senders.clear()
+        self.counts.clear()
+
+    def __len__(self):
+        return len(self.senders)
+
+    def __iter__(self):
+        return iter(self.senders)
+
+    def distinct(self) -> int:
+        return len(self.counts)
+
+    def detected_runners(self):
+        # sorted runner tuple when a full window holds exactly `people` distinct senders
+        if len(self.senders) == self.size and len(self.counts) == self.people:
+            return tuple(sorted(self.counts))
+        return None
+
+class SenderWindows(dict):
+    # ch_id -> SenderWindow, created with that channel's (window size, number of people)
+    def __init__(self, detection_by_channel=None):
+        super().__init__()
+        self.detection_by_channel = detection_by_channel or {}
+
+    def __missing__(self, ch: int):
+        size, people = self.detection_by_channel.get(ch, (TWO_PERSON_DETECTION_WINDOW, TWO_PERSON_PEOPLE))
+        window = self[ch] = SenderWindow(size, people)
+        return window
+
+class CountRing:
+    # the last `size` accepted counts of one channel: message id -> uid, oldest overwritten
+    # first. a count that was taken back stays in the ring as None, so a second report of
+    # the same mistake is recognized instead of charging someone else; numbers already
+    # charged as wrong by sequence validation are added as None for the same reason
+    __slots__ = ("ids", "by_id", "pos")
+
+    def __init__(self, size: int = RECENT_COUNTS_PER_CHANNEL):
+        self.ids = [None] * size
+        self.by_id = {}
+        self.pos = 0
+
+    def add(self, message_id: int, uid: int):
+        old = self.ids[self.pos]
+        if old is not None:
+            del self.by_id[old]
+        self.ids[self.pos] = message_id
+        self.by_id[message_id] = uid
+        self.pos = (self.pos + 1) % len(self.ids)
+
+    def __contains__(self, message_id) -> bool:
+        return message_id in self.by_id
+
+    def take(self, message_id: int):
+        # uid of a remembered count, marking it taken back (None if it already was)
+        uid = self.by_id[message_id]
+        self.by_id[message_id] = None
+        return uid
+
+    def take_latest(self):
+        # take() for the newest count; None if it was already taken back, since then the
+        # report is about that mistake, not the count before it
+        message_id = self.ids[self.pos - 1]
+        if message_id is None:
+            return None
+        return self.take(message_id)
+
+# -------- RUN STATE --------
+class RunState:
+    # everything that belongs to one 24h attempt; replaced as a whole when the run ends
+    def __init__(self, start_time: float, channel_id=None, detection_by_channel=None):
+        self.start_time = start_time
+        self.channel_id = channel_id     # channel the run was started from (final stats are posted there)
+        self.team = None                 # team assigned to the run (set on first valid number)
+
+        self.counts_by_user = defaultdict(int)
+        self.team_mistakes = defaultdict(int)
+        # running sums of counts_by_user / team_mistakes, and a counter bumped on every
+        # count or mistake, so status views need neither sums nor sorts to tell what changed
+        self.correct = 0
+        self.incorrect = 0
+        self.version = 0
+
+        # per-channel running counters (all users) and per-user counters
+        self.counts_by_channel = defaultdict(int)
+        self.user_counts_by_channel = defaultdict(lambda: defaultdict(int))
+
+        # per-channel snapshots (cumulative totals sampled every SAMPLE_INTERVAL_SECONDS)
+        # and per-channel per-user sampled snapshots (see UserSnapshotStore)
+        self.snapshots = defaultdict(lambda: array("I"))
+        self.user_snapshots = defaultdict(UserSnapshotStore)
+        # per-channel 10 minute rollups of the snapshots (see RateRollup); rebuilt from
+        # the snapshots on restore rather than checkpointed
+        self.rollups = defaultdict(RateRollup)
+
+        # last N senders per channel (to detect 2-person start), see SenderWindow
+        self.senders = SenderWindows(detection_by_channel)
+
+        # two-person run state per channel (N-person where detection_by_channel says so)
+        # structure: ch_id -> { 'active': bool, 'runners': (uid1, uid2, ...), 'start_time': float,
+        #                       'warned': bool, 'times': deque, 'last': {uid: ts}, 'deadline': float }
+        self.two_person_runs = {}
+
+        # history of two-person runs during the attempt, per channel
+        # structure: ch_id -> [ { "runners": (uid1, uid2), "start": ts, "end": ts, "duration": secs } , ... ]
+        self.two_person_history = defaultdict(list)
+
+        # inactivity deadlines of the two-person runs: (when, ch, run start_time)
+        self.inactivity_heap = []
+
+        # sequence validation per channel: ch_id -> [expected next number or None, last counter].
+        # not checkpointed - a restored run resyncs every channel on its next number
+        self.sequence = {}
+
+        # recent accepted counts per channel by message id (see CountRing). not checkpointed
+        # either - after a restore, mistakes fall back to the channel's newest count
+        self.recent_counts = defaultdict(CountRing)
+
+    def tick_count(self) -> int:
+        return max((len(snaps) for snaps in self.snapshots.values()), default=0)
+
+    def to_json(self):
+        # copy of the state for a checkpoint, cheap enough to take with counts_lock held
+        return {
+            "run_start": self.start_time,
+            "channel": self.channel_id,
+            "team": self.team,
+            "run_counts_by_user": dict(self.counts_by_user),
+            "run_team_mistakes": dict(self.team_mistakes),
+            "run_counts_by_channel": dict(self.counts_by_channel),
+            "run_user_counts_by_channel": {ch: dict(users) for ch, users in self.user_counts_by_channel.items()},
+            "snapshots": {ch: snaps[:] for ch, snaps in self.snapshots.items()},
+            "user_snapshots": {ch: store.to_json() for ch, store in self.user_snapshots.items()},
+            "senders": {ch: list(window) for ch, window in self.senders.items()},
+            "two_person_runs": {
+                ch: {**state, "times": list(state["times"]), "last": dict(state["last"])}
+                for ch, state in self.two_person_runs.items()
+            },
+            "two_person_history": {ch: list(runs) for ch, runs in self.two_person_history.items()},
+        }
+
+    @classmethod
+    def from_json(cls, cp, detection_by_channel=None):
+        run = cls(cp["run_start"], cp.get("channel"), detection_by_channel)
+        run.team = cp["team"]
+        for uid, cnt in cp["run_counts_by_user"].items():
+            run.counts_by_user[int(uid)] = cnt
+        run.team_mistakes.update(cp["run_team_mistakes"])
+        run.correct = sum(run.counts_by_user.values())
+        run.incorrect = sum(run.team_mistakes.values())
+        for ch, cnt in cp["run_counts_by_channel"].items():
+            run.counts_by_channel[int(ch)] = cnt
+        for ch, users in cp["run_user_counts_by_channel"].items():
+            for uid, cnt in users.items():
+                run.user_counts_by_channel[int(ch)][int(uid)] = cnt
+        for ch, snaps in cp["snapshots"].items():
+            run.snapshots[int(ch)].extend(snaps)
+            run.rollups[int(ch)] = RateRollup.from_snapshots(snaps)
+        for ch, data in cp["user_snapshots"].items():
+            run.user_snapshots[int(ch)] = UserSnapshotStore.from_json(data)
+        for ch, senders in cp["senders"].items():
+            run.senders[int(ch)].extend(senders)
+        for ch, state in cp["two_person_runs"].items():
+            state["runners"] = tuple(state["runners"])
+            state["times"] = deque(state["times"], maxlen=TWO_PERSON_MIN_COUNT)
+            state["last"] = {int(uid): ts for uid, ts in state["last"].items()}
+            run.two_person_runs[int(ch)] = state
+        for ch, runs in cp["two_person_history"].items():
+            for rec in runs:
+                rec["runners"] = tuple(rec["runners"])
+            run.two_person_history[int(ch)].extend(runs)
+        return run
+
+# -------- LEADERBOARD INDEX --------
+# sorted per-category views of the attempt history, maintained as attempts are appended,
+# so leaderboards and the points tally never rescan the history.
+# entries are (team, attempt_number, value, extra), best first; ties keep history order
+# (teams in the order they first appear, then attempt number), like a stable sort would.
+LeaderboardEntry = namedtuple("LeaderboardEntry", "team attempt value extra")
+
+class LeaderboardIndex:
+    CATEGORIES = ("accuracy", "numbers", "fastest", "longest")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.team_order = {}
+        # category -> sorted [(-value, team position, attempt, entry)]
+        self.sorted = {category: [] for category in self.CATEGORIES}
+        # team -> [attempt summary], in attempt order (see attempt_summary)
+        self.attempts = {}
+
+    def rebuild(self, history):
+        self.clear()
+        for team, runs in history.items():
+            for attempt, record in enumerate(runs, start=1):
+                self.add(team, attempt, record)
+
+    @staticmethod
+    def longest_two_person_run(record):
+        # the single longest two-person run inside an attempt (None if it had none)
+        two_runs = record.get("two_person_runs", []) or []
+        if not two_runs:
+            return None
+        return max(two_runs, key=lambda r: int(r.get("duration", 0) or 0))
+
+    def _insert(self, category, team, attempt, value, extra=None):
+        pos = self.team_order[team]
+        insort(self.sorted[category], (-value, pos, attempt, LeaderboardEntry(team, attempt, value, extra)))
+
+    def add(self, team, attempt, record):
+        self.team_order.setdefault(team, len(self.team_order))
+
+        acc = record.get("accuracy")
+        if acc is not None:
+            self._insert("accuracy", team, attempt, float(acc))
+
+        correct = int(record.get("correct", 0) or 0)
+        self._insert("numbers", team, attempt, correct)
+
+        best = int(record.get("best_1hour", 0) or 0)
+        if best > 0:
+            self._insert("fastest", team, attempt, best, tuple(record.get("top_users", []) or []))
+
+        longest = self.longest_two_person_run(record)
+        longest_secs = 0
+        if longest is not None:
+            longest_secs = int(longest.get("duration", 0) or 0)
+            self._insert("longest", team, attempt, longest_secs, tuple(longest.get("runners", ())))
+
+        self.attempts.setdefault(team, []).append({
+            "team": team,
+            "attempt": attempt,
+            "correct": correct,
+            "accuracy": acc,
+            "longest": longest_secs,
+            "fastest": best,
+        })
+
+    def top(self, category, k=None):
+        # the k best entries of a category (all of them if k is None)
+        entries = self.sorted[category] if k is None else self.sorted[category][:k]
+        return [e[-1] for e in entries]
+
+    def winner(self, category, *, positive=True):
+        # team holding the best value of a category (only if positive, by default), or None
+        entries = self.sorted[category]
+        if entries and (entries[0][-1].value > 0 or not positive):
+            return entries[0][-1].team
+        return None
+
+    def attempt_summaries(self):
+        # per-attempt summaries, teams in history order
+        for rows in self.attempts.values():
+            yield from rows
+
+# -------- READ VIEWS --------
+class LeaderboardView:
+    # frozen copy of a LeaderboardIndex with the same reads (top, winner, attempt_summaries)
+    __slots__ = ("sorted", "summaries")
+
+    def __init__(self, index: LeaderboardIndex):
+        self.sorted = {category: tuple(e[-1] for e in entries) for category, entries in index.sorted.items()}
+        self.summaries = tuple(row for rows in index.attempts.values() for row in rows)
+
+    def top(self, category, k=None):
+        entries = self.sorted[category]
+        return list(entries if k is None else entries[:k])
+
+    def winner(self, category, *, positive=True):
+        entries = self.sorted[category]
+        if entries and (entries[0].value > 0 or not positive):
+            return entries[0].team
+        return None
+
+    def attempt_summaries(self):
+        return iter(self.summaries)
+
+# what read-only commands see (see CountingEngine.view): totals and history are read-only
+# mappings over copies the engine never touches again, history runs are tuples
+ReadView = namedtuple("ReadView", "data_version history_version totals history leaderboards")
+
+# -------- ENGINE --------
+class CountingEngine:
+    def __init__(
+        self,
+        track_channels,
+        *,
+        team_of=None,
+        main_user_of=None,
+        display_name=None,
+        mistake_bot_channel_id=None,
+        mistake_bot_ruined_id=None,
+        detection_by_channel=None,
+        on_deadline=None,
+        sequence_validation=False,
+        double_post="allow",
+        sequence_reset="resync",
+    ):
+        self.track_channels = frozenset(track_channels)
+        self.team_of = team_of or (lambda uid: None)
+        self.main_user_of = main_user_of or (lambda uid: uid)
+        self.display_name = display_name or (lambda uid: f"User {uid}")
+        self.mistake_bot_channel_id = mistake_bot_channel_id
+        self.mistake_bot_ruined_id = mistake_bot_ruined_id
+        self.mistake_bots = frozenset(b for b in (mistake_bot_channel_id, mistake_bot_ruined_id) if b is not None)
+        self.detection_by_channel = detection_by_channel or {}
+        # called with the time of a newly scheduled inactivity deadline that is now the earliest
+        self.on_deadline = on_deadline
+
+        # with sequence_validation every tracked channel expects the next number and wrong
+        # numbers are charged as they arrive; the mistake bots then only resync the channel.
+        # without it, any number counts and mistakes come from the mistake bots alone
+        if double_post not in DOUBLE_POST_MODES:
+            raise ValueError(f"double_post must be one of {DOUBLE_POST_MODES}")
+        if sequence_reset not in SEQUENCE_RESET_MODES:
+            raise ValueError(f"sequence_reset must be one of {SEQUENCE_RESET_MODES}")
+        self.sequence_validation = sequence_validation
+        self.double_post = double_post
+        self.sequence_reset = sequence_reset
+
+        self.totals = defaultdict(int)
+        # store per-team attempt history: team -> list of { "correct": int, "incorrect": int, "accuracy": float or None, "best_1hour": int, "best_1hour_start": int, "best_windows": { "secs": { "delta": int, "start": int } }, "top_users": [str,...], "two_person_runs": [...], "rate_rollup": { "bucket_seconds": int, "channels": { "ch": [int,...] } } }
+        self.history = defaultdict(list)
+        # sorted views of history for the leaderboards (see LeaderboardIndex)
+        self.leaderboards = LeaderboardIndex()
+        # bumped on every change to persisted data (totals, attempt history)
+        self.data_version = 0
+        # bumped only when the attempt history changes
+        self.history_version = 0
+        # latest published read views (see view)
+        self._history_view = None
+        self._view = None
+
+        self.run = None
+
+    @property
+    def run_active(self) -> bool:
+        return self.run is not None
+
+    # ---- persisted data ----
+    def load(self, data: dict):
+        for uid, count in data.get("total_counts_by_user", {}).items():
+            self.totals[int(uid)] = count
+
+        # load accuracy history (keys are team names)
+        for team, runs in data.get("team_accuracy_history", {}).items():
+            self.history[team] = runs
+        self.leaderboards.rebuild(self.history)
+        self.history_version += 1
+        self._publish_history()
+
+    def snapshot_data(self) -> dict:
+        # attempt records are never mutated after being appended, so copying the lists is enough
+        return {
+            "total_counts_by_user": dict(self.totals),
+            "team_accuracy_history": {team: list(runs) for team, runs in self.history.items()},
+        }
+
+    # ---- read views ----
+    def _publish_history(self):
+        # called at the points where an attempt is committed (or the history loaded)
+        self._history_view = (
+            self.history_version,
+            MappingProxyType({team: tuple(runs) for team, runs in self.history.items()}),
+            LeaderboardView(self.leaderboards),
+        )
+
+    def view(self) -> ReadView:
+        # immutable view of the persisted data for read-only commands, which use it instead of
+        # taking counts_lock. the history part is published when an attempt is committed; the
+        # totals change with every count, so they are copied when first read at a new
+        # data_version rather than on every count. everything runs on the event loop and the
+        # copy never awaits, so a view never shows a half-applied message
+        view = self._view
+        if view is None or view.data_version != self.data_version or view.history_version != self.history_version:
+            if self._history_view is None or self._history_view[0] != self.history_version:
+                self._publish_history()
+            _, history, leaderboards = self._history_view
+            view = self._view = ReadView(
+                self.data_version,
+                self.history_version,
+                MappingProxyType(dict(self.totals)),
+                history,
+                leaderboards,
+            )
+        return view
+
+    # ---- run lifecycle ----
+    def start_run(self, ts: float, channel_id=None) -> RunState:
+        self.run = RunState(ts, channel_id, self.detection_by_channel)
+        return self.run
+
+    def restore_run(self, cp: dict) -> RunState:
+        self.run = RunState.from_json(cp, self.detection_by_channel)
+        for ch, state in self.run.two_person_runs.items():
+            self._schedule_inactivity(ch, state)
+        return self.run
+
+    # ---- ingest ----
+    def is_relevant(self, ev: MessageEvent) -> bool:
+        # cheap pre-filter so unrelated messages never wait for counts_lock
+        if self.run is None:
+            return False
+        if ev.author_id in self.mistake_bots:
+            return True
+        return not ev.author_bot and ev.channel_id in self.track_channels
+
+    def handle_message(self, ev: MessageEvent) -> list:
+        if self.run is None:
+            return []
+        # deadlines due by now fire before the message is applied, as in replay, so the
+        # result does not depend on whether inactivity_watcher woke up first
+        expired = self.process_inactivity(ev.ts)
+
+        # ---- Mistake detection (channel / RUINED bots) ----
+        if ev.author_id in self.mistake_bots:
+            content = ev.content.lower()
+            if ("of" in content and ev.author_id == self.mistake_bot_channel_id) or (
+                "ruined" in content and ev.author_id == self.mistake_bot_ruined_id
+            ):
+                return expired + self.bot_mistake(ev)
+            return expired
+
+        # ---- Normal counting ----
+        if ev.author_bot or ev.channel_id not in self.track_channels:
+            return expired
+        number = parse_count(ev.content)
+        if number is None:
+            return expired
+        uid = self.main_user_of(ev.author_id)
+        if self.sequence_validation:
+            outcomes = self.check_sequence(ev.channel_id, uid, number, ev.ts)
+        else:
+            outcomes = self.record_count(ev.channel_id, uid, ev.ts)
+        if ev.message_id is not None and outcomes:
+            if outcomes[0].kind == "count":
+                self.run.recent_counts[ev.channel_id].add(ev.message_id, uid)
+            elif outcomes[0].kind == "wrong":
+                self.run.recent_counts[ev.channel_id].add(ev.message_id, None)
+        return expired + outcomes
+
+    def bot_mistake(self, ev: MessageEvent) -> list:
+        # a mistake bot reported a mistake in ev's channel. a reply to a remembered count takes
+        # back exactly that count; otherwise the channel's newest count is charged. a number
+        # sequence validation already charged as wrong is not charged again, and nothing is
+        # charged in a channel without counts this run
+        run = self.run
+        ch = ev.channel_id
+        ring = run.recent_counts.get(ch)
+        if self.sequence_validation:
+            run.sequence.pop(ch, None)
+        if ring is None:
+            return []
+        if ev.reference_id in ring:
+            uid = ring.take(ev.reference_id)
+            if uid is None:
+                # already taken back (both bots reported it) or charged as wrong
+                return []
+        else:
+            uid = ring.take_latest()
+        if uid is None:
+            return []
+        self.record_mistake(ch, uid)
+        return [Outcome("mistake", ch, uid)]
+
+    def check_sequence(self, ch: int, uid: int, number: int, ts: float) -> list:
+        # counts number if it is the channel's expected next number (any number while the
+        # channel is unsynced), otherwise charges uid with a wrong number
+        seq = self.run.sequence.get(ch)
+        if seq is None:
+            seq = self.run.sequence[ch] = [None, None]
+        expected, last_uid = seq
+
+        wrong = expected is not None and number != expected
+        if uid == last_uid and self.double_post != "allow":
+            if self.double_post == "ignore":
+                return []
+            wrong = True
+        if wrong:
+            seq[0] = None if self.sequence_reset == "resync" else 1
+            seq[1] = None
+            self.record_mistake(ch, uid, counted=False)
+            return [Outcome("wrong", ch, uid)]
+
+        seq[0] = number + 1
+        seq[1] = uid
+        return self.record_count(ch, uid, ts)
+
+    def record_count(self, ch: int, uid: int, ts: float, *, count_total: bool = True) -> list:
+        # applies one accepted count; returns the "count" outcome plus any two-person transitions
+        run = self.run
+
+        # assign run team on first valid number
+        if run.team is None:
+            run.team = self.team_of(uid)
+
+        run.counts_by_user[uid] += 1
+        run.correct += 1
+        run.version += 1
+        if count_total:
+            self.totals[uid] += 1
+            self.data_version += 1
+
+        run.counts_by_channel[ch] += 1
+
+        # increment per-channel per-user counter (and flag it for the next snapshot tick)
+        run.user_counts_by_channel[ch][uid] += 1
+        run.user_snapshots[ch].mark(uid)
+
+        # exact activity of the channel's current run (see INACTIVITY DEADLINES)
+        state = run.two_person_runs.get(ch)
+        if state and uid in state["runners"]:
+            state["times"].append(ts)
+            state["last"][uid] = ts
+
+        # append sender to last-N window for that channel (for detection)
+        window = run.senders[ch]
+        window.append(uid)
+
+        outcomes = [Outcome("count", ch, uid)]
+        # detection: window full with exactly the configured number of distinct senders
+        runners = window.detected_runners()
+        if runners:
+            if not state or not state.get("active"):
+                # no active run -> start it
+                self._start_two_person_run(ch, runners, ts)
+                outcomes.append(Outcome("run_started", ch, runners))
+            elif state.get("runners") != runners:
+                # NEW pair detected — finalize old run and START new run immediately
+                # finalize previous run but do NOT clear deque (so new run detection continues)
+                rec = self.end_two_person_run(ch, end_ts=ts, clear_deque=False)
+                outcomes.append(Outcome("run_ended", ch, rec))
+                self._start_two_person_run(ch, runners, ts)
+                outcomes.append(Outcome("run_started", ch, runners))
+        return outcomes
+
+    def record_mistake(self, ch: int, uid: int, *, counted: bool = True, count_total: bool = True):
+        # charges a mistake to uid in channel ch; returns the charged uid.
+        # counted: the mistaken number was credited as a count in ch and is taken back
+        # everywhere record_count added it (the snapshots pick it up at the next tick)
+        run = self.run
+        run.version += 1
+        if counted:
+            if run.counts_by_user[uid] > 0:
+                run.counts_by_user[uid] -= 1
+                run.correct -= 1
+            user_counts = run.user_counts_by_channel[ch]
+            if user_counts.get(uid, 0) > 0:
+                user_counts[uid] -= 1
+                run.counts_by_channel[ch] -= 1
+                run.user_snapshots[ch].mark(uid)
+            if count_total:
+                self.totals[uid] = max(0, self.totals[uid] - 1)
+                self.data_version += 1
+
+        team = self.team_of(uid)
+        if team:
+            run.team_mistakes[team] += 1
+            run.incorrect += 1
+        return uid
+
+    def sample_tick(self):
+        # appends one snapshot tick for every tracked channel
+        run = self.run
+        for ch in self.track_channels:
+            snaps = run.snapshots[ch]
+            value = run.counts_by_channel.get(ch, 0)
+            run.rollups[ch].add(len(snaps), value - (snaps[-1] if snaps else 0))
+            snaps.append(value)
+            run.user_snapshots[ch].sample(run.user_counts_by_channel[ch])
+
+    def replay(self, records, *, totals_saved_seq: int = 0, until_ts: float = None) -> int:
+        # re-applies journal records on top of the current run, replaying the sampler ticks
+        # and inactivity deadlines that fell between them; returns how many were applied
+        run = self.run
+        run_end_ts = run.start_time + RUN_ANALYSIS_WINDOW_HOURS * 3600
+        next_tick = run.tick_count()
+
+        def advance_ticks(to_ts):
+            # replays the sampler ticks that happened before to_ts
+            nonlocal next_tick
+            while True:
+                tick_ts = run.start_time + next_tick * SAMPLE_INTERVAL_SECONDS
+                if tick_ts > to_ts or tick_ts > run_end_ts:
+                    return
+                self.sample_tick()
+                next_tick += 1
+
+        replayed = 0
+        for rec in records:
+            advance_ticks(rec["ts"])
+            self.process_inactivity(rec["ts"])
+            count_total = rec["seq"] > totals_saved_seq
+            if rec["kind"] == "count":
+                self.record_count(rec["ch"], rec["uid"], rec["ts"], count_total=count_total)
+            elif rec["kind"] == "mistake":
+                self.record_mistake(rec["ch"], rec["uid"], count_total=count_total)
+            elif rec["kind"] == "wrong":
+                self.record_mistake(rec["ch"], rec["uid"], counted=False)
+            replayed += 1
+        if until_ts is not None:
+            advance_ticks(until_ts)
+            self.process_inactivity(until_ts)
+        return replayed
+
+    # ---- two-person runs ----
+    def _start_two_person_run(self, ch: int, runners: tuple, start_ts: float):
+        state = self.run.two_person_runs[ch] = {
+            "active": True,
+            "runners": runners,
+            "start_time": start_ts,
+            "warned": False,
+            # timestamps of the runners' last TWO_PERSON_MIN_COUNT counts since the start
+            "times": deque(maxlen=TWO_PERSON_MIN_COUNT),
+            # runner -> timestamp of their last count since the start
+            "last": {},
+        }
+        self._schedule_inactivity(ch, state)
+
+    def end_two_person_run(self, ch: int, *, end_ts: float, clear_deque: bool = True):
+        # closes the two-person run of a channel into its history; returns the history record (or None)
+        run = self.run
+        state = run.two_person_runs.pop(ch, None)
+        if not state:
+            return None
+        start_ts = state.get("start_time", end_ts)
+        rec = {
+            "runners": state["runners"],
+            "start": start_ts,
+            "end": end_ts,
+            "duration": int(end_ts - start_ts)
+        }
+        run.two_person_history[ch].append(rec)
+
+        # clear deque if requested
+        if clear_deque:
+            run.senders[ch].clear()
+        return rec
+
+    # ---- inactivity deadlines ----
+    # instead of re-checking every run on every sampler tick, each active run has the exact
+    # moment its activity rule would fail given the counts so far:
+    #   end:  TWO_PERSON_CHECK_MINUTES after the start, once fewer than TWO_PERSON_MIN_COUNT
+    #         runner counts are left in the trailing window or a runner has none in it
+    #   warn: the same with TWO_PERSON_WARNING_MINUTES, for the combined count only
+    # new counts can only push these moments later, so record_count just appends timestamps;
+    # deadlines live in a heap and are recomputed lazily when they come due.
+    @staticmethod
+    def inactivity_deadlines(state):
+        # (warn_at, end_at) for a run; warn_at is None once the run was warned
+        start = state["start_time"]
+        times = state["times"]
+        # the trailing window holds fewer than TWO_PERSON_MIN_COUNT counts once the oldest of the
+        # last TWO_PERSON_MIN_COUNT leaves it (already the case if there are fewer than that)
+        oldest = times[0] if len(times) == TWO_PERSON_MIN_COUNT else float("-inf")
+        quietest = min(state["last"].get(u, float("-inf")) for u in state["runners"])
+
+        check_s = TWO_PERSON_CHECK_MINUTES * 60
+        end_at = max(start + check_s, min(oldest, quietest) + check_s)
+        warn_at = None
+        if not state.get("warned", False):
+            warn_s = TWO_PERSON_WARNING_MINUTES * 60
+            warn_at = max(start + warn_s, oldest + warn_s)
+        return warn_at, end_at
+
+    def _schedule_inactivity(self, ch: int, state: dict):
+        heap = self.run.inactivity_heap
+        warn_at, end_at = self.inactivity_deadlines(state)
+        when = end_at if warn_at is None else min(warn_at, end_at)
+        state["deadline"] = when
+        heapq.heappush(heap, (when, ch, state["start_time"]))
+        if heap[0][0] == when and self.on_deadline is not None:
+            self.on_deadline(when)
+
+    def next_deadline(self):
+        if self.run is None or not self.run.inactivity_heap:
+            return None
+        return self.run.inactivity_heap[0][0]
+
+    def process_inactivity(self, now_ts: float) -> list:
+        # fires every deadline due at now_ts; returns "run_warning" and "run_ended" outcomes,
+        # runs that failed the rule end at the exact crossing time
+        run = self.run
+        if run is None:
+            return []
+        heap = run.inactivity_heap
+        outcomes = []
+        while heap and heap[0][0] <= now_ts:
+            when, ch, start_ts = heapq.heappop(heap)
+            state = run.two_person_runs.get(ch)
+            if not state or state["start_time"] != start_ts or state.get("deadline") != when:
+                # run ended or rescheduled since
+                continue
+            warn_at, end_at = self.inactivity_deadlines(state)
+            if end_at <= now_ts:
+                # clear the deque so we don't immediately restart accidentally
+                rec = self.end_two_person_run(ch, end_ts=end_at, clear_deque=True)
+                outcomes.append(Outcome("run_ended", ch, rec))
+                continue
+            if warn_at is not None and warn_at <= now_ts:
+                state["warned"] = True  # mark warned so we don't spam
+                outcomes.append(Outcome("run_warning", ch, None))
+            self._schedule_inactivity(ch, state)
+        return outcomes
+
+    # ---- finalization ----
+    # finalize_run = detach_run (under counts_lock) + summarize_run (pure, safe to run in a
+    # worker thread on the detached run) + commit_attempt (under counts_lock)
+    def detach_run(self, end_ts: float):
+        # ends the run: closes its still-active two-person runs at end_ts and detaches its
+        # state, so a new run can start right away. returns (run, [(ch, two-person record)])
+        run = self.run
+        # finalize any still-active two-person runs as ending now and append to history (clear deque)
+        ended = []
+        for ch, state in list(run.two_person_runs.items()):
+            if state.get("active"):
+                ended.append((ch, self.end_two_person_run(ch, end_ts=end_ts, clear_deque=True)))
+        run.inactivity_heap.clear()
+        self.run = None
+        return run, ended
+
+    def commit_attempt(self, summary: dict, *, save: bool = True) -> dict:
+        # stores the attempt record of a summarize_run result (if the run has a team and save
+        # is True); fills in the display fields and returns the summary
+        team = summary["team"]
+        record = summary["record"]
+        # top users for this run (up to 2) for storage
+        record["top_users"] = [self.display_name(uid) for uid in summary["top_team_users"]]
+        summary["saved"] = bool(team and save)
+        if summary["saved"]:
+            self.history[team].append(record)
+            self.leaderboards.add(team, len(self.history[team]), record)
+            self.data_version += 1
+            self.history_version += 1
+            self._publish_history()
+        summary["attempt_number"] = len(self.history[team]) if team in self.history else 1
+        return summary
+
+    def finalize_run(self, end_ts: float, *, save: bool = True) -> dict:
+        # all three steps at once, for callers that don't need the lock released in between
+        run, ended = self.detach_run(end_ts)
+        summary = summarize_run(run, self.team_of)
+        summary["ended_two_person"] = ended
+        return self.commit_attempt(summary, save=save)
+
+def summarize_run(run: RunState, team_of) -> dict:
+    # everything the final stats need from a detached run: leaderboard, accuracy, best
+    # windows, two-person runs and the attempt record (top_users is set by commit_attempt).
+    # reads nothing but the run, so it can run in a worker thread
+    leaderboard_items = sorted(
+        run.counts_by_user.items(),
+        key=lambda x: -x[1]
+    )
+
+    correct = sum(run.counts_by_user.values())
+    incorrect = sum(run.team_mistakes.values())
+
+    # compute numeric accuracy value (percent)
+    acc_value = format_accuracy_value(correct, incorrect)
+
+    # best windows (fastest 1 hour and the other ANALYSIS_WINDOW_SECONDS) from the snapshots
+    windows = analyze_run_windows(run.snapshots, run.user_snapshots)
+    fastest = windows[FASTEST_WINDOW_SECONDS]
+    best_windows = {
+        str(secs): {"delta": res["delta"], "start": res["start_seconds"]}
+        for secs, res in windows.items()
+    }
+
+    # the run team's top users (up to 2)
+    top_team_users = []
+    for uid, cnt in leaderboard_items:
+        if team_of(uid) == run.team:
+            top_team_users.append(uid)
+        if len(top_team_users) >= 2:
+            break
+
+    # two-person runs flattened for storing in the attempt record, and the longest one
+    two_runs_flat = []
+    longest = None
+    for ch, runs in run.two_person_history.items():
+        for rec in runs:
+            two_runs_flat.append({
+                "channel": ch,
+                "runners": rec["runners"],
+                "start": rec["start"],
+                "end": rec["end"],
+                "duration": rec["duration"]
+            })
+            if rec["duration"] > (longest["duration"] if longest else 0):
+                longest = dict(rec, channel=ch)
+
+    record = {
+        "correct": correct,
+        "incorrect": incorrect,
+        "accuracy": acc_value,
+        "best_1hour": fastest["delta"],
+        "best_1hour_start": fastest["start_seconds"],
+        "best_windows": best_windows,
+        "top_users": [],
+        "two_person_runs": two_runs_flat,
+        # numbers counted per ROLLUP_BUCKET_SECONDS of the attempt, per channel
+        "rate_rollup": {
+            "bucket_seconds": ROLLUP_BUCKET_SECONDS,
+            "channels": {
+                str(ch): rollup.buckets()
+                for ch, rollup in run.rollups.items()
+            },
+        },
+    }
+
+    # participants of the best 1-hour window
+    best_participants = []
+    if fastest["channel"] is not None and fastest["delta"] > 0:
+        best_participants = [uid for d, uid in fastest["participants"]][:2]
+
+    return {
+        "run": run,
+        "team": run.team,
+        "record": record,
+        "top_team_users": top_team_users,
+        "leaderboard": leaderboard_items,
+        "correct": correct,
+        "incorrect": incorrect,
+        "accuracy": acc_value,
+        "best_1hour": fastest["delta"],
+        "best_channel": fastest["channel"],
+        "best_participants": best_participants,
+        "windows": windows,
+        "longest": longest,
+        "ended_two_person": [],
+    }
@@ -1,1510 +1,1991 @@
-import discord
-from discord.ext import commands
-import logging
-from dotenv import load_dotenv
-import os
-import asyncio
-import json
-import time
-from collections import defaultdict, deque
-import io
-
-# -------- ENV --------
-load_dotenv()
-TOKEN = os.getenv("DISCORD_TOKEN")
-
-# -------- LOGGING --------
-handler = logging.FileHandler(filename="discord.log", encoding="utf-8", mode="w")
-
-# -------- INTENTS --------
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-
-# -------- BOT --------
-bot = commands.Bot(command_prefix=None, intents=intents)
-
-# -------- CHANNELS --------
-TRACK_CHANNELS = {
-    1315525836341907560, # classic coliseum
-    1315492435115114517  # contando coliseum
-}
-
-COMMANDS_CHANNEL_ID = 1315525419813834783
-
-# roles to lock/unlock
-LOCK_ROLE_IDS = {
-    1315670624898650152,
-    1315670215006359602
-}
-
-# special runner roles - if the run starter has one of these, enable Send Messages for that role during the run
-SPECIAL_ROLES = {
-    1468272749142212718,
-    1468272788874989653,
-    1468272811859640524,
-    1468272842327195805
-}
-
-# store original overwrites when modifying special roles during run
-run_original_overwrites = defaultdict(dict)
-run_enabled_special_roles = set()
-
-# -------- CONSTANTS --------
-MISTAKE_BOT_CHANNEL_ID = 510016054391734273
-MISTAKE_BOT_RUINED_ID = 639599059036012605
-
-# two-person run thresholds
-TWO_PERSON_DETECTION_WINDOW = 40     # how many recent messages to inspect to detect a 2-person pair
-TWO_PERSON_MIN_COUNT = 95            # changed from 100 -> 95 (numbers in last 10 minutes required)
-TWO_PERSON_WARNING_MINUTES = 9       # send warning if last 9 minutes < TWO_PERSON_MIN_COUNT
-TWO_PERSON_CHECK_MINUTES = 10        # check inactivity over last 10 minutes
-
-# -------- TEAMS --------
-teams = {
-    "Space Walkers": [1189250809020555344, 904224456677945364, 577666133549645834, 497517322206969856, 832596613922684968,
-             495708539462090762, 665011985121017894, 514078286146699265, 1063269856251740180, 520341628049686538,
-             1221444926819270763, 762417923574726667, 1156662987357171854, 885123109630406706, 1274417682975952948
-    ],
-    "Hopes and Dreams": [903692413300793434, 586031901207166976, 992014751381065791, 770794762780409856, 1275494343293272166,
-             713936728481857637, 1198658950082609299, 130452258864234496, 875155347541721100, 1136159374511968438,
-             890989360701386754, 91628137384808448, 572231874525659189, 1200505072493285544, 817022469004984340
-    ],
-    "ⅩⅩⅡ": [485412155596996628, 1327841688147984558, 593889062377488435, 1267712959589912598, 855351859039174677,
-             668223790500544512, 456613134682030081, 1146434565179723899, 953238846852702238, 1137835454671097906,
-             249881368945885184, 641706102312140800, 484484139349835781, 392459609283100672, 735957682913017866
-    ],
-    "Chicago Stix": [895534695729725500, 709650885487099985, 749049630775312524, 1178268672373030975,784701362536448001,
-                     886617454867013642, 547612876530122763, 309840548695638026, 747859758354137128, 848670503182794763,
-                     1290390298958233720, 655855955304644629, 815837012648919050, 1403694438143889498, 154721499159199744
-    ]
-}
-
-user_team_mapping = {
-    user_id: team
-    for team, users in teams.items()
-    for user_id in users
-}
-
-
-# -------- NICKNAMES --------
-user_nicknames = {
-    749049630775312524:  "nicks",    497517322206969856:  "isa",    709650885487099985:  "gab",    665011985121017894:  "nicoel",
-    992014751381065791:  "khyma",    1327841688147984558: "thiran", 762417923574726667:  "logan",  1189250809020555344: "dark",
-    91628137384808448:   "A*",       1136159374511968438: "ama",    1267712959589912598: "arya",   875155347541721100:  "axo",
-    593889062377488435:  "azure",    855351859039174677:  "bertl",  1200505072493285544: "claret", 1290390298958233720: "cobrakai",
-    848670503182794763:  "deepblue", 514078286146699265:  "digi",   1275494343293272166: "dodge",  641706102312140800:  "ec",
-    903692413300793434:  "hope",     747859758354137128:  "iron",   713936728481857637:  "jake",   1063269856251740180: "james",
-    1156662987357171854: "jdubs",    586031901207166976:  "kailee", 890989360701386754:  "korl",   770794762780409856:  "leaw",
-    249881368945885184:  "leti",     1137835454671097906: "lost",   832596613922684968:  "maddie", 1146434565179723899: "lite",
-    495708539462090762:  "marcin",   885123109630406706:  "milk",   904224456677945364:  "nai",    547612876530122763:  "nap",
-    1403694438143889498: "nssleo",   1221444926819270763: "sonic",  895534695729725500: "stick",   577666133549645834:  "onyan",
-    735957682913017866:  "onyx",     668223790500544512:  "pia",    485412155596996628:  "quv",    154721499159199744:  "raydop",
-    572231874525659189:  "rreae",    456613134682030081:  "sall",   953238846852702238:  "salt",   392459609283100672:  "saud",
-    130452258864234496:  "scan",     817022469004984340:  "schpark", 484484139349835781:  "skilo", 784701362536448001: "shelley", 
-    815837012648919050:  "super",    520341628049686538: "trashcore", 886617454867013642: "zgames", 655855955304644629: "robby",
-    309840548695638026:  "w0rd",     1198658950082609299:"storydreamer", 1178268672373030975:"willy", 1274417682975952948:"bruce"
-}
-
-# -------- ALTS --------
-alt_to_main = {
-    # ALT_ID: MAIN_ID,
-    866803634964529162: 749049630775312524,  # nicks
-    984550127400259695: 709650885487099985,  # gab
-    892551131488743434: 497517322206969856,  # isa
-    1260746158553305222: 497517322206969856, # isa2
-    1207827979451768862: 665011985121017894, # nicoel
-    
-    1176872999287279710: 992014751381065791, # "khyma"
-    1250914738603557016: 992014751381065791, # "khyma2"
-    1347500051441909760: 1327841688147984558,# "thiran"
-    1: 762417923574726667, # "logan"
-    1189255952797536339: 1189250809020555344,# "dark"
-    0: 91628137384808448,  # "A*"
-    305414646972809216: 1136159374511968438, # "ama"
-    1414033725045473281: 1267712959589912598,# "arya"
-    1469199696135454831: 1267712959589912598,# "arya"
-    1079617884633968720: 875155347541721100, # "axo"
-    1024919799630929930: 875155347541721100, # "axo2"
-    1248216922760151075: 593889062377488435, # "azure"
-    1154761242611814431: 593889062377488435, # "azure2"
-    1222912258594705519: 855351859039174677, # "bertl"
-    0: 1200505072493285544,# "claret"
-    1293661110066483323: 1290390298958233720,# "cobrakai"
-    1153637098751004722: 848670503182794763, # "deepblue"
-    1: 514078286146699265, # "digi"
-    1370859001469993052: 1275494343293272166,# "dodge"
-    1472092376867668133: 1275494343293272166,# "dodge2"
-    0: 177013970895503360, # "duck"
-    1214592526510456872: 903692413300793434, # "hope"
-    1273859055147945994: 903692413300793434, # "hope2"
-    1082448603789922386: 747859758354137128, # "iron"
-    955603875421904966: 713936728481857637,  # "jake"
-    1310698295642820608: 1063269856251740180,# "james"
-    1348389360122466347: 1156662987357171854,# "jdubs"
-    419233067312611329: 586031901207166976,  # "kailee"
-    936197474115276810: 890989360701386754,  # "korl"
-    1329622073978388532: 770794762780409856, # "leaw"
-    1298027245478350942: 249881368945885184, # "leti"
-    1201311902085685338: 1137835454671097906,# "lost"
-    0: 832596613922684968, # "maddie"
-    0: 1146434565179723899,# "lite"
-    898089548905578506: 495708539462090762,  # "marcin"
-    915622952257601596: 885123109630406706,  # "milk"
-    1247146814281613408: 904224456677945364, # "nai"
-    343209930590912525: 904224456677945364, # "nai2"
-    0: 547612876530122763, # "nap"
-    0: 1403694438143889498,# "nssleo"
-    1: 1221444926819270763,# "sonic"
-    452322112707756032: 895534695729725500,  # "stick"
-    627998970320388106: 577666133549645834,  # "onyan"
-    1305061438959779871: 735957682913017866, # "onyx"
-    0: 668223790500544512, # "pia"
-    1051529942107689020: 485412155596996628,  # "quv2"
-    592670631854735361: 485412155596996628,  # "quv"
-    1345019952310259732: 154721499159199744, # "raydop"
-    1472743353404883040: 572231874525659189, # "rreae"
-    0: 456613134682030081, # "sall"
-    1223120985109041194: 953238846852702238, # "salt"
-    1225374339961065503: 953238846852702238,  # salt2
-    1239981964153327734: 392459609283100672, # "saud"
-    0: 130452258864234496, # "scan"
-    1420868900295413790: 817022469004984340, # "schpark"
-    0: 784701362536448001, # "shelley"
-    1374386220259610746: 484484139349835781, # "skilo"
-    1: 815837012648919050, # "super"
-    964996735908843520: 520341628049686538,  # "trashcore"
-    1146121542560927905: 886617454867013642, # "zgames"
-    1141392363319722075: 886617454867013642, # "zgames2"
-    1336180081500094536: 655855955304644629, # "kazuma"
-    0: 309840548695638026, # "w0rd"
-    0: 1198658950082609299,# "storydreamer"
-    1065819724082065489: 1178268672373030975,# "willy"
-    1348101708974391357: 1274417682975952948,# "bruce"
-    1354797552511225926: 641706102312140800  # ec
-}
-
-# -------- STORAGE --------
-DATA_DIR = "/data" if os.getenv("RAILWAY_ENVIRONMENT") else "."
-DATA_FILE = os.path.join(DATA_DIR, "run_data.json")
-
-# -------- STATE --------
-run_active = False
-run_start_time = None
-last_valid_user_id = None
-current_run_team = None  # <-- team assigned to the current run (set on first valid number)
-
-total_counts_by_user = defaultdict(int)
-
-run_counts_by_user = defaultdict(int)
-run_team_mistakes = defaultdict(int)
-
-# store per-team attempt history: team -> list of { "correct": int, "incorrect": int, "accuracy": float or None, "best_1hour": int, "best_1hour_start": int, "top_users": [str,...], "two_person_runs": [...] }
-team_accuracy_history = defaultdict(list)
-
-# For fastest 1-hour sliding window analysis
-RUN_ANALYSIS_WINDOW_HOURS = 24   # total run duration
-FASTEST_WINDOW_SECONDS = 3600   # 1 hour window
-SAMPLE_INTERVAL_SECONDS = 10    # keep this (sampling resolution)
-# per-channel snapshots (cumulative totals sampled during run every SAMPLE_INTERVAL_SECONDS)
-run_snapshots_per_channel = defaultdict(list)
-
-# per-channel running counters during run (all users)
-run_counts_by_channel = defaultdict(int)
-
-# per-channel per-user cumulative counters during run
-run_user_counts_by_channel = defaultdict(lambda: defaultdict(int))
-# per-channel per-user sampled snapshots lists
-run_user_snapshots_per_channel = defaultdict(lambda: defaultdict(list))
-
-# last N senders per channel (to detect 2-person start)
-last_50_senders_per_channel = defaultdict(lambda: deque(maxlen=TWO_PERSON_DETECTION_WINDOW))
-
-# two-person run state per channel
-# structure: ch_id -> { 'active': bool, 'runners': (uid1, uid2), 'start_time': float, 'warned': bool }
-two_person_runs = {}
-
-# history of two-person runs during the attempt, per channel
-# structure: ch_id -> [ { "runners": (uid1, uid2), "start": ts, "end": ts, "duration": secs } , ... ]
-run_two_person_history_per_channel = defaultdict(list)
-
-# background task references (so /end_run can cancel them)
-run_timer_task = None
-run_sampler_task = None
-
-counts_lock = asyncio.Lock()
-
-# -------- LOAD / SAVE --------
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        return
-
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    for uid, count in data.get("total_counts_by_user", {}).items():
-        total_counts_by_user[int(uid)] = count
-
-    # load accuracy history (keys are team names)
-    for team, runs in data.get("team_accuracy_history", {}).items():
-        team_accuracy_history[team] = runs
-
-
-def save_data():
-    os.makedirs(DATA_DIR, exist_ok=True)
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump({
-            "total_counts_by_user": dict(total_counts_by_user),
-            "team_accuracy_history": dict(team_accuracy_history),
-        }, f, indent=2)
-
-# -------- AUTOSAVE --------
-async def autosave_loop():
-    while True:
-        await asyncio.sleep(10)
-        async with counts_lock:
-            if run_active:
-                save_data()
-
-# -------- HELPERS --------
-def resolve_main_user_id(uid: int) -> int:
-    return alt_to_main.get(uid, uid)
-
-def get_user_team(uid: int):
-    return user_team_mapping.get(uid)
-
-def get_display_name(uid: int):
-    if uid in user_nicknames:
-        return user_nicknames[uid]
-    user = bot.get_user(uid)
-    if user:
-        return user.name
-    return f"User {uid}"
-
-def is_valid_count_message(content: str) -> bool:
-    content = content.lstrip()
-    if not content:
-        return False
-    # valid if begins with digits and next char (if any) is whitespace or end-of-string
-    first_token = content.split(" ", 1)[0]
-    return first_token.isdigit()
-
-def format_duration(seconds: int) -> str:
-    h = seconds // 3600
-    m = (seconds % 3600) // 60
-    s = seconds % 60
-    return f"{h:02}:{m:02}:{s:02}"
-
-def format_duration_hours_minutes(seconds: int) -> str:
-    # For leaderboard_longest display as HH:MM (no seconds)
-    h = seconds // 3600
-    m = (seconds % 3600) // 60
-    return f"{h:02}:{m:02}"
-
-def format_accuracy_value(correct: int, incorrect: int):
-    total = correct + incorrect
-    if total == 0:
-        return None
-    acc = (correct / total) * 100
-    return acc
-
-def format_accuracy_display(acc_value):
-    # acc_value is float percent or None
-    if acc_value is None:
-        return "N/A"
-    if acc_value == 100:
-        return "100%"
-    return f"{acc_value:06.3f}%"
-
-def _overwrite_has_any(ow: discord.PermissionOverwrite) -> bool:
-    # returns True if overwrite has any explicit permission set (not all None)
-    if ow is None:
-        return False
-    for attr in (
-        "add_reactions", "manage_messages", "manage_channels", "manage_roles", "view_channel",
-        "send_messages", "read_message_history", "send_tts", "connect", "speak",
-        "use_application_commands", "embed_links", "attach_files", "use_external_emojis",
-        "use_external_stickers"
-    ):
-        if getattr(ow, attr, None) is not None:
-            return True
-    return False
-
-# -------- Lock/Unlock helper for TRACK_CHANNELS --------
-async def lock_track_channels(guild: discord.Guild):
-    try:
-        for role_id in LOCK_ROLE_IDS:
-            role = guild.get_role(role_id)
-            if role is None:
-                continue
-
-            for ch_id in TRACK_CHANNELS:
-                ch = bot.get_channel(ch_id) or guild.get_channel(ch_id)
-                if ch:
-                    try:
-                        await ch.set_permissions(
-                            role,
-                            send_messages=False,
-                            reason="Run started: locking channels"
-                        )
-                    except Exception:
-                        pass
-    except Exception:
-        pass
-
-async def unlock_track_channels(guild: discord.Guild):
-    try:
-        for role_id in LOCK_ROLE_IDS:
-            role = guild.get_role(role_id)
-            if role is None:
-                continue
-
-            for ch_id in TRACK_CHANNELS:
-                ch = bot.get_channel(ch_id) or guild.get_channel(ch_id)
-                if ch:
-                    try:
-                        await ch.set_permissions(
-                            role,
-                            send_messages=True,
-                            reason="Run ended: unlocking channels"
-                        )
-                    except Exception:
-                        pass
-    except Exception:
-        pass
-
-# -------- Special roles enable/restore helpers --------
-async def enable_special_roles_for_member(guild: discord.Guild, member: discord.Member):
-    global run_original_overwrites, run_enabled_special_roles
-    if guild is None or member is None:
-        return
-
-    member_role_ids = {r.id for r in member.roles}
-    to_enable = member_role_ids & SPECIAL_ROLES
-    if not to_enable:
-        return
-
-    run_enabled_special_roles = set(to_enable)
-
-    async with counts_lock:
-        for ch_id in TRACK_CHANNELS:
-            ch = bot.get_channel(ch_id) or guild.get_channel(ch_id)
-            if not ch:
-                continue
-            for rid in to_enable:
-                role = guild.get_role(rid)
-                if role is None:
-                    continue
-                try:
-                    prev = ch.overwrites_for(role)
-                except Exception:
-                    prev = None
-                prev_save = None
-                try:
-                    if prev is not None and _overwrite_has_any(prev):
-                        prev_save = prev
-                except Exception:
-                    prev_save = None
-                run_original_overwrites[ch_id][rid] = prev_save
-                try:
-                    await ch.set_permissions(role, send_messages=True, reason="Run started: enabling special role for runner")
-                except Exception:
-                    pass
-
-async def restore_special_roles(guild: discord.Guild):
-    global run_original_overwrites, run_enabled_special_roles
-    if guild is None:
-        # clear stored data anyway
-        run_original_overwrites.clear()
-        run_enabled_special_roles.clear()
-        return
-
-    async with counts_lock:
-        for ch_id, role_map in list(run_original_overwrites.items()):
-            ch = bot.get_channel(ch_id) or guild.get_channel(ch_id)
-            if not ch:
-                continue
-            for rid, prev in role_map.items():
-                role = guild.get_role(rid)
-                if role is None:
-                    continue
-                try:
-                    if prev is None:
-                        # remove explicit overwrite (restore to "no explicit allow/deny")
-                        await ch.set_permissions(role, overwrite=None, reason="Run ended: restoring special role overwrite")
-                    else:
-                        # restore previous explicit overwrite object
-                        await ch.set_permissions(role, overwrite=prev, reason="Run ended: restoring special role overwrite")
-                except Exception:
-                    pass
-        run_original_overwrites.clear()
-        run_enabled_special_roles.clear()
-
-# -------- UTIL: finalize two-person run --------
-def _append_two_person_history(ch: int, runners: tuple, start_ts: float, end_ts: float):
-    duration = int(end_ts - start_ts)
-    run_two_person_history_per_channel[ch].append({
-        "runners": runners,
-        "start": start_ts,
-        "end": end_ts,
-        "duration": duration
-    })
-
-async def finalize_two_person_run(ch: int, *, end_ts: float = None, clear_deque: bool = True, announce_in_commands: bool = True):
-
-    if end_ts is None:
-        end_ts = time.time()
-    state = two_person_runs.get(ch)
-    if not state:
-        return
-    runners = state["runners"]
-    start_ts = state.get("start_time", end_ts)
-    _append_two_person_history(ch, runners, start_ts, end_ts)
-
-    if announce_in_commands:
-        duration = int(end_ts - start_ts)
-        duration_text = format_duration(duration)
-        cmd_ch = bot.get_channel(COMMANDS_CHANNEL_ID)
-        runners_display = " & ".join(get_display_name(u) for u in runners)
-        ch_mention = f"<#{ch}>"
-        if cmd_ch:
-            await cmd_ch.send(f"Run ended in {ch_mention}!\nRunners: {runners_display}\nTotal time was: **{duration_text}**")
-
-    # remove active run state
-    if ch in two_person_runs:
-        del two_person_runs[ch]
-
-    # clear deque if requested
-    if clear_deque:
-        last_50_senders_per_channel[ch].clear()
-
-# -------- SECONDARY SAMPLER TASK (every SAMPLE_INTERVAL_SECONDS) --------
-async def minute_sampler():
- 
-    total_samples = (RUN_ANALYSIS_WINDOW_HOURS * 3600) // SAMPLE_INTERVAL_SECONDS
-    # initial snapshot at time 0 for each tracked channel
-    async with counts_lock:
-        for ch in TRACK_CHANNELS:
-            run_snapshots_per_channel[ch].append(run_counts_by_channel.get(ch, 0))
-            # per-user: initialize existing users snapshot
-            users = set(run_user_counts_by_channel[ch].keys()) | set(run_user_snapshots_per_channel[ch].keys())
-            for u in users:
-                val = run_user_counts_by_channel[ch].get(u, 0)
-                run_user_snapshots_per_channel[ch][u].append(val)
-
-    samples_in_10min = (TWO_PERSON_CHECK_MINUTES * 60) // SAMPLE_INTERVAL_SECONDS
-    samples_in_9min = (TWO_PERSON_WARNING_MINUTES * 60) // SAMPLE_INTERVAL_SECONDS
-
-    for _ in range(total_samples):
-        await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
-        async with counts_lock:
-            if not run_active:
-                break
-
-            for ch in TRACK_CHANNELS:
-                run_snapshots_per_channel[ch].append(run_counts_by_channel.get(ch, 0))
-                users = set(run_user_counts_by_channel[ch].keys()) | set(run_user_snapshots_per_channel[ch].keys())
-                for u in users:
-                    val = run_user_counts_by_channel[ch].get(u, None)
-                    if val is None:
-                        prev_list = run_user_snapshots_per_channel[ch].get(u, [])
-                        val = prev_list[-1] if prev_list else 0
-                    run_user_snapshots_per_channel[ch][u].append(val)
-
-            # After sampling, check two-person runs for activity condition (TWO_PERSON_MIN_COUNT in last 10 minutes)
-            to_end = []
-            now_ts = time.time()
-            for ch, state in list(two_person_runs.items()):
-                if not state.get("active"):
-                    continue
-                runners = state["runners"]
-                run_start_time = state.get("start_time", now_ts)
-
-                # WARNING: check the 9-minute warning if run has been active long enough and not yet warned
-                if (now_ts - run_start_time) >= (TWO_PERSON_WARNING_MINUTES * 60) and not state.get("warned", False):
-                    snaps = run_user_snapshots_per_channel.get(ch, {})
-                    u1, u2 = runners
-                    list1 = snaps.get(u1, [])
-                    list2 = snaps.get(u2, [])
-                    if len(list1) > samples_in_9min and len(list2) > samples_in_9min:
-                        curr1 = list1[-1]
-                        prev1 = list1[-1 - samples_in_9min]
-                        curr2 = list2[-1]
-                        prev2 = list2[-1 - samples_in_9min]
-                        delta9 = (curr1 - prev1) + (curr2 - prev2)
-                        if delta9 < TWO_PERSON_MIN_COUNT:
-                            # send a single warning in commands channel mentioning the active channel
-                            cmd_ch = bot.get_channel(COMMANDS_CHANNEL_ID)
-                            ch_mention = f"<#{ch}>"
-                            if cmd_ch:
-                                await cmd_ch.send(f"The current run in {ch_mention} is close to ending for inactivity!")
-                            state['warned'] = True  # mark warned so we don't spam
-
-                # Only check full inactivity rule if run has existed at least TWO_PERSON_CHECK_MINUTES
-                if now_ts - run_start_time < (TWO_PERSON_CHECK_MINUTES * 60):
-                    continue
-
-                snaps = run_user_snapshots_per_channel.get(ch, {})
-                u1, u2 = runners
-                list1 = snaps.get(u1, [])
-                list2 = snaps.get(u2, [])
-                if len(list1) <= samples_in_10min or len(list2) <= samples_in_10min:
-                    # still not enough samples -> wait
-                    continue
-
-                curr1 = list1[-1]
-                prev1 = list1[-1 - samples_in_10min]
-                curr2 = list2[-1]
-                prev2 = list2[-1 - samples_in_10min]
-                delta1 = curr1 - prev1
-                delta2 = curr2 - prev2
-                delta = delta1 + delta2
-
-                # End run if combined < TWO_PERSON_MIN_COUNT OR if any runner contributed 0 in last 10 minutes
-                if delta < TWO_PERSON_MIN_COUNT or delta1 < 1 or delta2 < 1:
-                    to_end.append(ch)
-
-            # End the runs that failed the check (inactivity). Announce in commands channel and clear deque.
-            for ch in to_end:
-                # finalize and clear_deque=True so we don't immediately restart accidentally
-                await finalize_two_person_run(ch, clear_deque=True, announce_in_commands=True)
-
-# -------- MESSAGE LISTENER --------
-@bot.event
-async def on_message(message: discord.Message):
-    global last_valid_user_id, current_run_team
-
-    # ---- Mistake detection (channel / RUINED bots) ----
-    if run_active and message.author.id in {MISTAKE_BOT_CHANNEL_ID, MISTAKE_BOT_RUINED_ID}:
-        content = (message.content or "").lower()
-        if ("of" in content and message.author.id == MISTAKE_BOT_CHANNEL_ID) or (
-            "ruined" in content and message.author.id == MISTAKE_BOT_RUINED_ID
-        ):
-            async with counts_lock:
-                if last_valid_user_id is not None:
-                    uid = last_valid_user_id
-                    run_counts_by_user[uid] = max(0, run_counts_by_user[uid] - 1)
-                    total_counts_by_user[uid] = max(0, total_counts_by_user[uid] - 1)
-
-                    team = get_user_team(uid)
-                    if team:
-                        run_team_mistakes[team] += 1
-            return
-
-    # ---- Normal counting ----
-    if message.author.bot or message.author.system:
-        return
-    if not run_active or message.channel.id not in TRACK_CHANNELS:
-        return
-    if not is_valid_count_message(message.content or ""):
-        return
-
-    async with counts_lock:
-        raw_uid = message.author.id
-        uid = resolve_main_user_id(raw_uid)
-
-        last_valid_user_id = uid
-
-        # assign run team on first valid number
-        if current_run_team is None:
-            current_run_team = get_user_team(uid)
-
-        run_counts_by_user[uid] += 1
-        total_counts_by_user[uid] += 1
-
-        # increment per-channel running counter
-        run_counts_by_channel[message.channel.id] += 1
-
-        # increment per-channel per-user counter
-        run_user_counts_by_channel[message.channel.id][uid] += 1
-
-        # append sender to last-N deque for that channel (for detection)
-        dq = last_50_senders_per_channel[message.channel.id]
-        dq.append(uid)
-
-        # detection: if deque full and plugin not already active, check unique senders
-        if len(dq) == dq.maxlen:
-            unique = set(dq)
-            if len(unique) == 2:
-                runners = tuple(sorted(unique))
-                state = two_person_runs.get(message.channel.id)
-                if not state or not state.get("active"):
-                    # no active run -> start it
-                    two_person_runs[message.channel.id] = {
-                        "active": True,
-                        "runners": runners,
-                        "start_time": time.time(),
-                        "warned": False
-                    }
-                    # announce in commands channel (clickable mention)
-                    cmd_ch = bot.get_channel(COMMANDS_CHANNEL_ID)
-                    runners_display = " & ".join(get_display_name(u) for u in runners)
-                    ch_mention = f"<#{message.channel.id}>"
-                    if cmd_ch:
-                        await cmd_ch.send(f"A new run has started in {ch_mention}\nRunners: {runners_display}")
-                else:
-                    # there is an active run in this channel
-                    current_runners = state.get("runners")
-                    if current_runners != runners:
-                        # NEW pair detected — finalize old run and START new run immediately
-                        # finalize previous run but do NOT clear deque (so new run detection continues)
-                        await finalize_two_person_run(message.channel.id, clear_deque=False, announce_in_commands=True)
-                        # start the new run
-                        two_person_runs[message.channel.id] = {
-                            "active": True,
-                            "runners": runners,
-                            "start_time": time.time(),
-                            "warned": False
-                        }
-                        cmd_ch = bot.get_channel(COMMANDS_CHANNEL_ID)
-                        runners_display = " & ".join(get_display_name(u) for u in runners)
-                        ch_mention = f"<#{message.channel.id}>"
-                        if cmd_ch:
-                            await cmd_ch.send(f"A new run has started in {ch_mention}\nRunners: {runners_display}")
-
-# -------- RUN TIMER (finalize attempt) --------
-async def run_timer(channel: discord.abc.Messageable):
-    global run_active, current_run_team, run_timer_task
-
-    # original sleep duration preserved (kept same as you had)
-    await asyncio.sleep(60*60*24)
-
-    async with counts_lock:
-        run_active = False
-
-        leaderboard_items = sorted(
-            run_counts_by_user.items(),
-            key=lambda x: -x[1]
-        )
-
-        mistakes_snapshot = dict(run_team_mistakes)
-        correct = sum(run_counts_by_user.values())
-        incorrect = sum(mistakes_snapshot.values())
-        total_attempts = correct + incorrect
-
-        # compute numeric accuracy value (percent) and store per-team attempt
-        acc_value = format_accuracy_value(correct, incorrect)
-
-        # compute best 1-hour sliding-window delta per channel using run_snapshots_per_channel
-        best_1hour = 0
-        best_channel = None
-        best_start_index = 0
-        window_samples = FASTEST_WINDOW_SECONDS // SAMPLE_INTERVAL_SECONDS
-        for ch, snapshots in run_snapshots_per_channel.items():
-            N = len(snapshots)
-            if N <= window_samples:
-                continue
-            for i in range(0, N - window_samples):
-                delta = snapshots[i + window_samples] - snapshots[i]
-                if delta > best_1hour:
-                    best_1hour = delta
-                    best_channel = ch
-                    best_start_index = i
-
-        best_start_seconds = best_start_index * SAMPLE_INTERVAL_SECONDS if best_channel is not None else 0
-
-        # determine top users for this run (up to 2) for storage
-        top_users_for_run = []
-        if leaderboard_items:
-            for uid, cnt in leaderboard_items:
-                team = get_user_team(uid)
-                if team == current_run_team:
-                    top_users_for_run.append(get_display_name(uid))
-                if len(top_users_for_run) >= 2:
-                    break
-
-        # finalize any still-active two-person runs as ending now and append to history (clear deque)
-        now_ts = time.time()
-        for ch, state in list(two_person_runs.items()):
-            if state.get("active"):
-                await finalize_two_person_run(ch, end_ts=now_ts, clear_deque=True, announce_in_commands=False)
-
-        # prepare two_person_runs flattened summary for storing in attempt record
-        two_runs_flat = []
-        for ch, runs in run_two_person_history_per_channel.items():
-            for rec in runs:
-                two_runs_flat.append({
-                    "channel": ch,
-                    "runners": rec["runners"],
-                    "start": rec["start"],
-                    "end": rec["end"],
-                    "duration": rec["duration"]
-                })
-
-        if current_run_team:
-            team_accuracy_history[current_run_team].append({
-                "correct": correct,
-                "incorrect": incorrect,
-                "accuracy": acc_value,
-                "best_1hour": best_1hour,
-                "best_1hour_start": best_start_seconds,
-                "top_users": top_users_for_run,
-                "two_person_runs": two_runs_flat
-            })
-
-        # persist data
-        save_data()
-
-        # compute longest two-person run across channels for this attempt
-        longest_duration = 0
-        longest_runners = None
-        longest_channel = None
-        for ch, runs in run_two_person_history_per_channel.items():
-            for rec in runs:
-                if rec["duration"] > longest_duration:
-                    longest_duration = rec["duration"]
-                    longest_runners = rec["runners"]
-                    longest_channel = ch
-
-        # determine participants for the best 1-hour window
-        best_participants_display = ""
-        if best_channel is not None and best_1hour > 0:
-            snaps = run_user_snapshots_per_channel.get(best_channel, {})
-            start_idx = best_start_index
-            end_idx = best_start_index + window_samples
-            deltas = []
-            for uid, lst in snaps.items():
-                if len(lst) > end_idx:
-                    delta = lst[end_idx] - lst[start_idx]
-                else:
-                    try:
-                        end_val = lst[end_idx] if end_idx < len(lst) else lst[-1]
-                        start_val = lst[start_idx] if start_idx < len(lst) else lst[0]
-                        delta = end_val - start_val
-                    except Exception:
-                        delta = 0
-                deltas.append((delta, uid))
-            deltas.sort(key=lambda x: -x[0])
-            top_uids = [uid for d, uid in deltas if d > 0][:2]
-            if top_uids:
-                best_participants_display = " & ".join(f"**{get_display_name(u)}**" for u in top_uids)
-            else:
-                best_participants_display = "N/A"
-        else:
-            best_participants_display = "N/A"
-
-    # prepare display
-    if total_attempts == 0:
-        accuracy_text = "N/A"
-    else:
-        accuracy_text = "100%" if acc_value == 100 else (format_accuracy_display(acc_value) if acc_value is not None else "N/A")
-
-    if not leaderboard_items:
-        leaderboard_text = "No numbers were counted."
-    else:
-        lines = []
-        for i, (uid, count) in enumerate(leaderboard_items, start=1):
-            name = get_display_name(uid)
-            lines.append(f"**#{i}** {name}, **{count:,}**")
-        leaderboard_text = "\n".join(lines)
-
-    # get best channel mention if possible
-    if best_channel is not None:
-        best_channel_mention = f"<#{best_channel}>"
-    else:
-        best_channel_mention = "N/A"
-
-    # longest run display
-    if longest_duration > 0 and longest_runners:
-        longest_duration_text = format_duration(longest_duration)
-        longest_participants = " & ".join(f"**{get_display_name(u)}**" for u in longest_runners)
-        longest_block = f"Longest run: **{longest_duration_text}**\nParticipants: {longest_participants}\n\n"
-    else:
-        longest_block = ""
-
-    attempt_number = len(team_accuracy_history[current_run_team]) if current_run_team in team_accuracy_history else 1
-
-    embed = discord.Embed(
-        title=f"**{current_run_team.upper() if current_run_team else 'NO TEAM'}'S ATTEMPT #{attempt_number} STATS:**",
-        description=(
-            f"Fastest 1-hour run: **{best_1hour:,}**\n"
-            f"Participants: {best_participants_display}\n\n"
-            f"{longest_block}"
-            f"Correct Rate: **{accuracy_text}**\n"
-            f"✅ **{correct:,}**\n"
-            f"❌ **{incorrect:,}**\n\n"
-            f"{leaderboard_text}"
-        ),
-        color=0xCCA958
-    )
-
-    message = await channel.send(embed=embed)
-    await message.pin()
-
-    # restore special role overwrites (remove/restore to previous state) before unlocking the locked roles
-    try:
-        guild = channel.guild if hasattr(channel, "guild") else None
-        if guild:
-            await restore_special_roles(guild)
-    except Exception:
-        pass
-
-    # unlock previously locked channels
-    try:
-        guild = channel.guild if hasattr(channel, "guild") else None
-        if guild:
-            await unlock_track_channels(guild)
-    except Exception:
-        pass
-
-    # clear run-only state
-    run_counts_by_user.clear()
-    run_team_mistakes.clear()
-    run_snapshots_per_channel.clear()
-    run_user_snapshots_per_channel.clear()
-    run_counts_by_channel.clear()
-    run_user_counts_by_channel.clear()
-    last_50_senders_per_channel.clear()
-    two_person_runs.clear()
-    run_two_person_history_per_channel.clear()
-    current_run_team = None
-
-    run_timer_task = None
-
-# -------- SLASH COMMANDS --------
-@bot.tree.command(name="run", description="Starts a run or shows current run status.")
-async def start_run(interaction: discord.Interaction):
-    global run_active, run_start_time, last_valid_user_id, current_run_team, run_timer_task, run_sampler_task
-
-    async with counts_lock:
-        if run_active:
-            elapsed = int(time.time() - run_start_time)
-
-            correct = sum(run_counts_by_user.values())
-            incorrect = sum(run_team_mistakes.values())
-            total_attempts = correct + incorrect
-
-            if total_attempts == 0:
-                accuracy_text = "N/A"
-            else:
-                acc_val = format_accuracy_value(correct, incorrect)
-                accuracy_text = "100%" if acc_val == 100 else (format_accuracy_display(acc_val) if acc_val is not None else "N/A")
-
-            items = sorted(
-                run_counts_by_user.items(),
-                key=lambda x: -x[1]
-            )
-
-            leaderboard = (
-                "\n".join(
-                    f"**#{i}** {get_display_name(uid)}, **{count:,}**"
-                    for i, (uid, count) in enumerate(items, start=1)
-                )
-                if items else
-                "No numbers counted yet."
-            )
-
-            embed = discord.Embed(
-                title="**CURRENT RUN STATUS**",
-                description=(
-                    f"Time: **{format_duration(elapsed)}**\n"
-                    f"Correct Rate: **{accuracy_text}**\n"
-                    f"✅ **{correct:,}**\n"
-                    f"❌ **{incorrect:,}**\n\n"
-                    f"{leaderboard}"
-                ),
-                color=0xCCA958
-            )
-
-            await interaction.response.send_message(embed=embed)
-            return
-
-        run_active = True
-        run_start_time = time.time()
-        last_valid_user_id = None
-        current_run_team = None
-        run_counts_by_user.clear()
-        run_team_mistakes.clear()
-        run_snapshots_per_channel.clear()
-        run_counts_by_channel.clear()
-        run_user_counts_by_channel.clear()
-        run_user_snapshots_per_channel.clear()
-        last_50_senders_per_channel.clear()
-        two_person_runs.clear()
-        run_two_person_history_per_channel.clear()
-
-    # lock tracked channels for the specified roles
-    try:
-        guild = interaction.guild
-        if guild:
-            await lock_track_channels(guild)
-            # enable send_messages for any special role the command user has,
-            # saving previous overwrites so we can restore them when the run ends
-            member = guild.get_member(interaction.user.id)
-            if member:
-                await enable_special_roles_for_member(guild, member)
-    except Exception:
-        pass
-
-    await interaction.response.send_message(
-        "24 hours attempt started! Stats are now being collected."
-    )
-
-    # start run timer and minute sampler and keep references so /end_run can cancel them
-    run_timer_task = bot.loop.create_task(run_timer(interaction.channel))
-    run_sampler_task = bot.loop.create_task(minute_sampler())
-
-@bot.tree.command(name="end_run", description="Ends the current run early. Choose to save the data or not.")
-async def end_run(interaction: discord.Interaction, save: bool = True):
-
-    global run_active, run_timer_task, run_sampler_task, current_run_team
-
-    async with counts_lock:
-        if not run_active:
-            await interaction.response.send_message("No active run to end.", ephemeral=True)
-            return
-
-        # cancel background tasks if present
-        if run_timer_task is not None and not run_timer_task.done():
-            run_timer_task.cancel()
-        if run_sampler_task is not None and not run_sampler_task.done():
-            run_sampler_task.cancel()
-
-        # Immediately perform the same finalization logic from run_timer
-        run_active = False
-
-        leaderboard_items = sorted(
-            run_counts_by_user.items(),
-            key=lambda x: -x[1]
-        )
-
-        mistakes_snapshot = dict(run_team_mistakes)
-        correct = sum(run_counts_by_user.values())
-        incorrect = sum(mistakes_snapshot.values())
-        total_attempts = correct + incorrect
-
-        # compute numeric accuracy value (percent)
-        acc_value = format_accuracy_value(correct, incorrect)
-
-        # compute best 1-hour sliding-window delta per channel using run_snapshots_per_channel
-        best_1hour = 0
-        best_channel = None
-        best_start_index = 0
-        window_samples = FASTEST_WINDOW_SECONDS // SAMPLE_INTERVAL_SECONDS
-        for ch, snapshots in run_snapshots_per_channel.items():
-            N = len(snapshots)
-            if N <= window_samples:
-                continue
-            for i in range(0, N - window_samples):
-                delta = snapshots[i + window_samples] - snapshots[i]
-                if delta > best_1hour:
-                    best_1hour = delta
-                    best_channel = ch
-                    best_start_index = i
-
-        best_start_seconds = best_start_index * SAMPLE_INTERVAL_SECONDS if best_channel is not None else 0
-
-        # determine top users for this run (up to 2) for storage
-        top_users_for_run = []
-        if leaderboard_items:
-            for uid, cnt in leaderboard_items:
-                team = get_user_team(uid)
-                if team == current_run_team:
-                    top_users_for_run.append(get_display_name(uid))
-                if len(top_users_for_run) >= 2:
-                    break
-
-        # finalize any still-active two-person runs as ending now and append to history
-        now_ts = time.time()
-        for ch, state in list(two_person_runs.items()):
-            if state.get("active"):
-                # use finalize helper -> clear_deque=True (because this is an official end)
-                await finalize_two_person_run(ch, end_ts=now_ts, clear_deque=True, announce_in_commands=True)
-
-        # prepare two_person_runs flattened summary for storing in attempt record
-        two_runs_flat = []
-        for ch, runs in run_two_person_history_per_channel.items():
-            for rec in runs:
-                two_runs_flat.append({
-                    "channel": ch,
-                    "runners": rec["runners"],
-                    "start": rec["start"],
-                    "end": rec["end"],
-                    "duration": rec["duration"]
-                })
-
-        if current_run_team and save:
-            team_accuracy_history[current_run_team].append({
-                "correct": correct,
-                "incorrect": incorrect,
-                "accuracy": acc_value,
-                "best_1hour": best_1hour,
-                "best_1hour_start": best_start_seconds,
-                "top_users": top_users_for_run,
-                "two_person_runs": two_runs_flat
-            })
-
-        if save:
-            save_data()
-
-        # compute longest two-person run across channels for this attempt
-        longest_duration = 0
-        longest_runners = None
-        longest_channel = None
-        for ch, runs in run_two_person_history_per_channel.items():
-            for rec in runs:
-                if rec["duration"] > longest_duration:
-                    longest_duration = rec["duration"]
-                    longest_runners = rec["runners"]
-                    longest_channel = ch
-
-        # determine participants for the best 1-hour window
-        best_participants_display = ""
-        if best_channel is not None and best_1hour > 0:
-            snaps = run_user_snapshots_per_channel.get(best_channel, {})
-            start_idx = best_start_index
-            end_idx = best_start_index + window_samples
-            deltas = []
-            for uid, lst in snaps.items():
-                if len(lst) > end_idx:
-                    delta = lst[end_idx] - lst[start_idx]
-                else:
-                    try:
-                        end_val = lst[end_idx] if end_idx < len(lst) else lst[-1]
-                        start_val = lst[start_idx] if start_idx < len(lst) else lst[0]
-                        delta = end_val - start_val
-                    except Exception:
-                        delta = 0
-                deltas.append((delta, uid))
-            deltas.sort(key=lambda x: -x[0])
-            top_uids = [uid for d, uid in deltas if d > 0][:2]
-            if top_uids:
-                best_participants_display = " & ".join(f"**{get_display_name(u)}**" for u in top_uids)
-            else:
-                best_participants_display = "N/A"
-        else:
-            best_participants_display = "N/A"
-
-    # prepare display (outside counts_lock)
-    if total_attempts == 0:
-        accuracy_text = "N/A"
-    else:
-        accuracy_text = "100%" if acc_value == 100 else (format_accuracy_display(acc_value) if acc_value is not None else "N/A")
-
-    if not leaderboard_items:
-        leaderboard_text = "No numbers were counted."
-    else:
-        lines = []
-        for i, (uid, count) in enumerate(leaderboard_items, start=1):
-            name = get_display_name(uid)
-            lines.append(f"**#{i}** {name}, **{count:,}**")
-        leaderboard_text = "\n".join(lines)
-
-    if best_channel is not None:
-        best_channel_mention = f"<#{best_channel}>"
-    else:
-        best_channel_mention = "N/A"
-
-    if longest_duration > 0 and longest_runners:
-        longest_duration_text = format_duration(longest_duration)
-        longest_participants = " & ".join(f"**{get_display_name(u)}**" for u in longest_runners)
-        longest_block = f"Longest run: **{longest_duration_text}**\nParticipants: {longest_participants}\n\n"
-    else:
-        longest_block = ""
-
-    attempt_number = len(team_accuracy_history[current_run_team]) if current_run_team in team_accuracy_history else 1
-
-    embed = discord.Embed(
-        title=f"**{current_run_team.upper() if current_run_team else 'NO TEAM'}'S ATTEMPT #{attempt_number} STATS:**",
-        description=(
-            f"Fastest 1-hour run: **{best_1hour:,}**\n"
-            f"Participants: {best_participants_display}\n\n"
-            f"{longest_block}"
-            f"Correct Rate: **{accuracy_text}**\n"
-            f"✅ **{correct:,}**\n"
-            f"❌ **{incorrect:,}**\n\n"
-            f"{leaderboard_text}"
-        ),
-        color=0xCCA958
-    )
-
-    await interaction.response.send_message(embed=embed)
-
-    # restore special role overwrites (remove/restore to previous state) before unlocking the locked roles
-    try:
-        guild = interaction.guild
-        if guild:
-            await restore_special_roles(guild)
-    except Exception:
-        pass
-
-    # unlock previously locked channels
-    try:
-        guild = interaction.guild
-        if guild:
-            await unlock_track_channels(guild)
-    except Exception:
-        pass
-
-    # clear run-only state
-    async with counts_lock:
-        run_counts_by_user.clear()
-        run_team_mistakes.clear()
-        run_snapshots_per_channel.clear()
-        run_user_snapshots_per_channel.clear()
-        run_counts_by_channel.clear()
-        run_user_counts_by_channel.clear()
-        last_50_senders_per_channel.clear()
-        two_person_runs.clear()
-        run_two_person_history_per_channel.clear()
-        current_run_team = None
-        run_timer_task = None
-        run_sampler_task = None
-
-@bot.tree.command(name="top_users", description="Shows total numbers counted by each user and which team they belong to.")
-async def leaderboard_users(interaction: discord.Interaction):
-    async with counts_lock:
-        items = sorted(
-            total_counts_by_user.items(),
-            key=lambda x: -x[1]
-        )
-
-    if not items:
-        await interaction.response.send_message(
-            "No data available yet.",
-            ephemeral=False
-        )
-        return
-
-    lines = []
-    for i, (uid, count) in enumerate(items, start=1):
-        name = get_display_name(uid)
-        team = get_user_team(uid)
-        if team:
-            lines.append(f"**#{i}** {name} - {team}, **{count:,}**")
-        else:
-            lines.append(f"**#{i}** {name}, **{count:,}**")
-
-    embed = discord.Embed(
-        title="**USERS LEADERBOAD**",
-        description="\n".join(lines),
-        color=0xCCA958
-    )
-
-    await interaction.response.send_message(embed=embed)
-
-@bot.tree.command(name="leaderboard_accuracy", description="Shows accuracy leaderboard for all team attempts.")
-async def leaderboard_accuracy(interaction: discord.Interaction):
-    entries = []
-    async with counts_lock:
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                acc = run.get("accuracy")
-                if acc is None:
-                    continue
-                entries.append((team, idx, float(acc)))
-
-    if not entries:
-        await interaction.response.send_message("No accuracy data available yet.")
-        return
-
-    entries.sort(key=lambda x: -x[2])
-
-    lines = []
-    for rank, (team, attempt, value) in enumerate(entries, start=1):
-        if value == 100:
-            acc_text = "100%"
-        else:
-            acc_text = f"{value:06.3f}%"
-        lines.append(f"**#{rank}** {team} ({attempt}) - **{acc_text}**")
-
-    embed = discord.Embed(
-        title="**ACCURACY LEADERBOARD**",
-        description="\n".join(lines),
-        color=0xCCA958
-    )
-
-    await interaction.response.send_message(embed=embed)
-
-@bot.tree.command(name="leaderboard_numbers", description="Shows numbers counted per team attempt.")
-async def leaderboard_numbers(interaction: discord.Interaction):
-    entries = []
-    async with counts_lock:
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                count = int(run.get("correct", 0))
-                entries.append((team, idx, count))
-
-    if not entries:
-        await interaction.response.send_message("No run data available yet.")
-        return
-
-    entries.sort(key=lambda x: -x[2])
-
-    lines = []
-    for rank, (team, attempt, count) in enumerate(entries, start=1):
-        lines.append(f"**#{rank}** {team} ({attempt}) - **{count:,}**")
-
-    embed = discord.Embed(
-        title="**NUMBERS LEADERBOARD**",
-        description="\n".join(lines),
-        color=0xCCA958
-    )
-
-    await interaction.response.send_message(embed=embed)
-
-@bot.tree.command(name="leaderboard_fastest", description="Shows fastest 1-hour runs with top users and team.")
-async def leaderboard_fastest(interaction: discord.Interaction):
-    entries = []
-    async with counts_lock:
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                best = int(run.get("best_1hour", 0))
-                if best <= 0:
-                    continue
-                top_users = run.get("top_users", []) or []
-                entries.append((team, idx, best, top_users))
-
-    if not entries:
-        await interaction.response.send_message("No fastest-run data available yet.")
-        return
-
-    entries.sort(key=lambda x: -x[2])
-
-    lines = []
-    for rank, (team, attempt, best, top_users) in enumerate(entries, start=1):
-        if top_users:
-            display_users = " & ".join(top_users[:2])
-            lines.append(f"**#{rank}** {display_users} - {team}, **{best:,}**")
-        else:
-            lines.append(f"**#{rank}** {team}, **{best:,}**")
-
-    embed = discord.Embed(
-        title="**FASTEST RUN LEADERBOARD**",
-        description="\n".join(lines),
-        color=0xCCA958
-    )
-
-    await interaction.response.send_message(embed=embed)
-
-@bot.tree.command(name="leaderboard_longest", description="Shows longest two-person runs (best per attempt).")
-async def leaderboard_longest(interaction: discord.Interaction):
-
-    entries = []
-    async with counts_lock:
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                two_runs = run.get("two_person_runs", []) or []
-                if not two_runs:
-                    continue
-                # pick the single longest two-person run inside this attempt
-                max_rec = max(two_runs, key=lambda r: int(r.get("duration", 0) or 0))
-                dur = int(max_rec.get("duration", 0) or 0)
-                runners = max_rec.get("runners", ())
-                names = [get_display_name(u) for u in runners]
-                runners_display = " & ".join(names[:2]) if names else "N/A"
-                entries.append((dur, team, idx, runners_display))
-
-    if not entries:
-        await interaction.response.send_message("No two-person run data available yet.")
-        return
-
-    entries.sort(key=lambda x: -x[0])
-
-    lines = []
-    for rank, (dur, team, attempt_idx, runners_display) in enumerate(entries, start=1):
-        dur_text = format_duration_hours_minutes(dur)
-        lines.append(f"**#{rank}** {runners_display} - {team}, **{dur_text}** hours")
-
-    embed = discord.Embed(
-        title="**LONGEST RUN LEADERBOARD**",
-        description="\n".join(lines),
-        color=0xCCA958
-    )
-
-    await interaction.response.send_message(embed=embed)
-
-# -------- NEW: /points command --------
-@bot.tree.command(name="points", description="Shows points leaderboard from current winners of categories.")
-async def points_command(interaction: discord.Interaction):
-
-    # compute winners for each category
-    fastest_winner = None
-    numbers_winner = None
-    accuracy_winner = None
-    longest_winner = None
-
-    async with counts_lock:
-        # Fastest Run winner: highest best_1hour across all team attempts
-        fastest_entries = []
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                best = int(run.get("best_1hour", 0) or 0)
-                if best > 0:
-                    fastest_entries.append((best, team, idx))
-        if fastest_entries:
-            fastest_entries.sort(key=lambda x: -x[0])
-            fastest_winner = fastest_entries[0][1]
-
-        # Numbers Counted winner: highest correct count across attempts
-        numbers_entries = []
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                correct = int(run.get("correct", 0) or 0)
-                if correct > 0:
-                    numbers_entries.append((correct, team, idx))
-        if numbers_entries:
-            numbers_entries.sort(key=lambda x: -x[0])
-            numbers_winner = numbers_entries[0][1]
-
-        # Accuracy winner: highest accuracy percent across attempts
-        accuracy_entries = []
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                acc = run.get("accuracy")
-                if acc is None:
-                    continue
-                accuracy_entries.append((float(acc), team, idx))
-        if accuracy_entries:
-            accuracy_entries.sort(key=lambda x: -x[0])
-            accuracy_winner = accuracy_entries[0][1]
-
-        # Longest Run winner: highest duration from two_person_runs across attempts (best per attempt already handled by leaderboard_longest)
-        longest_entries = []
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                two_runs = run.get("two_person_runs", []) or []
-                if not two_runs:
-                    continue
-                max_rec = max(two_runs, key=lambda r: int(r.get("duration", 0) or 0))
-                dur = int(max_rec.get("duration", 0) or 0)
-                if dur > 0:
-                    longest_entries.append((dur, team, idx))
-        if longest_entries:
-            longest_entries.sort(key=lambda x: -x[0])
-            longest_winner = longest_entries[0][1]
-
-    # tally points
-    points = defaultdict(int)
-    winning_categories = defaultdict(list)
-
-    if fastest_winner:
-        points[fastest_winner] += 1
-        winning_categories[fastest_winner].append("Fastest Run")
-    if numbers_winner:
-        points[numbers_winner] += 2  # Numbers Counted worth 2 points
-        winning_categories[numbers_winner].append("Numbers Counted")
-    if accuracy_winner:
-        points[accuracy_winner] += 1
-        winning_categories[accuracy_winner].append("Accuracy")
-    if longest_winner:
-        points[longest_winner] += 1
-        winning_categories[longest_winner].append("Longest Run")
-
-    if not points:
-        await interaction.response.send_message("No winners available yet to calculate points.")
-        return
-
-    # build sorted leaderboard by points desc, then team name
-    leaderboard = sorted(points.items(), key=lambda x: (-x[1], x[0]))
-
-    lines = []
-    for i, (team, pts) in enumerate(leaderboard, start=1):
-        cats = ", ".join(winning_categories.get(team, []))
-        if cats:
-            lines.append(f"**#{i}** {team} - {cats}, **{pts}**")
-        else:
-            lines.append(f"**#{i}** {team}, **{pts}**")
-
-    embed = discord.Embed(
-        title="**POINTS LEADERBOARD**",
-        description="\n".join(lines),
-        color=0xCCA958
-    )
-
-    await interaction.response.send_message(embed=embed)
-
-# -------- NEW: /all_runs command --------
-@bot.tree.command(name="all_runs", description="Shows summary of all attempts so far.")
-async def all_runs(interaction: discord.Interaction):
-
-    entries = []
-    async with counts_lock:
-        # iterate teams in insertion order and their attempts in stored order
-        for team, runs in team_accuracy_history.items():
-            for idx, run in enumerate(runs, start=1):
-                correct = int(run.get("correct", 0) or 0)
-                acc = run.get("accuracy")
-                if acc is None:
-                    acc_text = "N/A"
-                else:
-                    acc_text = "100%" if acc == 100 else f"{float(acc):06.3f}%"
-                # longest run (max duration in two_person_runs)
-                two_runs = run.get("two_person_runs", []) or []
-                longest_secs = 0
-                for rec in two_runs:
-                    dur = int(rec.get("duration", 0) or 0)
-                    if dur > longest_secs:
-                        longest_secs = dur
-                longest_text = format_duration(longest_secs) if longest_secs > 0 else "N/A"
-                best_1hour = int(run.get("best_1hour", 0) or 0)
-                entries.append({
-                    "team": team,
-                    "attempt": idx,
-                    "correct": correct,
-                    "accuracy": acc_text,
-                    "longest": longest_text,
-                    "fastest": best_1hour
-                })
-
-    if not entries:
-        await interaction.response.send_message("No saved attempts available yet.")
-        return
-
-    # build the message string
-    blocks = []
-    for e in entries:
-        team_label = e["team"].upper()
-        blocks.append(f"**{team_label}** ({e['attempt']})")
-        blocks.append(f"Numbers Counted: **{e['correct']:,}**")
-        blocks.append(f"Accuracy **{e['accuracy']}**")
-        blocks.append(f"Longest Run: **{e['longest']}**")
-        blocks.append(f"Fastest Run: **{e['fastest']:,}**")
-        blocks.append("")  # blank line between attempts
-
-    desc = "\n".join(blocks).strip()
-
-    embed = discord.Embed(
-        title="**ALL RUNS**",
-        description=desc,
-        color=0xCCA958
-    )
-
-    await interaction.response.send_message(embed=embed)
-
-@bot.tree.command(name="show_data", description="Shows raw stored data.")
-async def show_data(interaction: discord.Interaction):
-    if interaction.user.id != 749049630775312524:
-        await interaction.response.send_message(
-            "You are not allowed to use this command silly :p",
-            ephemeral=True
-        )
-        return
-
-    async with counts_lock:
-        data_snapshot = {
-            "total_counts_by_user": dict(total_counts_by_user),
-            "team_accuracy_history": dict(team_accuracy_history),
-        }
-
-    pretty = json.dumps(data_snapshot, indent=2)
-
-    # send as a file to avoid message length limits
-    bio = io.BytesIO(pretty.encode("utf-8"))
-    bio.seek(0)
-    await interaction.response.send_message(
-        file=discord.File(fp=bio, filename="run_data.json"),
-        ephemeral=True
-    )
-
-# -------- READY --------
-@bot.event
-async def on_ready():
-    load_data()
-    bot.loop.create_task(autosave_loop())
-    await bot.tree.sync()
-    print(f"Logged in as {bot.user} (ID: {bot.user.id}")
-    print(f"Data file: {DATA_FILE}")
-
-# -------- RUN --------
-bot.run(TOKEN, log_handler=handler)
+import discord
+from discord.ext import commands
+from discord import app_commands
+import logging
+from dotenv import load_dotenv
+import os
+import asyncio
+import json
+import time
+import threading
+from collections import defaultdict
+import io
+import csv
+import gzip
+import tempfile
+from typing import Literal, Optional
+
+from engine import (
+    CountingEngine,
+    summarize_run,
+    message_event,
+    format_accuracy_value,
+    RUN_ANALYSIS_WINDOW_HOURS,
+    SAMPLE_INTERVAL_SECONDS,
+)
+from clock import Clock
+from storage import JsonStorage, SqliteStorage, write_json_atomic
+import metrics
+from profiling import StallWatchdog, SamplingProfiler
+
+# -------- ENV --------
+load_dotenv()
+TOKEN = os.getenv("DISCORD_TOKEN")
+# local Prometheus endpoint (http://METRICS_HOST:METRICS_PORT/metrics), off unless a port is set
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# -------- LOGGING --------
+handler = logging.FileHandler(filename="discord.log", encoding="utf-8", mode="w")
+logger = logging.getLogger("counting")
+
+# -------- INTENTS --------
+intents = discord.Intents.default()
+intents.message_content = True
+intents.members = True
+
+# -------- BOT --------
+bot = commands.Bot(command_prefix=None, intents=intents)
+
+# -------- CHANNELS --------
+TRACK_CHANNELS = {
+    1315525836341907560, # classic coliseum
+    1315492435115114517  # contando coliseum
+}
+
+COMMANDS_CHANNEL_ID = 1315525419813834783
+
+# roles to lock/unlock
+LOCK_ROLE_IDS = {
+    1315670624898650152,
+    1315670215006359602
+}
+
+# special runner roles - if the run starter has one of these, enable Send Messages for that role during the run
+SPECIAL_ROLES = {
+    1468272749142212718,
+    1468272788874989653,
+    1468272811859640524,
+    1468272842327195805
+}
+
+# store original overwrites when modifying special roles during run
+run_original_overwrites = defaultdict(dict)
+run_enabled_special_roles = set()
+
+# -------- CONSTANTS --------
+MISTAKE_BOT_CHANNEL_ID = 510016054391734273
+MISTAKE_BOT_RUINED_ID = 639599059036012605
+
+# the only user allowed to run the admin commands (/show_data, /profile)
+ADMIN_USER_ID = 749049630775312524
+
+# check every number against the channel's expected next number as it arrives, instead of
+# waiting for the mistake bots (which then only resync the channel); see CountingEngine
+SEQUENCE_VALIDATION = True
+DOUBLE_POST = "allow"          # same user counting twice in a row: "allow", "mistake" or "ignore"
+SEQUENCE_RESET = "resync"      # after a wrong number: "resync" on the next number, or "restart" at 1
+
+# two-person run thresholds, window lengths and sampling resolution live in engine.py
+
+# per-channel run detection overrides: ch_id -> (window size, number of people).
+# e.g. (20, 1) detects solo runs, (60, 3) three-person runs
+RUN_DETECTION_BY_CHANNEL = {}
+
+# -------- TEAMS --------
+teams = {
+    "Space Walkers": [1189250809020555344, 904224456677945364, 577666133549645834, 497517322206969856, 832596613922684968,
+             495708539462090762, 665011985121017894, 514078286146699265, 1063269856251740180, 520341628049686538,
+             1221444926819270763, 762417923574726667, 1156662987357171854, 885123109630406706, 1274417682975952948
+    ],
+    "Hopes and Dreams": [903692413300793434, 586031901207166976, 992014751381065791, 770794762780409856, 1275494343293272166,
+             713936728481857637, 1198658950082609299, 130452258864234496, 875155347541721100, 1136159374511968438,
+             890989360701386754, 91628137384808448, 572231874525659189, 1200505072493285544, 817022469004984340
+    ],
+    "ⅩⅩⅡ": [485412155596996628, 1327841688147984558, 593889062377488435, 1267712959589912598, 855351859039174677,
+             668223790500544512, 456613134682030081, 1146434565179723899, 953238846852702238, 1137835454671097906,
+             249881368945885184, 641706102312140800, 484484139349835781, 392459609283100672, 735957682913017866
+    ],
+    "Chicago Stix": [895534695729725500, 709650885487099985, 749049630775312524, 1178268672373030975,784701362536448001,
+                     886617454867013642, 547612876530122763, 309840548695638026, 747859758354137128, 848670503182794763,
+                     1290390298958233720, 655855955304644629, 815837012648919050, 1403694438143889498, 154721499159199744
+    ]
+}
+
+user_team_mapping = {
+    user_id: team
+    for team, users in teams.items()
+    for user_id in users
+}
+
+
+# -------- NICKNAMES --------
+user_nicknames = {
+    749049630775312524:  "nicks",    497517322206969856:  "isa",    709650885487099985:  "gab",    665011985121017894:  "nicoel",
+    992014751381065791:  "khyma",    1327841688147984558: "thiran", 762417923574726667:  "logan",  1189250809020555344: "dark",
+    91628137384808448:   "A*",       1136159374511968438: "ama",    1267712959589912598: "arya",   875155347541721100:  "axo",
+    593889062377488435:  "azure",    855351859039174677:  "bertl",  1200505072493285544: "claret", 1290390298958233720: "cobrakai",
+    848670503182794763:  "deepblue", 514078286146699265:  "digi",   1275494343293272166: "dodge",  641706102312140800:  "ec",
+    903692413300793434:  "hope",     747859758354137128:  "iron",   713936728481857637:  "jake",   1063269856251740180: "james",
+    1156662987357171854: "jdubs",    586031901207166976:  "kailee", 890989360701386754:  "korl",   770794762780409856:  "leaw",
+    249881368945885184:  "leti",     1137835454671097906: "lost",   832596613922684968:  "maddie", 1146434565179723899: "lite",
+    495708539462090762:  "marcin",   885123109630406706:  "milk",   904224456677945364:  "nai",    547612876530122763:  "nap",
+    1403694438143889498: "nssleo",   1221444926819270763: "sonic",  895534695729725500: "stick",   577666133549645834:  "onyan",
+    735957682913017866:  "onyx",     668223790500544512:  "pia",    485412155596996628:  "quv",    154721499159199744:  "raydop",
+    572231874525659189:  "rreae",    456613134682030081:  "sall",   953238846852702238:  "salt",   392459609283100672:  "saud",
+    130452258864234496:  "scan",     817022469004984340:  "schpark", 484484139349835781:  "skilo", 784701362536448001: "shelley", 
+    815837012648919050:  "super",    520341628049686538: "trashcore", 886617454867013642: "zgames", 655855955304644629: "robby",
+    309840548695638026:  "w0rd",     1198658950082609299:"storydreamer", 1178268672373030975:"willy", 1274417682975952948:"bruce"
+}
+
+# -------- ALTS --------
+alt_to_main = {
+    # ALT_ID: MAIN_ID,
+    866803634964529162: 749049630775312524,  # nicks
+    984550127400259695: 709650885487099985,  # gab
+    892551131488743434: 497517322206969856,  # isa
+    1260746158553305222: 497517322206969856, # isa2
+    1207827979451768862: 665011985121017894, # nicoel
+    
+    1176872999287279710: 992014751381065791, # "khyma"
+    1250914738603557016: 992014751381065791, # "khyma2"
+    1347500051441909760: 1327841688147984558,# "thiran"
+    1: 762417923574726667, # "logan"
+    1189255952797536339: 1189250809020555344,# "dark"
+    0: 91628137384808448,  # "A*"
+    305414646972809216: 1136159374511968438, # "ama"
+    1414033725045473281: 1267712959589912598,# "arya"
+    1469199696135454831: 1267712959589912598,# "arya"
+    1079617884633968720: 875155347541721100, # "axo"
+    1024919799630929930: 875155347541721100, # "axo2"
+    1248216922760151075: 593889062377488435, # "azure"
+    1154761242611814431: 593889062377488435, # "azure2"
+    1222912258594705519: 855351859039174677, # "bertl"
+    0: 1200505072493285544,# "claret"
+    1293661110066483323: 1290390298958233720,# "cobrakai"
+    1153637098751004722: 848670503182794763, # "deepblue"
+    1: 514078286146699265, # "digi"
+    1370859001469993052: 1275494343293272166,# "dodge"
+    1472092376867668133: 1275494343293272166,# "dodge2"
+    0: 177013970895503360, # "duck"
+    1214592526510456872: 903692413300793434, # "hope"
+    1273859055147945994: 903692413300793434, # "hope2"
+    1082448603789922386: 747859758354137128, # "iron"
+    955603875421904966: 713936728481857637,  # "jake"
+    1310698295642820608: 1063269856251740180,# "james"
+    1348389360122466347: 1156662987357171854,# "jdubs"
+    419233067312611329: 586031901207166976,  # "kailee"
+    936197474115276810: 890989360701386754,  # "korl"
+    1329622073978388532: 770794762780409856, # "leaw"
+    1298027245478350942: 249881368945885184, # "leti"
+    1201311902085685338: 1137835454671097906,# "lost"
+    0: 832596613922684968, # "maddie"
+    0: 1146434565179723899,# "lite"
+    898089548905578506: 495708539462090762,  # "marcin"
+    915622952257601596: 885123109630406706,  # "milk"
+    1247146814281613408: 904224456677945364, # "nai"
+    343209930590912525: 904224456677945364, # "nai2"
+    0: 547612876530122763, # "nap"
+    0: 1403694438143889498,# "nssleo"
+    1: 1221444926819270763,# "sonic"
+    452322112707756032: 895534695729725500,  # "stick"
+    627998970320388106: 577666133549645834,  # "onyan"
+    1305061438959779871: 735957682913017866, # "onyx"
+    0: 668223790500544512, # "pia"
+    1051529942107689020: 485412155596996628,  # "quv2"
+    592670631854735361: 485412155596996628,  # "quv"
+    1345019952310259732: 154721499159199744, # "raydop"
+    1472743353404883040: 572231874525659189, # "rreae"
+    0: 456613134682030081, # "sall"
+    1223120985109041194: 953238846852702238, # "salt"
+    1225374339961065503: 953238846852702238,  # salt2
+    1239981964153327734: 392459609283100672, # "saud"
+    0: 130452258864234496, # "scan"
+    1420868900295413790: 817022469004984340, # "schpark"
+    0: 784701362536448001, # "shelley"
+    1374386220259610746: 484484139349835781, # "skilo"
+    1: 815837012648919050, # "super"
+    964996735908843520: 520341628049686538,  # "trashcore"
+    1146121542560927905: 886617454867013642, # "zgames"
+    1141392363319722075: 886617454867013642, # "zgames2"
+    1336180081500094536: 655855955304644629, # "kazuma"
+    0: 309840548695638026, # "w0rd"
+    0: 1198658950082609299,# "storydreamer"
+    1065819724082065489: 1178268672373030975,# "willy"
+    1348101708974391357: 1274417682975952948,# "bruce"
+    1354797552511225926: 641706102312140800  # ec
+}
+
+# -------- STORAGE --------
+DATA_DIR = "/data" if os.getenv("RAILWAY_ENVIRONMENT") else "."
+DATA_FILE = os.path.join(DATA_DIR, "run_data.json")
+DATA_DB = os.path.join(DATA_DIR, "run_data.db")
+# "json" rewrites DATA_FILE on every save; "sqlite" keeps DATA_DB (WAL) and imports an
+# existing DATA_FILE into it once on first start
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+JOURNAL_FILE = os.path.join(DATA_DIR, "run_journal.ndjson")
+CHECKPOINT_FILE = os.path.join(DATA_DIR, "run_checkpoint.json")
+
+JOURNAL_FLUSH_INTERVAL = 1.0       # seconds between journal write + fsync batches
+JOURNAL_FLUSH_MAX_RECORDS = 500    # flush early once this many records are buffered
+# seconds between checkpoints; a restart replays the journal tail written after the last one
+CHECKPOINT_INTERVAL = 300
+
+# -------- RUN JOURNAL --------
+# append-only NDJSON log of the current run: one record per line,
+# { "seq": int, "ts": float, "kind": "start" | "count" | "mistake" | "wrong", ...fields }.
+# records are buffered in memory by append() and written + fsynced in batches by
+# journal_flush_loop in a worker thread; restore_run rebuilds the run from it.
+class RunJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self.seq = 0
+        self.generation = 0          # bumped by reset/discard so stale batches are dropped
+        self.synced_offset = 0       # bytes of the file written + fsynced so far
+        self.pending_full = asyncio.Event()
+        self._buffer = []
+        self._truncate = False
+        self._io_lock = threading.Lock()
+
+    def append(self, kind: str, ts: float, **fields) -> int:
+        self.seq += 1
+        rec = {"seq": self.seq, "ts": ts, "kind": kind}
+        rec.update(fields)
+        self._buffer.append(json.dumps(rec, separators=(",", ":")) + "\n")
+        if len(self._buffer) >= JOURNAL_FLUSH_MAX_RECORDS:
+            self.pending_full.set()
+        return self.seq
+
+    def reset(self):
+        # start a new run: the next batch truncates the file
+        self.generation += 1
+        self.seq = 0
+        self.synced_offset = 0
+        self._buffer = []
+        self._truncate = True
+
+    def discard(self):
+        # the run is over: drop buffered records and remove the file
+        self.generation += 1
+        self.seq = 0
+        self.synced_offset = 0
+        self._buffer = []
+        self._truncate = False
+        with self._io_lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def pending(self) -> int:
+        # records buffered but not written yet
+        return len(self._buffer)
+
+    def take_pending(self):
+        batch = (self.generation, self._truncate, self._buffer)
+        self._buffer = []
+        self._truncate = False
+        return batch
+
+    def write(self, generation: int, truncate: bool, lines: list):
+        # runs in a worker thread
+        if not lines and not truncate:
+            return
+        with self._io_lock:
+            if generation != self.generation:
+                return
+            with open(self.path, "w" if truncate else "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+                # records are plain ASCII json, so characters == bytes
+                self.synced_offset = (0 if truncate else self.synced_offset) + sum(map(len, lines))
+
+    def read_first(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.loads(f.readline())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def read(self, offset: int = 0):
+        # records from byte offset (a record boundary) to the end of the file, and the
+        # offset just past the last complete record
+        records = []
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return records, 0
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # torn last line from a crash mid-write
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                offset += len(line)
+        return records, offset
+
+    def truncate(self, offset: int):
+        # cut a torn tail off so records appended after a restart start on a fresh line
+        with self._io_lock:
+            try:
+                with open(self.path, "r+b") as f:
+                    if os.fstat(f.fileno()).st_size > offset:
+                        f.truncate(offset)
+                        f.flush()
+                        os.fsync(f.fileno())
+            except FileNotFoundError:
+                pass
+            self.synced_offset = offset
+
+# -------- METRICS --------
+# always collected (see metrics.py); served only when METRICS_PORT is set.
+# run-state sizes are read at scrape time by the gauges registered below STATE
+registry = metrics.Registry()
+counts_metric = registry.counter("counting_counts_total", "Counts accepted, per channel.", ("channel",))
+mistakes_metric = registry.counter("counting_mistakes_total", "Mistakes charged, per channel and kind.", ("channel", "kind"))
+message_latency = registry.histogram("counting_on_message_seconds", "on_message time for relevant messages, lock wait included.")
+lock_wait = registry.histogram("counting_lock_wait_seconds", "Time spent waiting for counts_lock.")
+lock_hold = registry.histogram("counting_lock_hold_seconds", "Time counts_lock was held.")
+sampler_drift = registry.histogram("counting_sampler_drift_seconds", "Delay of sampler ticks past their scheduled time.")
+save_seconds = registry.histogram("counting_save_seconds", "Time to write a save, per target.", ("target",))
+save_snapshot_seconds = registry.histogram("counting_save_snapshot_seconds", "Time counts_lock was held to snapshot data for a save.")
+saves_skipped = registry.counter("counting_saves_skipped_total", "Saves skipped because nothing changed since the last one.")
+save_size = registry.gauge("counting_save_size", "Size of the last save (bytes; rows for the sqlite backend).", ("target",))
+send_seconds = registry.histogram("counting_send_seconds", "Outbox channel.send latency.")
+send_failures = registry.counter("counting_send_failures_total", "Outbox messages dropped after failed sends.")
+
+# -------- STALL WATCHDOG / PROFILER --------
+STALL_THRESHOLD_SECONDS = 0.25    # event-loop stalls longer than this are logged with the blocking stack
+PROFILE_MAX_SECONDS = 60          # longest /profile session
+PROFILE_HZ = 200                  # /profile samples per second
+
+loop_stalls = registry.histogram(
+    "counting_loop_stall_seconds", "Event loop stalls over STALL_THRESHOLD_SECONDS.",
+    buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+def _log_stall(seconds: float, stack: str):
+    loop_stalls.observe(seconds)
+    logger.warning("event loop stalled for %.0f ms in:\n%s", seconds * 1000, stack)
+
+stall_watchdog = StallWatchdog(STALL_THRESHOLD_SECONDS, on_stall=_log_stall)
+profile_running = False
+
+# -------- STATE --------
+# the counting state (totals, attempt history and the current run, see engine.RunState)
+# lives in the engine; this module adapts Discord events to it and persists what it returns
+engine = CountingEngine(
+    TRACK_CHANNELS,
+    team_of=user_team_mapping.get,
+    main_user_of=lambda uid: alt_to_main.get(uid, uid),
+    display_name=lambda uid: get_display_name(uid),
+    mistake_bot_channel_id=MISTAKE_BOT_CHANNEL_ID,
+    mistake_bot_ruined_id=MISTAKE_BOT_RUINED_ID,
+    sequence_validation=SEQUENCE_VALIDATION,
+    double_post=DOUBLE_POST,
+    sequence_reset=SEQUENCE_RESET,
+    detection_by_channel=RUN_DETECTION_BY_CHANNEL,
+    # wake inactivity_watcher when an earlier deadline is scheduled
+    on_deadline=lambda when: inactivity_wake.set(),
+)
+
+# time source of the run timer, sampler, inactivity deadlines and autosave; tests and
+# benchmarks swap in a clock.VirtualClock to simulate a whole attempt
+clock = Clock()
+
+# background task references (so /end_run can cancel them)
+run_timer_task = None
+run_sampler_task = None
+run_status_task = None
+# id of the current run's pinned status message; checkpointed so a restart edits the same one
+status_message_id = None
+# run start permission changes, applied after /run has answered; the run end ones wait for it
+run_permissions_task = None
+# set from the moment a run is detached until its permissions are restored; /run refuses to
+# start the next run meanwhile, so the old run's restore can't undo the new run's changes
+run_end_pending = False
+
+counts_lock = metrics.TimedLock(lock_wait, lock_hold)
+
+run_journal = RunJournal(JOURNAL_FILE)
+storage = None    # JsonStorage or SqliteStorage, opened in on_ready (see open_storage)
+metrics_server = None
+# journal position covered by the last saved total_counts_by_user: { "run_start", "seq", "finished" }
+saved_journal_marker = None
+startup_done = False
+
+# engine.data_version is bumped on every change to persisted data (totals, attempt history);
+# saves are skipped while saved_data_version is current
+saved_data_version = 0
+checkpoint_saved_seq = None
+checkpoint_saved_at = 0.0
+
+# serializes the worker-thread writers and keeps stale snapshots from overwriting newer files
+data_io_lock = threading.Lock()
+checkpoint_io_lock = threading.Lock()
+written_data_version = -1
+
+SAVE_STALL_WARN_MS = 50    # log a warning when snapshotting under counts_lock takes longer
+def _run_sizes():
+    run = engine.run
+    if run is None:
+        return {}
+    return {
+        ("counts",): sum(run.counts_by_channel.values()),
+        ("ticks",): run.tick_count(),
+        ("two_person_active",): sum(1 for state in run.two_person_runs.values() if state.get("active")),
+        ("inactivity_deadlines",): len(run.inactivity_heap),
+    }
+
+registry.gauge("counting_run_active", "1 while a run is in progress.", fn=lambda: int(engine.run is not None))
+registry.gauge("counting_run_size", "Sizes of the current run's state.", ("item",), fn=_run_sizes)
+registry.gauge("counting_journal_pending", "Journal records not written yet.", fn=lambda: run_journal.pending)
+registry.gauge("counting_outbox_queued", "Announcements waiting to be sent.", fn=lambda: announcements.queue.qsize())
+registry.gauge("counting_name_cache_size", "Display names cached.", fn=lambda: len(display_names.names))
+
+# -------- LOAD / SAVE --------
+def open_storage():
+    if STORAGE_BACKEND == "sqlite":
+        db = SqliteStorage(DATA_DB)
+        if db.migrate_from_json(DATA_FILE):
+            logger.info("migrated %s into %s", DATA_FILE, DATA_DB)
+        return db
+    return JsonStorage(DATA_FILE)
+
+def load_data():
+    data = storage.load()
+    if data is None:
+        return
+
+    engine.load(data)
+
+    global saved_journal_marker
+    saved_journal_marker = data.get("journal")
+
+
+def snapshot_data(*, force: bool = False, finished_run_start: float = None):
+    # cheap copy of everything save_data persists, taken with counts_lock held.
+    # finished_run_start marks the save that finalizes the run started at that time.
+    # returns None if nothing changed since the last save
+    if not force and engine.data_version == saved_data_version:
+        saves_skipped.inc()
+        return None
+    t0 = time.perf_counter()
+    journal_marker = None
+    if engine.run is not None:
+        journal_marker = {"run_start": engine.run.start_time, "seq": run_journal.seq, "finished": False}
+    elif finished_run_start is not None:
+        journal_marker = {"run_start": finished_run_start, "seq": run_journal.seq, "finished": True}
+    payload = engine.snapshot_data()
+    payload["journal"] = journal_marker
+    stall_ms = (time.perf_counter() - t0) * 1000
+    save_snapshot_seconds.observe(stall_ms / 1000)
+    if stall_ms > SAVE_STALL_WARN_MS:
+        logger.warning("save_data snapshot held counts_lock for %.1f ms", stall_ms)
+    return engine.data_version, payload
+
+def _write_data_file(version: int, payload: dict) -> int:
+    # runs in a worker thread
+    global written_data_version
+    with data_io_lock:
+        if version < written_data_version:
+            return 0
+        size = storage.save(payload)
+        written_data_version = version
+        return size
+
+async def save_data(snapshot):
+    # writes a snapshot_data() result to storage off the event loop
+    global saved_data_version
+    if snapshot is None:
+        return
+    version, payload = snapshot
+    t0 = time.perf_counter()
+    size = await asyncio.to_thread(_write_data_file, version, payload)
+    write_ms = (time.perf_counter() - t0) * 1000
+    saved_data_version = max(saved_data_version, version)
+    save_seconds.observe(write_ms / 1000, "data")
+    save_size.set(size, "data")
+    logger.debug(
+        "saved to %s (%d %s): %.1f ms writing",
+        storage.path, size, "rows" if STORAGE_BACKEND == "sqlite" else "bytes", write_ms
+    )
+
+# -------- JOURNAL FLUSH / RUN RECOVERY --------
+async def journal_flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(run_journal.pending_full.wait(), JOURNAL_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        run_journal.pending_full.clear()
+        try:
+            await asyncio.to_thread(run_journal.write, *run_journal.take_pending())
+        except Exception:
+            logger.exception("run journal write failed")
+
+def snapshot_checkpoint():
+    # full in-run state as of journal seq run_journal.seq; with the journal tail after
+    # journal_offset this is enough to resume the run without replaying it from the start.
+    # taken with counts_lock held; returns None if no record was journaled since the last one
+    # or the last one is less than CHECKPOINT_INTERVAL old
+    if run_journal.seq == checkpoint_saved_seq or clock.time() - checkpoint_saved_at < CHECKPOINT_INTERVAL:
+        return None
+    payload = engine.run.to_json()
+    payload["status_message_id"] = status_message_id
+    payload["journal_seq"] = run_journal.seq
+    payload["journal_offset"] = run_journal.synced_offset
+    return run_journal.generation, run_journal.seq, payload
+
+
+def _write_checkpoint_file(generation: int, payload: dict) -> int:
+    # runs in a worker thread; a checkpoint of a run that was finalized meanwhile is dropped
+    with checkpoint_io_lock:
+        if generation != run_journal.generation:
+            return 0
+        os.makedirs(DATA_DIR, exist_ok=True)
+        return write_json_atomic(CHECKPOINT_FILE, payload)
+
+async def save_checkpoint(snapshot):
+    global checkpoint_saved_seq, checkpoint_saved_at
+    if snapshot is None:
+        return
+    generation, seq, payload = snapshot
+    t0 = time.perf_counter()
+    size = await asyncio.to_thread(_write_checkpoint_file, generation, payload)
+    checkpoint_saved_seq = seq
+    checkpoint_saved_at = clock.time()
+    save_seconds.observe(time.perf_counter() - t0, "checkpoint")
+    save_size.set(size, "checkpoint")
+
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def clear_run_persistence(generation: int = None):
+    # the run is finalized (or dropped): nothing left to resume. with a journal generation,
+    # only if no new run has taken over the journal since. called with counts_lock held
+    global checkpoint_saved_seq
+    if generation is not None and generation != run_journal.generation:
+        return
+    run_journal.discard()
+    checkpoint_saved_seq = None
+    with checkpoint_io_lock:
+        try:
+            os.remove(CHECKPOINT_FILE)
+        except FileNotFoundError:
+            pass
+
+
+def restore_run() -> bool:
+    # rebuilds the in-flight run (counters, snapshots, two-person state) from the last
+    # checkpoint plus the journal records written after it, or from the whole journal
+    # if there is no usable checkpoint. returns True if an unfinished run was restored.
+    global status_message_id
+    start = run_journal.read_first()
+    if not start or start.get("kind") != "start":
+        clear_run_persistence()
+        return False
+
+    marker = saved_journal_marker or {}
+    same_run = marker.get("run_start") == start["ts"]
+    if same_run and marker.get("finished"):
+        # finalized and saved, only the cleanup was missed
+        clear_run_persistence()
+        return False
+    # totals up to the saved seq are already in total_counts_by_user
+    totals_saved_seq = marker.get("seq", 0) if same_run else 0
+
+    cp = load_checkpoint()
+    from_checkpoint = bool(cp and cp.get("run_start") == start["ts"])
+    if from_checkpoint:
+        engine.restore_run(cp)
+        status_message_id = cp.get("status_message_id")
+        offset, after_seq = cp["journal_offset"], cp["journal_seq"]
+    else:
+        engine.start_run(start["ts"], start.get("channel"))
+        offset, after_seq = 0, start["seq"]
+    records, end = run_journal.read(offset)
+    records = [rec for rec in records if rec["seq"] > after_seq]
+
+    replayed = engine.replay(records, totals_saved_seq=totals_saved_seq, until_ts=clock.time())
+
+    run_journal.seq = max(after_seq, records[-1]["seq"] if records else 0)
+    run_journal.truncate(end)
+    logger.info(
+        "restored run started at %s (from checkpoint: %s, replayed %d journal records)",
+        engine.run.start_time, from_checkpoint, replayed
+    )
+    return True
+
+async def resume_run():
+    # re-arms run_timer for the time left, minute_sampler at its next tick and the pinned
+    # status after a restart
+    global run_timer_task, run_sampler_task, run_status_task
+    run_channel_id = engine.run.channel_id
+    channel = bot.get_channel(run_channel_id) if run_channel_id else None
+    if channel is None and run_channel_id:
+        try:
+            channel = await bot.fetch_channel(run_channel_id)
+        except Exception:
+            channel = None
+    if channel is None:
+        channel = bot.get_channel(COMMANDS_CHANNEL_ID)
+
+    remaining = engine.run.start_time + RUN_ANALYSIS_WINDOW_HOURS * 3600 - clock.time()
+    run_timer_task = bot.loop.create_task(run_timer(channel, max(0, remaining)))
+    run_sampler_task = bot.loop.create_task(minute_sampler())
+    run_status_task = bot.loop.create_task(pinned_status(channel, engine.run, status_message_id))
+
+# -------- AUTOSAVE --------
+async def autosave_loop():
+    while True:
+        await clock.sleep(10)
+        # copy under the lock, serialize and write in a worker thread after releasing it
+        async with counts_lock:
+            if not engine.run_active:
+                continue
+            data_snapshot = snapshot_data()
+            checkpoint_snapshot = snapshot_checkpoint()
+        try:
+            await save_data(data_snapshot)
+            await save_checkpoint(checkpoint_snapshot)
+        except Exception:
+            logger.exception("autosave failed")
+
+# -------- HELPERS --------
+def resolve_main_user_id(uid: int) -> int:
+    return alt_to_main.get(uid, uid)
+
+def get_user_team(uid: int):
+    return user_team_mapping.get(uid)
+
+def get_display_name(uid: int):
+    if uid in user_nicknames:
+        return user_nicknames[uid]
+    name = display_names.get(uid)
+    if name:
+        return name
+    return f"User {uid}"
+
+
+def format_duration(seconds: int) -> str:
+    h = seconds // 3600
+    m = (seconds % 3600) // 60
+    s = seconds % 60
+    return f"{h:02}:{m:02}:{s:02}"
+
+def format_duration_hours_minutes(seconds: int) -> str:
+    # For leaderboard_longest display as HH:MM (no seconds)
+    h = seconds // 3600
+    m = (seconds % 3600) // 60
+    return f"{h:02}:{m:02}"
+
+
+def format_accuracy_display(acc_value):
+    # acc_value is float percent or None
+    if acc_value is None:
+        return "N/A"
+    if acc_value == 100:
+        return "100%"
+    return f"{acc_value:06.3f}%"
+
+def _overwrite_has_any(ow: discord.PermissionOverwrite) -> bool:
+    # returns True if overwrite has any explicit permission set (not all None)
+    if ow is None:
+        return False
+    for attr in (
+        "add_reactions", "manage_messages", "manage_channels", "manage_roles", "view_channel",
+        "send_messages", "read_message_history", "send_tts", "connect", "speak",
+        "use_application_commands", "embed_links", "attach_files", "use_external_emojis",
+        "use_external_stickers"
+    ):
+        if getattr(ow, attr, None) is not None:
+            return True
+    return False
+
+# -------- PERMISSION PLANS --------
+# run start/end permission changes are collected per channel first and then applied with a
+# single channel.edit(overwrites=...) per channel, all channels concurrently, instead of
+# one set_permissions call per role x channel. failed edits are retried and reported.
+PERMISSION_EDIT_ATTEMPTS = 3
+
+class PermissionPlan:
+    def __init__(self, reason: str):
+        self.reason = reason
+        # ch_id -> { role: ("update", {perm: value}) | ("replace", overwrite or None) }
+        self.changes = defaultdict(dict)
+
+    def update(self, ch_id: int, role, **perms):
+        # set perms on top of the role's current overwrite (or what is planned for it)
+        kind, value = self.changes[ch_id].get(role, ("update", {}))
+        if kind == "update":
+            self.changes[ch_id][role] = ("update", {**value, **perms})
+        else:
+            ow = discord.PermissionOverwrite(**dict(iter(value))) if value is not None else discord.PermissionOverwrite()
+            ow.update(**perms)
+            self.changes[ch_id][role] = ("replace", ow)
+
+    def replace(self, ch_id: int, role, overwrite):
+        # put back an explicit overwrite (None removes the role's overwrite)
+        self.changes[ch_id][role] = ("replace", overwrite)
+
+    def overwrites_for(self, channel) -> dict:
+        # the channel's final overwrite map
+        overwrites = dict(channel.overwrites)
+        for role, (kind, value) in self.changes[channel.id].items():
+            if kind == "replace":
+                if value is None:
+                    overwrites.pop(role, None)
+                else:
+                    overwrites[role] = value
+            else:
+                ow = channel.overwrites_for(role)
+                ow.update(**value)
+                overwrites[role] = ow
+        return overwrites
+
+    async def _apply_channel(self, guild: discord.Guild, ch_id: int):
+        # returns None on success or the reason it failed
+        for attempt in range(1, PERMISSION_EDIT_ATTEMPTS + 1):
+            ch = bot.get_channel(ch_id) or guild.get_channel(ch_id)
+            if ch is None:
+                return "channel not found"
+            try:
+                # recomputed on every attempt, from the channel's current overwrites
+                await ch.edit(overwrites=self.overwrites_for(ch), reason=self.reason)
+                return None
+            except discord.Forbidden as e:
+                return f"missing permissions ({e})"
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    delay = _retry_after_seconds(e)
+                elif e.status >= 500:
+                    delay = min(2 ** attempt, 30)
+                else:
+                    return str(e)
+                if attempt == PERMISSION_EDIT_ATTEMPTS:
+                    return str(e)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logger.exception("permission edit of %s failed", ch_id)
+                return str(e)
+
+    async def apply(self, guild: discord.Guild) -> dict:
+        # applies the plan; returns ch_id -> failure reason for the channels that failed
+        ch_ids = [ch_id for ch_id, changes in self.changes.items() if changes]
+        results = await asyncio.gather(*(self._apply_channel(guild, ch_id) for ch_id in ch_ids))
+        failures = {ch_id: reason for ch_id, reason in zip(ch_ids, results) if reason is not None}
+        if failures:
+            details = "\n".join(f"<#{ch_id}>: {reason}" for ch_id, reason in failures.items())
+            logger.warning("%s: permission changes failed: %s", self.reason, failures)
+            announcements.post(f"Could not update channel permissions ({self.reason}):\n{details}")
+        return failures
+
+# -------- Lock/Unlock helper for TRACK_CHANNELS --------
+def plan_lock_track_channels(plan: PermissionPlan, guild: discord.Guild):
+    for role_id in LOCK_ROLE_IDS:
+        role = guild.get_role(role_id)
+        if role is None:
+            continue
+        for ch_id in TRACK_CHANNELS:
+            plan.update(ch_id, role, send_messages=False)
+
+def plan_unlock_track_channels(plan: PermissionPlan, guild: discord.Guild):
+    for role_id in LOCK_ROLE_IDS:
+        role = guild.get_role(role_id)
+        if role is None:
+            continue
+        for ch_id in TRACK_CHANNELS:
+            plan.update(ch_id, role, send_messages=True)
+
+# -------- Special roles enable/restore helpers --------
+def plan_enable_special_roles(plan: PermissionPlan, guild: discord.Guild, member: discord.Member):
+    global run_enabled_special_roles
+    if guild is None or member is None:
+        return
+
+    member_role_ids = {r.id for r in member.roles}
+    to_enable = member_role_ids & SPECIAL_ROLES
+    if not to_enable:
+        return
+
+    run_enabled_special_roles = set(to_enable)
+
+    for ch_id in TRACK_CHANNELS:
+        ch = bot.get_channel(ch_id) or guild.get_channel(ch_id)
+        if not ch:
+            continue
+        for rid in to_enable:
+            role = guild.get_role(rid)
+            if role is None:
+                continue
+            # remember the previous explicit overwrite (None if it had none) to restore it later
+            prev = ch.overwrites_for(role)
+            run_original_overwrites[ch_id][rid] = prev if _overwrite_has_any(prev) else None
+            plan.update(ch_id, role, send_messages=True)
+
+def plan_restore_special_roles(plan: PermissionPlan, guild: discord.Guild):
+    if guild is not None:
+        for ch_id, role_map in run_original_overwrites.items():
+            for rid, prev in role_map.items():
+                role = guild.get_role(rid)
+                if role is None:
+                    continue
+                # prev None removes the explicit overwrite (restore to "no explicit allow/deny")
+                plan.replace(ch_id, role, prev)
+    run_original_overwrites.clear()
+    run_enabled_special_roles.clear()
+
+async def apply_run_start_permissions(guild: discord.Guild, member: discord.Member):
+    # lock tracked channels for the specified roles and enable send_messages for any special
+    # role the run starter has, saving previous overwrites so we can restore them at the end
+    plan = PermissionPlan("Run started: locking channels and enabling special roles for runner")
+    plan_lock_track_channels(plan, guild)
+    if member:
+        plan_enable_special_roles(plan, guild, member)
+    await plan.apply(guild)
+
+async def apply_run_end_permissions(guild: discord.Guild):
+    # restore special role overwrites (remove/restore to previous state) and unlock the locked
+    # roles; ends the run_end_pending phase of the run that finalize_current_run detached
+    global run_end_pending
+    try:
+        if guild is None:
+            return
+        if run_permissions_task is not None and not run_permissions_task.done():
+            # a short run: let the start changes land first so they are not left behind
+            await asyncio.wait([run_permissions_task])
+        plan = PermissionPlan("Run ended: restoring special roles and unlocking channels")
+        plan_restore_special_roles(plan, guild)
+        plan_unlock_track_channels(plan, guild)
+        await plan.apply(guild)
+    finally:
+        run_end_pending = False
+
+# -------- DISPLAY NAMES --------
+# uid -> user name for everyone without a nickname. guild members are prefetched once at
+# startup and kept current by member/user events, so rendering a leaderboard is one dict
+# lookup per row. ids that are not cached (users who left, alts) are fetched in the
+# background and show as "User <id>" until then.
+NAME_CACHE_TTL = 6 * 3600          # entries older than this are refreshed when used
+NAME_PREFETCH_CHUNK = 1000         # members cached per event-loop turn during the prefetch
+NAME_FETCH_INTERVAL = 1.0          # seconds between background fetch_user calls
+
+class NameCache:
+    def __init__(self):
+        self.names = {}            # uid -> (name or None if the user doesn't exist, cached_at)
+        self.missing = set()
+        self.wake = asyncio.Event()
+        self.last_sweep = time.monotonic()
+
+    def get(self, uid: int):
+        entry = self.names.get(uid)
+        if entry is not None:
+            name, cached_at = entry
+            if time.monotonic() - cached_at > NAME_CACHE_TTL:
+                self._want(uid)
+            return name
+        user = bot.get_user(uid)
+        if user:
+            self.put(uid, user.name)
+            return user.name
+        self._want(uid)
+        return None
+
+    def put(self, uid: int, name):
+        self.names[uid] = (name, time.monotonic())
+        self.missing.discard(uid)
+
+    def evict(self, uid: int):
+        self.names.pop(uid, None)
+
+    def _want(self, uid: int):
+        if uid not in self.missing:
+            self.missing.add(uid)
+            self.wake.set()
+
+    def sweep(self):
+        # drops entries nobody used for two TTLs (a used one would have been refreshed)
+        cutoff = time.monotonic() - 2 * NAME_CACHE_TTL
+        for uid in [uid for uid, (_, cached_at) in self.names.items() if cached_at < cutoff]:
+            del self.names[uid]
+        self.last_sweep = time.monotonic()
+
+    async def prefetch(self, guilds):
+        for guild in guilds:
+            try:
+                if not guild.chunked:
+                    await guild.chunk()
+            except Exception:
+                logger.exception("name cache: could not chunk guild %s", guild.id)
+            members = list(guild.members)
+            for i in range(0, len(members), NAME_PREFETCH_CHUNK):
+                for member in members[i:i + NAME_PREFETCH_CHUNK]:
+                    self.put(member.id, member.name)
+                await asyncio.sleep(0)
+        logger.info("name cache: %d names prefetched", len(self.names))
+
+    async def run(self):
+        # resolves requested ids one at a time, paced to stay clear of rate limits
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), NAME_CACHE_TTL)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            if time.monotonic() - self.last_sweep > NAME_CACHE_TTL:
+                self.sweep()
+            while self.missing:
+                uid = self.missing.pop()
+                try:
+                    user = await bot.fetch_user(uid)
+                    self.put(uid, user.name)
+                except discord.NotFound:
+                    self.put(uid, None)
+                except Exception:
+                    logger.warning("name cache: could not fetch user %s", uid)
+                await asyncio.sleep(NAME_FETCH_INTERVAL)
+
+display_names = NameCache()
+
+# -------- OUTBOX --------
+# announcements are queued without blocking (callers usually hold counts_lock) and
+# delivered in order by a single task. intents queued within OUTBOX_COALESCE_SECONDS
+# of each other go out as one message, e.g. the "ended" + "started" of a pair change.
+OUTBOX_COALESCE_SECONDS = 0.5
+OUTBOX_MAX_ATTEMPTS = 5
+DISCORD_MESSAGE_LIMIT = 2000
+EMBED_DESCRIPTION_LIMIT = 4096
+
+def _retry_after_seconds(exc: discord.HTTPException, default: float = 1.0) -> float:
+    # seconds to wait according to Discord's rate-limit headers
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    for key in ("Retry-After", "X-RateLimit-Reset-After"):
+        try:
+            return max(float(headers[key]), 0.0)
+        except (KeyError, TypeError, ValueError):
+            continue
+    return default
+
+class Outbox:
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.queue = asyncio.Queue()
+
+    def post(self, text: str):
+        self.queue.put_nowait(text)
+
+    def _pack(self, texts: list) -> list:
+        # joins queued intents into as few messages as fit the length limit
+        chunks = []
+        current = ""
+        for text in texts:
+            if current and len(current) + 2 + len(text) > DISCORD_MESSAGE_LIMIT:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{text}" if current else text
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _send(self, content: str):
+        for attempt in range(1, OUTBOX_MAX_ATTEMPTS + 1):
+            channel = bot.get_channel(self.channel_id)
+            if channel is None:
+                logger.warning("outbox: channel %s not available, dropping message", self.channel_id)
+                return
+            try:
+                t0 = time.perf_counter()
+                await channel.send(content)
+                send_seconds.observe(time.perf_counter() - t0)
+                return
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    delay = _retry_after_seconds(e)
+                elif e.status >= 500:
+                    delay = min(2 ** attempt, 30)
+                else:
+                    logger.warning("outbox: send to %s failed: %s", self.channel_id, e)
+                    send_failures.inc()
+                    return
+                logger.info("outbox: send to %s got %s, retrying in %.1fs", self.channel_id, e.status, delay)
+                await asyncio.sleep(delay)
+        logger.warning("outbox: giving up on message to %s after %d attempts", self.channel_id, OUTBOX_MAX_ATTEMPTS)
+        send_failures.inc()
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(OUTBOX_COALESCE_SECONDS)
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            for content in self._pack(batch):
+                try:
+                    await self._send(content)
+                except Exception:
+                    logger.exception("outbox: unexpected error sending to %s", self.channel_id)
+
+announcements = Outbox(COMMANDS_CHANNEL_ID)
+
+# -------- TWO-PERSON ANNOUNCEMENTS --------
+def announce_two_person_start(ch: int, runners: tuple):
+    # announce in commands channel (clickable mention)
+    runners_display = " & ".join(get_display_name(u) for u in runners)
+    ch_mention = f"<#{ch}>"
+    announcements.post(f"A new run has started in {ch_mention}\nRunners: {runners_display}")
+
+def announce_two_person_end(ch: int, rec: dict):
+    duration_text = format_duration(rec["duration"])
+    runners_display = " & ".join(get_display_name(u) for u in rec["runners"])
+    ch_mention = f"<#{ch}>"
+    announcements.post(f"Run ended in {ch_mention}!\nRunners: {runners_display}\nTotal time was: **{duration_text}**")
+
+def announce_outcomes(outcomes):
+    # posts the two-person transitions among engine outcomes
+    for kind, ch, data in outcomes:
+        if kind == "run_started":
+            announce_two_person_start(ch, data)
+        elif kind == "run_ended":
+            announce_two_person_end(ch, data)
+        elif kind == "run_warning":
+            # send a single warning in commands channel mentioning the active channel
+            ch_mention = f"<#{ch}>"
+            announcements.post(f"The current run in {ch_mention} is close to ending for inactivity!")
+
+# -------- INACTIVITY WATCHER --------
+# the engine keeps the exact inactivity deadline of every two-person run (see
+# CountingEngine.inactivity_deadlines); this task sleeps until the earliest one
+inactivity_wake = asyncio.Event()
+
+async def inactivity_watcher():
+    # sleeps until the earliest deadline (or until an earlier one is scheduled)
+    while True:
+        inactivity_wake.clear()
+        deadline = engine.next_deadline()
+        delay = deadline - clock.time() if deadline is not None else None
+        if delay is None or delay > 0:
+            await clock.wait(inactivity_wake, delay)
+            continue
+
+        async with counts_lock:
+            # runs that failed the check had their deque cleared so we don't immediately restart accidentally
+            announce_outcomes(engine.process_inactivity(clock.time()))
+
+# -------- SECONDARY SAMPLER TASK (every SAMPLE_INTERVAL_SECONDS) --------
+async def minute_sampler():
+ 
+    total_samples = (RUN_ANALYSIS_WINDOW_HOURS * 3600) // SAMPLE_INTERVAL_SECONDS
+    # tick i is taken at the run start + i * SAMPLE_INTERVAL_SECONDS; start at the next
+    # missing tick (0 for a new run, later when resuming after a restart)
+    async with counts_lock:
+        run = engine.run
+        if run is None:
+            return
+        first_tick = run.tick_count()
+
+    for tick in range(first_tick, total_samples + 1):
+        tick_ts = run.start_time + tick * SAMPLE_INTERVAL_SECONDS
+        await clock.sleep_until(tick_ts)
+        async with counts_lock:
+            if engine.run is not run:
+                break
+
+            sampler_drift.observe(max(0.0, clock.time() - tick_ts))
+            engine.sample_tick()
+
+# -------- MESSAGE LISTENER --------
+@bot.event
+async def on_message(message: discord.Message):
+    t0 = time.perf_counter()
+    ev = message_event(message, clock.time())
+    if not engine.is_relevant(ev):
+        return
+
+    async with counts_lock:
+        # timestamp in lock order, so the journal is replayed in the order it was applied
+        ev = ev._replace(ts=clock.time())
+        outcomes = engine.handle_message(ev)
+        for kind, ch, data in outcomes:
+            if kind == "count":
+                counts_metric.inc(ch)
+            elif kind in ("mistake", "wrong"):
+                mistakes_metric.inc(ch, kind)
+            else:
+                continue
+            run_journal.append(kind, ev.ts, ch=ch, uid=data)
+        announce_outcomes(outcomes)
+    message_latency.observe(time.perf_counter() - t0)
+
+# -------- FINALIZATION --------
+# the one way a run ends (timer or /end_run):
+#   1. under counts_lock: detach the run state (counting stops; /run waits for step 5)
+#   2. in a worker thread: summarize the detached run (window scan, leaderboard, record)
+#   3. under counts_lock: store the attempt and snapshot the data, then write it
+#   4. outside the lock: clean up the run files and hand back the summary for display
+#   5. the caller posts the summary and restores permissions (apply_run_end_permissions)
+async def finalize_current_run(*, save: bool = True, announce_two_person: bool = False):
+    # returns the summary (see engine.summarize_run), or None if no run was active. on
+    # success the caller must follow up with apply_run_end_permissions, which allows the
+    # next /run again
+    global run_timer_task, run_sampler_task, run_status_task, run_end_pending
+
+    async with counts_lock:
+        if not engine.run_active:
+            return None
+
+        # cancel background tasks if present (but not the run timer calling us)
+        for task in (run_timer_task, run_sampler_task, run_status_task):
+            if task is not None and not task.done() and task is not asyncio.current_task():
+                task.cancel()
+        run_timer_task = None
+        run_sampler_task = None
+        run_status_task = None
+
+        run, ended = engine.detach_run(clock.time())
+        generation = run_journal.generation
+        run_end_pending = True
+
+    try:
+        if announce_two_person:
+            for ch, rec in ended:
+                announce_two_person_end(ch, rec)
+
+        summary = await asyncio.to_thread(summarize_run, run, engine.team_of)
+        summary["ended_two_person"] = ended
+
+        async with counts_lock:
+            engine.commit_attempt(summary, save=save)
+            data_snapshot = snapshot_data(force=True, finished_run_start=run.start_time) if save else None
+
+        # persist data, then drop the journal and checkpoint (unless a new run owns them by now)
+        await save_data(data_snapshot)
+        async with counts_lock:
+            clear_run_persistence(generation)
+    except Exception:
+        # no caller will restore the permissions; don't block the next run forever
+        run_end_pending = False
+        raise
+    return summary
+
+def build_attempt_embed(summary: dict) -> discord.Embed:
+    current_run_team = summary["team"]
+    leaderboard_items = summary["leaderboard"]
+    correct = summary["correct"]
+    incorrect = summary["incorrect"]
+    acc_value = summary["accuracy"]
+    longest = summary["longest"]
+
+    if correct + incorrect == 0:
+        accuracy_text = "N/A"
+    else:
+        accuracy_text = "100%" if acc_value == 100 else (format_accuracy_display(acc_value) if acc_value is not None else "N/A")
+
+    if not leaderboard_items:
+        leaderboard_text = "No numbers were counted."
+    else:
+        lines = []
+        for i, (uid, count) in enumerate(leaderboard_items, start=1):
+            name = get_display_name(uid)
+            lines.append(f"**#{i}** {name}, **{count:,}**")
+        leaderboard_text = "\n".join(lines)
+
+    # participants for the best 1-hour window
+    if summary["best_participants"]:
+        best_participants_display = " & ".join(f"**{get_display_name(u)}**" for u in summary["best_participants"])
+    else:
+        best_participants_display = "N/A"
+
+    # longest run display
+    if longest:
+        longest_duration_text = format_duration(longest["duration"])
+        longest_participants = " & ".join(f"**{get_display_name(u)}**" for u in longest["runners"])
+        longest_block = f"Longest run: **{longest_duration_text}**\nParticipants: {longest_participants}\n\n"
+    else:
+        longest_block = ""
+
+    return discord.Embed(
+        title=f"**{current_run_team.upper() if current_run_team else 'NO TEAM'}'S ATTEMPT #{summary['attempt_number']} STATS:**",
+        description=(
+            f"Fastest 1-hour run: **{summary['best_1hour']:,}**\n"
+            f"Participants: {best_participants_display}\n\n"
+            f"{longest_block}"
+            f"Correct Rate: **{accuracy_text}**\n"
+            f"✅ **{correct:,}**\n"
+            f"❌ **{incorrect:,}**\n\n"
+            f"{leaderboard_text}"
+        )[:EMBED_DESCRIPTION_LIMIT],
+        color=0xCCA958
+    )
+
+# -------- RUN TIMER (finalize attempt) --------
+async def run_timer(channel: discord.abc.Messageable, duration: float = RUN_ANALYSIS_WINDOW_HOURS * 3600):
+    # full 24h for a new run, the time left when resuming after a restart
+    await clock.sleep(duration)
+
+    summary = await finalize_current_run()
+    if summary is None:
+        return
+
+    try:
+        message = await channel.send(embed=build_attempt_embed(summary))
+        await message.pin()
+    finally:
+        # restore special role overwrites and unlock previously locked channels
+        await apply_run_end_permissions(getattr(channel, "guild", None))
+
+# -------- LIVE RUN STATUS --------
+# /run during a run and the pinned status message share one cached embed. it is rebuilt at
+# most once per STATUS_REFRESH_SECONDS, and only when the run changed or the shown time moved
+# on; callers arriving during a rebuild wait for that one instead of starting their own
+STATUS_REFRESH_SECONDS = 1.0
+STATUS_PIN_INTERVAL = 0      # seconds between edits of a pinned status message (0 = don't pin one)
+
+class RunStatus:
+    def __init__(self):
+        self.embed = None
+        self.key = None              # (run start, run version, elapsed seconds) shown by embed
+        self.built_at = 0.0
+        self.lock = asyncio.Lock()
+
+    def _fresh(self, run) -> bool:
+        return (
+            self.embed is not None
+            and self.key[0] == run.start_time
+            and clock.time() - self.built_at < STATUS_REFRESH_SECONDS
+        )
+
+    async def embed_for(self, run):
+        # status embed of run, or None once it is no longer the current run
+        if engine.run is not run:
+            return None
+        if self._fresh(run):
+            return self.embed
+        async with self.lock:
+            if self._fresh(run):
+                return self.embed
+            elapsed = int(clock.time() - run.start_time)
+            key = (run.start_time, run.version, elapsed)
+            if key != self.key:
+                # copied without awaiting, so no message can be half-applied; no counts_lock needed
+                items = list(run.counts_by_user.items())
+                correct, incorrect = run.correct, run.incorrect
+                self.embed = self._render(elapsed, correct, incorrect, items)
+                self.key = key
+            self.built_at = clock.time()
+            return self.embed
+
+    @staticmethod
+    def _render(elapsed: int, correct: int, incorrect: int, items: list) -> discord.Embed:
+        if correct + incorrect == 0:
+            accuracy_text = "N/A"
+        else:
+            acc_val = format_accuracy_value(correct, incorrect)
+            accuracy_text = "100%" if acc_val == 100 else (format_accuracy_display(acc_val) if acc_val is not None else "N/A")
+
+        items.sort(key=lambda x: -x[1])
+        leaderboard = (
+            "\n".join(
+                f"**#{i}** {get_display_name(uid)}, **{count:,}**"
+                for i, (uid, count) in enumerate(items, start=1)
+            )
+            if items else
+            "No numbers counted yet."
+        )
+
+        return discord.Embed(
+            title="**CURRENT RUN STATUS**",
+            description=(
+                f"Time: **{format_duration(elapsed)}**\n"
+                f"Correct Rate: **{accuracy_text}**\n"
+                f"✅ **{correct:,}**\n"
+                f"❌ **{incorrect:,}**\n\n"
+                f"{leaderboard}"
+            )[:EMBED_DESCRIPTION_LIMIT],
+            color=0xCCA958
+        )
+
+run_status = RunStatus()
+
+async def pinned_status(channel: discord.abc.Messageable, run, message_id: int = None):
+    # posts a status message for run (or picks up message_id, the one posted before a
+    # restart), pins it and edits it every STATUS_PIN_INTERVAL seconds until the run ends
+    # (or this task is cancelled), then unpins it
+    global status_message_id, checkpoint_saved_seq, checkpoint_saved_at
+    if not STATUS_PIN_INTERVAL:
+        return
+    message = None
+    try:
+        embed = await run_status.embed_for(run)
+        if embed is None:
+            return
+        if message_id is not None:
+            try:
+                message = await channel.fetch_message(message_id)
+                await message.edit(embed=embed)
+            except discord.HTTPException:
+                message = None
+        if message is None:
+            message = await channel.send(embed=embed)
+            status_message_id = message.id
+            # checkpoint at the next autosave, so a restart finds this message
+            checkpoint_saved_seq, checkpoint_saved_at = None, 0.0
+        if not message.pinned:
+            await message.pin()
+        while True:
+            await clock.sleep(STATUS_PIN_INTERVAL)
+            embed = await run_status.embed_for(run)
+            if embed is None:
+                break
+            try:
+                await message.edit(embed=embed)
+            except discord.HTTPException as e:
+                logger.warning("pinned status: edit failed: %s", e)
+    except discord.HTTPException as e:
+        logger.warning("pinned status: could not post or pin in %s: %s", getattr(channel, "id", None), e)
+    finally:
+        if message is not None and engine.run is not run:
+            # keep it pinned (and its id) while the run is still going, e.g. across a restart
+            if status_message_id == message.id:
+                status_message_id = None
+            try:
+                await message.unpin()
+            except discord.HTTPException:
+                pass
+
+# -------- PAGINATED LEADERBOARDS --------
+# long leaderboards are shown one page at a time with prev/next buttons. the ranked rows of
+# a board are built once per data version, without counts_lock, from an immutable
+# engine.view(), and each page is rendered the first time it is viewed, so paging and
+# repeated views never re-sort or re-render the list.
+LEADERBOARD_VIEW_TIMEOUT = 300    # seconds the buttons stay active after the last click
+
+class PagedLeaderboard:
+    def __init__(self, title: str, page_size: int, empty_text: str, version, build_rows, render_row,
+                 *, separator: str = "\n", max_staleness: float = 0.0):
+        self.title = title
+        self.page_size = page_size
+        self.empty_text = empty_text
+        self.version = version            # (view) -> data version the rows depend on
+        self.build_rows = build_rows      # (view) -> ranked rows, from an engine.view()
+        self.render_row = render_row      # (rank, row) -> text
+        self.separator = separator
+        # rows built less than this many seconds ago are reused even if the version moved on,
+        # so a board that changes with every count is re-sorted at most once per interval
+        self.max_staleness = max_staleness
+        self.rows = None
+        self.rows_version = None
+        self.rows_built_at = 0.0
+        self.pages = {}
+
+    async def _current_rows(self):
+        view = engine.view()
+        version = self.version(view)
+        if self.rows is not None and (
+            version == self.rows_version
+            or (self.rows and time.monotonic() - self.rows_built_at < self.max_staleness)
+        ):
+            return self.rows
+        self.rows = self.build_rows(view)
+        self.rows_version = version
+        self.rows_built_at = time.monotonic()
+        self.pages = {}
+        return self.rows
+
+    async def page(self, number: int):
+        # (embed or None if there are no rows, page number clamped to the range, page count)
+        rows = await self._current_rows()
+        if not rows:
+            return None, 0, 0
+        page_count = (len(rows) + self.page_size - 1) // self.page_size
+        number = max(0, min(number, page_count - 1))
+        embed = self.pages.get(number)
+        if embed is None:
+            first = number * self.page_size
+            text = self.separator.join(
+                self.render_row(rank, row)
+                for rank, row in enumerate(rows[first:first + self.page_size], start=first + 1)
+            )
+            embed = discord.Embed(
+                title=self.title,
+                description=text[:EMBED_DESCRIPTION_LIMIT],
+                color=0xCCA958
+            )
+            if page_count > 1:
+                embed.set_footer(text=f"Page {number + 1}/{page_count}")
+            self.pages[number] = embed
+        return embed, number, page_count
+
+    async def send(self, interaction: discord.Interaction):
+        embed, number, page_count = await self.page(0)
+        if embed is None:
+            await interaction.response.send_message(self.empty_text)
+            return
+        if page_count > 1:
+            await interaction.response.send_message(embed=embed, view=LeaderboardPageView(self, number, page_count))
+        else:
+            await interaction.response.send_message(embed=embed)
+
+class LeaderboardPageView(discord.ui.View):
+    def __init__(self, board: PagedLeaderboard, number: int, page_count: int):
+        super().__init__(timeout=LEADERBOARD_VIEW_TIMEOUT)
+        self.board = board
+        self.number = number
+        self._update_buttons(page_count)
+
+    def _update_buttons(self, page_count: int):
+        self.prev_page.disabled = self.number <= 0
+        self.next_page.disabled = self.number >= page_count - 1
+
+    async def _show(self, interaction: discord.Interaction, number: int):
+        embed, self.number, page_count = await self.board.page(number)
+        if embed is None:
+            await interaction.response.edit_message(content=self.board.empty_text, embed=None, view=None)
+            return
+        self._update_buttons(page_count)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="◀ Prev", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.number - 1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.number + 1)
+
+def _render_top_user(rank: int, row) -> str:
+    uid, count = row
+    name = get_display_name(uid)
+    team = get_user_team(uid)
+    if team:
+        return f"**#{rank}** {name} - {team}, **{count:,}**"
+    return f"**#{rank}** {name}, **{count:,}**"
+
+def _render_attempt(rank: int, e) -> str:
+    acc = e["accuracy"]
+    if acc is None:
+        acc_text = "N/A"
+    else:
+        acc_text = "100%" if acc == 100 else f"{float(acc):06.3f}%"
+    longest_text = format_duration(e["longest"]) if e["longest"] > 0 else "N/A"
+    team_label = e["team"].upper()
+    return "\n".join((
+        f"**{team_label}** ({e['attempt']})",
+        f"Numbers Counted: **{e['correct']:,}**",
+        f"Accuracy **{acc_text}**",
+        f"Longest Run: **{longest_text}**",
+        f"Fastest Run: **{e['fastest']:,}**",
+    ))
+
+top_users_board = PagedLeaderboard(
+    "**USERS LEADERBOAD**", 25, "No data available yet.",
+    version=lambda view: view.data_version,
+    build_rows=lambda view: sorted(view.totals.items(), key=lambda x: -x[1]),
+    render_row=_render_top_user,
+    # totals change with every count during a run
+    max_staleness=5.0,
+)
+
+# teams in insertion order and their attempts in stored order
+all_runs_board = PagedLeaderboard(
+    "**ALL RUNS**", 10, "No saved attempts available yet.",
+    version=lambda view: view.history_version,
+    build_rows=lambda view: list(view.leaderboards.attempt_summaries()),
+    render_row=_render_attempt,
+    separator="\n\n",    # blank line between attempts
+)
+
+# -------- EXPORT --------
+EXPORT_KINDS = ("totals", "attempts", "two_person")
+EXPORT_FORMATS = ("ndjson", "csv")
+EXPORT_CHUNK_ROWS = 500    # rows serialized per write into the compressed stream
+
+EXPORT_COLUMNS = {
+    "totals": ["user_id", "name", "team", "total"],
+    "attempts": [
+        "team", "attempt", "correct", "incorrect", "accuracy", "best_1hour",
+        "best_1hour_start", "best_windows", "top_users", "two_person_runs", "rate_rollup"
+    ],
+    "two_person": ["team", "attempt", "channel", "runners", "start", "end", "duration"],
+}
+
+def _export_attempts(history, team, first, last):
+    # (team, attempt number, record) for the attempts that pass the team/attempt filters
+    for t, attempts in history.items():
+        if team is not None and t.lower() != team.lower():
+            continue
+        for i, record in enumerate(attempts, start=1):
+            if first is not None and i < first:
+                continue
+            if last is not None and i > last:
+                break
+            yield t, i, record
+
+def export_rows(kind, data, *, team=None, first=None, last=None, user_id=None, user_name=None):
+    # rows for one export kind, built from a copy of the stored data.
+    # the user filter keeps that user's total, the two-person runs they ran in, and the
+    # attempts where they were a two-person runner or one of the top counters
+    if kind == "totals":
+        for uid, total in data["totals"].items():
+            if user_id is not None and uid != user_id:
+                continue
+            t = data["teams"].get(uid)
+            if team is not None and (t is None or t.lower() != team.lower()):
+                continue
+            yield {"user_id": uid, "name": data["names"].get(uid), "team": t, "total": total}
+        return
+
+    for t, attempt, record in _export_attempts(data["history"], team, first, last):
+        two_runs = record.get("two_person_runs", []) or []
+        if kind == "two_person":
+            for rec in two_runs:
+                if user_id is not None and user_id not in rec["runners"]:
+                    continue
+                yield {
+                    "team": t,
+                    "attempt": attempt,
+                    "channel": rec["channel"],
+                    "runners": list(rec["runners"]),
+                    "start": rec["start"],
+                    "end": rec["end"],
+                    "duration": rec["duration"]
+                }
+            continue
+
+        if user_id is not None:
+            ran = any(user_id in rec["runners"] for rec in two_runs)
+            if not ran and user_name not in record.get("top_users", []):
+                continue
+        yield {
+            "team": t,
+            "attempt": attempt,
+            "correct": record.get("correct", 0),
+            "incorrect": record.get("incorrect", 0),
+            "accuracy": record.get("accuracy"),
+            "best_1hour": record.get("best_1hour", 0),
+            "best_1hour_start": record.get("best_1hour_start"),
+            "best_windows": record.get("best_windows", {}),
+            "top_users": record.get("top_users", []),
+            "two_person_runs": len(two_runs),
+            "rate_rollup": record.get("rate_rollup")
+        }
+
+def _csv_value(value):
+    # nested values go into one CSV cell as compact JSON
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, separators=(",", ":"))
+    return value
+
+def write_export(kind, fmt, data, **filters):
+    # serializes the export into a gzip-compressed temp file, EXPORT_CHUNK_ROWS rows per
+    # write so the whole export is never held in memory. blocking - run it in a thread.
+    # returns (file positioned at the start, row count)
+    out = tempfile.TemporaryFile()
+    rows = 0
+    with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+        writer = None
+        if fmt == "csv":
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_COLUMNS[kind])
+        chunk = []
+        for row in export_rows(kind, data, **filters):
+            if writer is not None:
+                chunk.append([_csv_value(row[c]) for c in EXPORT_COLUMNS[kind]])
+            else:
+                chunk.append(json.dumps(row, separators=(",", ":")))
+            rows += 1
+            if len(chunk) >= EXPORT_CHUNK_ROWS:
+                if writer is not None:
+                    writer.writerows(chunk)
+                else:
+                    text.write("\n".join(chunk) + "\n")
+                chunk.clear()
+        if chunk:
+            if writer is not None:
+                writer.writerows(chunk)
+            else:
+                text.write("\n".join(chunk) + "\n")
+        text.flush()
+        text.detach()
+    out.seek(0)
+    return out, rows
+
+# -------- SLASH COMMANDS --------
+@bot.tree.command(name="run", description="Starts a run or shows current run status.")
+async def start_run(interaction: discord.Interaction):
+    global run_timer_task, run_sampler_task, run_status_task, run_permissions_task
+
+    run = engine.run
+    if run is not None:
+        embed = await run_status.embed_for(run)
+        if embed is not None:
+            await interaction.response.send_message(embed=embed)
+            return
+
+    async with counts_lock:
+        if engine.run is not None:
+            await interaction.response.send_message("A run is already in progress.", ephemeral=True)
+            return
+        if run_end_pending:
+            await interaction.response.send_message(
+                "The last run is still wrapping up (restoring channel permissions). Try again in a moment.",
+                ephemeral=True
+            )
+            return
+        run = engine.start_run(clock.time(), interaction.channel_id)
+
+        run_journal.reset()
+        run_journal.append("start", run.start_time, channel=run.channel_id)
+
+    # answer within the interaction deadline before anything that can wait on Discord
+    await interaction.response.send_message(
+        "24 hours attempt started! Stats are now being collected."
+    )
+
+    # start run timer, minute sampler and pinned status; keep references so /end_run can cancel them
+    run_timer_task = bot.loop.create_task(run_timer(interaction.channel))
+    run_sampler_task = bot.loop.create_task(minute_sampler())
+    run_status_task = bot.loop.create_task(pinned_status(interaction.channel, run))
+
+    # lock tracked channels and enable the run starter's special roles in the background;
+    # permission edits are retried with backoff and failures are announced by the plan
+    guild = interaction.guild
+    if guild:
+        run_permissions_task = bot.loop.create_task(
+            apply_run_start_permissions(guild, guild.get_member(interaction.user.id))
+        )
+
+@bot.tree.command(name="end_run", description="Ends the current run early. Choose to save the data or not.")
+async def end_run(interaction: discord.Interaction, save: bool = True):
+    if not engine.run_active:
+        await interaction.response.send_message("No active run to end.", ephemeral=True)
+        return
+
+    # the analysis can take longer than the interaction response window
+    await interaction.response.defer()
+
+    # same finalization as run_timer; still-active two-person runs end now (official end)
+    summary = await finalize_current_run(save=save, announce_two_person=True)
+    if summary is None:
+        await interaction.followup.send("No active run to end.", ephemeral=True)
+        return
+
+    try:
+        await interaction.followup.send(embed=build_attempt_embed(summary))
+    finally:
+        # restore special role overwrites and unlock previously locked channels
+        await apply_run_end_permissions(interaction.guild)
+
+@bot.tree.command(name="top_users", description="Shows total numbers counted by each user and which team they belong to.")
+async def leaderboard_users(interaction: discord.Interaction):
+    await top_users_board.send(interaction)
+
+@bot.tree.command(name="leaderboard_accuracy", description="Shows accuracy leaderboard for all team attempts.")
+async def leaderboard_accuracy(interaction: discord.Interaction):
+    entries = engine.view().leaderboards.top("accuracy")
+
+    if not entries:
+        await interaction.response.send_message("No accuracy data available yet.")
+        return
+
+    lines = []
+    for rank, (team, attempt, value, _) in enumerate(entries, start=1):
+        if value == 100:
+            acc_text = "100%"
+        else:
+            acc_text = f"{value:06.3f}%"
+        lines.append(f"**#{rank}** {team} ({attempt}) - **{acc_text}**")
+
+    embed = discord.Embed(
+        title="**ACCURACY LEADERBOARD**",
+        description="\n".join(lines),
+        color=0xCCA958
+    )
+
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="leaderboard_numbers", description="Shows numbers counted per team attempt.")
+async def leaderboard_numbers(interaction: discord.Interaction):
+    entries = engine.view().leaderboards.top("numbers")
+
+    if not entries:
+        await interaction.response.send_message("No run data available yet.")
+        return
+
+    lines = []
+    for rank, (team, attempt, count, _) in enumerate(entries, start=1):
+        lines.append(f"**#{rank}** {team} ({attempt}) - **{count:,}**")
+
+    embed = discord.Embed(
+        title="**NUMBERS LEADERBOARD**",
+        description="\n".join(lines),
+        color=0xCCA958
+    )
+
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="leaderboard_fastest", description="Shows fastest 1-hour runs with top users and team.")
+async def leaderboard_fastest(interaction: discord.Interaction):
+    entries = engine.view().leaderboards.top("fastest")
+
+    if not entries:
+        await interaction.response.send_message("No fastest-run data available yet.")
+        return
+
+    lines = []
+    for rank, (team, attempt, best, top_users) in enumerate(entries, start=1):
+        if top_users:
+            display_users = " & ".join(top_users[:2])
+            lines.append(f"**#{rank}** {display_users} - {team}, **{best:,}**")
+        else:
+            lines.append(f"**#{rank}** {team}, **{best:,}**")
+
+    embed = discord.Embed(
+        title="**FASTEST RUN LEADERBOARD**",
+        description="\n".join(lines),
+        color=0xCCA958
+    )
+
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="leaderboard_longest", description="Shows longest two-person runs (best per attempt).")
+async def leaderboard_longest(interaction: discord.Interaction):
+
+    # the single longest two-person run of each attempt, longest first
+    entries = engine.view().leaderboards.top("longest")
+
+    if not entries:
+        await interaction.response.send_message("No two-person run data available yet.")
+        return
+
+    lines = []
+    for rank, (team, attempt_idx, dur, runners) in enumerate(entries, start=1):
+        names = [get_display_name(u) for u in runners]
+        runners_display = " & ".join(names[:2]) if names else "N/A"
+        dur_text = format_duration_hours_minutes(dur)
+        lines.append(f"**#{rank}** {runners_display} - {team}, **{dur_text}** hours")
+
+    embed = discord.Embed(
+        title="**LONGEST RUN LEADERBOARD**",
+        description="\n".join(lines),
+        color=0xCCA958
+    )
+
+    await interaction.response.send_message(embed=embed)
+
+# -------- NEW: /points command --------
+@bot.tree.command(name="points", description="Shows points leaderboard from current winners of categories.")
+async def points_command(interaction: discord.Interaction):
+
+    # winners for each category, read off the published leaderboards
+    boards = engine.view().leaderboards
+    # Fastest Run winner: highest best_1hour across all team attempts
+    fastest_winner = boards.winner("fastest")
+    # Numbers Counted winner: highest correct count across attempts
+    numbers_winner = boards.winner("numbers")
+    # Accuracy winner: highest accuracy percent across attempts
+    accuracy_winner = boards.winner("accuracy", positive=False)
+    # Longest Run winner: highest duration from two_person_runs across attempts
+    longest_winner = boards.winner("longest")
+
+    # tally points
+    points = defaultdict(int)
+    winning_categories = defaultdict(list)
+
+    if fastest_winner:
+        points[fastest_winner] += 1
+        winning_categories[fastest_winner].append("Fastest Run")
+    if numbers_winner:
+        points[numbers_winner] += 2  # Numbers Counted worth 2 points
+        winning_categories[numbers_winner].append("Numbers Counted")
+    if accuracy_winner:
+        points[accuracy_winner] += 1
+        winning_categories[accuracy_winner].append("Accuracy")
+    if longest_winner:
+        points[longest_winner] += 1
+        winning_categories[longest_winner].append("Longest Run")
+
+    if not points:
+        await interaction.response.send_message("No winners available yet to calculate points.")
+        return
+
+    # build sorted leaderboard by points desc, then team name
+    leaderboard = sorted(points.items(), key=lambda x: (-x[1], x[0]))
+
+    lines = []
+    for i, (team, pts) in enumerate(leaderboard, start=1):
+        cats = ", ".join(winning_categories.get(team, []))
+        if cats:
+            lines.append(f"**#{i}** {team} - {cats}, **{pts}**")
+        else:
+            lines.append(f"**#{i}** {team}, **{pts}**")
+
+    embed = discord.Embed(
+        title="**POINTS LEADERBOARD**",
+        description="\n".join(lines),
+        color=0xCCA958
+    )
+
+    await interaction.response.send_message(embed=embed)
+
+# -------- NEW: /all_runs command --------
+@bot.tree.command(name="all_runs", description="Shows summary of all attempts so far.")
+async def all_runs(interaction: discord.Interaction):
+    await all_runs_board.send(interaction)
+
+@bot.tree.command(name="show_data", description="Exports stored data as a compressed NDJSON or CSV file.")
+@app_commands.describe(
+    kind="What to export",
+    fmt="File format",
+    team="Only this team",
+    first_attempt="First attempt number to include",
+    last_attempt="Last attempt number to include",
+    user="Only rows involving this user"
+)
+async def show_data(
+    interaction: discord.Interaction,
+    kind: Literal["totals", "attempts", "two_person"] = "attempts",
+    fmt: Literal["ndjson", "csv"] = "ndjson",
+    team: Optional[str] = None,
+    first_attempt: Optional[int] = None,
+    last_attempt: Optional[int] = None,
+    user: Optional[discord.User] = None
+):
+    if interaction.user.id != ADMIN_USER_ID:
+        await interaction.response.send_message(
+            "You are not allowed to use this command silly :p",
+            ephemeral=True
+        )
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    # the view is immutable and stored attempt records are never mutated after they are
+    # committed, so the worker thread can read them freely
+    view = engine.view()
+    data = {"totals": view.totals, "history": view.history}
+    data["teams"] = {uid: get_user_team(uid) for uid in data["totals"]} if kind == "totals" else {}
+    data["names"] = {uid: get_display_name(uid) for uid in data["totals"]} if kind == "totals" else {}
+
+    user_id = resolve_main_user_id(user.id) if user is not None else None
+    out, rows = await asyncio.to_thread(
+        write_export, kind, fmt, data,
+        team=team,
+        first=first_attempt,
+        last=last_attempt,
+        user_id=user_id,
+        user_name=get_display_name(user_id) if user_id is not None else None
+    )
+
+    size = out.seek(0, os.SEEK_END)
+    out.seek(0)
+    limit = interaction.guild.filesize_limit if interaction.guild else 8 * 1024 * 1024
+    if size > limit:
+        out.close()
+        await interaction.followup.send(
+            f"The export is {size // 1024} KiB compressed, over the {limit // 1024} KiB upload limit. "
+            "Narrow it down with the team, attempt or user filters.",
+            ephemeral=True
+        )
+        return
+
+    await interaction.followup.send(
+        f"{rows} {kind} row{'s' if rows != 1 else ''}.",
+        file=discord.File(fp=out, filename=f"run_data_{kind}.{fmt}.gz"),
+        ephemeral=True
+    )
+    out.close()
+
+@bot.tree.command(name="profile", description="Samples the bot for a few seconds and attaches a flame graph profile.")
+@app_commands.describe(seconds=f"How long to sample (1-{PROFILE_MAX_SECONDS})")
+async def profile(interaction: discord.Interaction, seconds: int = 10):
+    global profile_running
+    if interaction.user.id != ADMIN_USER_ID:
+        await interaction.response.send_message(
+            "You are not allowed to use this command silly :p",
+            ephemeral=True
+        )
+        return
+    if profile_running:
+        await interaction.response.send_message("A profile is already running.", ephemeral=True)
+        return
+
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    profile_running = True
+    try:
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        profiler = SamplingProfiler(stall_watchdog.loop_thread_id or threading.get_ident(), PROFILE_HZ)
+        folded, samples = await asyncio.to_thread(profiler.run, seconds)
+    finally:
+        profile_running = False
+
+    files = [discord.File(fp=io.BytesIO(folded.encode("utf-8")), filename="profile.folded")]
+    if stall_watchdog.stalls:
+        stalls = "\n".join(
+            f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))} UTC - {lag * 1000:.0f} ms\n{stack}"
+            for ts, lag, stack in stall_watchdog.stalls
+        )
+        files.append(discord.File(fp=io.BytesIO(stalls.encode("utf-8")), filename="stalls.txt"))
+    await interaction.followup.send(
+        f"{samples} samples over {seconds}s (folded stacks for flamegraph.pl / speedscope). "
+        f"{len(stall_watchdog.stalls)} recent stall{'s' if len(stall_watchdog.stalls) != 1 else ''} over "
+        f"{STALL_THRESHOLD_SECONDS * 1000:.0f} ms.",
+        files=files,
+        ephemeral=True
+    )
+
+# -------- READY --------
+@bot.event
+async def on_ready():
+    global startup_done, storage, metrics_server
+    # on_ready fires again on every reconnect; only load and replay once
+    if not startup_done:
+        startup_done = True
+        storage = open_storage()
+        load_data()
+        if restore_run():
+            await resume_run()
+        bot.loop.create_task(autosave_loop())
+        bot.loop.create_task(journal_flush_loop())
+        bot.loop.create_task(announcements.run())
+        bot.loop.create_task(inactivity_watcher())
+        bot.loop.create_task(display_names.prefetch(bot.guilds))
+        bot.loop.create_task(display_names.run())
+        bot.loop.create_task(stall_watchdog.run())
+        if METRICS_PORT:
+            metrics_server = await metrics.serve(registry, METRICS_HOST, METRICS_PORT)
+            logger.info("metrics on http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+    await bot.tree.sync()
+    print(f"Logged in as {bot.user} (ID: {bot.user.id}")
+    print(f"Data: {storage.path} ({STORAGE_BACKEND})")
+
+# keep display_names current
+@bot.event
+async def on_member_join(member: discord.Member):
+    display_names.put(member.id, member.name)
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    display_names.put(after.id, after.name)
+
+@bot.event
+async def on_user_update(before: discord.User, after: discord.User):
+    display_names.put(after.id, after.name)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    display_names.evict(member.id)
+
+# -------- RUN --------
+if __name__ == "__main__":
+    bot.run(TOKEN, log_handler=handler)
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from time import perf_counter
+
+# Diagnostics for a laggy event loop. StallWatchdog runs all the time: a heartbeat task on
+# the loop plus a thread that grabs the loop thread's stack once a beat is overdue, so the
+# report names the code that was blocking rather than whatever ran next. SamplingProfiler
+# is opt-in: it samples the loop thread for a few seconds and returns folded stacks
+# ("outer;inner count" lines) that flamegraph.pl, speedscope or inferno read directly.
+
+def _stack_frames(frame):
+    # "function (file:first line)" from outermost to innermost
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+class StallWatchdog:
+    def __init__(self, threshold: float, interval: float = 0.1, on_stall=None, keep: int = 20):
+        self.threshold = threshold    # seconds a beat may be late before it counts as a stall
+        self.interval = interval
+        self.on_stall = on_stall      # called on the loop with (seconds, stack text) after a stall
+        self.stalls = deque(maxlen=keep)    # (wall time, seconds, stack text), newest last
+        self.loop_thread_id = None
+        self.beat = perf_counter()
+        self._captured = None
+        self._thread = None
+
+    def _watch(self):
+        # runs in a daemon thread: captures the loop's stack once per overdue beat
+        captured_for = None
+        while True:
+            time.sleep(self.interval)
+            beat = self.beat
+            if beat == captured_for or perf_counter() - beat <= self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self._captured = "".join(traceback.format_stack(frame))
+                captured_for = beat
+
+    async def run(self):
+        self.loop_thread_id = threading.get_ident()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name="stall-watchdog", daemon=True)
+            self._thread.start()
+        while True:
+            self.beat = perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = perf_counter() - self.beat - self.interval
+            if lag <= self.threshold:
+                continue
+            stack, self._captured = self._captured, None
+            stack = stack or "(stack not captured)\n"
+            self.stalls.append((time.time(), lag, stack))
+            if self.on_stall is not None:
+                self.on_stall(lag, stack)
+
+class SamplingProfiler:
+    def __init__(self, thread_id: int, hz: int = 200):
+        self.thread_id = thread_id
+        self.hz = hz
+
+    def run(self, seconds: float) -> tuple:
+        # blocking - run it in a worker thread. returns (folded stacks text, samples taken)
+        counts = Counter()
+        interval = 1 / self.hz
+        samples = 0
+        end = perf_counter() + seconds
+        while perf_counter() < end:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                counts[";".join(name.replace(";", ":") for name in _stack_frames(frame))] += 1
+                samples += 1
+            del frame
+            time.sleep(interval)
+        text = "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+        return text, samples
@@ -0,0 +1,254 @@
+import json
+import os
+import sqlite3
+from array import array
+
+# Persistent storage for totals, attempt history and the journal marker. main.py hands
+# save() the engine.snapshot_data() payload (plus "journal") from a worker thread and reads
+# it back with load() at startup, in the same format for every backend:
+#   { "total_counts_by_user": { uid: int }, "team_accuracy_history": { team: [record] },
+#     "journal": marker or None }
+# Backends are picked with STORAGE_BACKEND ("json" by default, or "sqlite").
+
+def json_default(obj):
+    # snapshot arrays are copied as array('I') under the lock and listed in the writer thread
+    if isinstance(obj, array):
+        return obj.tolist()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+def write_json_atomic(path: str, obj, *, indent=None) -> int:
+    # the live file is only ever replaced by a complete, fsynced copy; returns bytes written
+    if indent is None:
+        text = json.dumps(obj, separators=(",", ":"), default=json_default)
+    else:
+        text = json.dumps(obj, indent=indent, default=json_default)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(text)
+
+class JsonStorage:
+    # everything in one JSON file, rewritten in full on every save
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save(self, payload: dict) -> int:
+        # returns bytes written
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        return write_json_atomic(self.path, payload, indent=2)
+
+class SqliteStorage:
+    # SQLite in WAL mode. saves are incremental: totals are diffed against what was last
+    # written and only changed users are upserted; attempt history is append-only, so only
+    # attempts past the stored ones are inserted. used from one thread at a time (main.py
+    # holds data_io_lock around save), hence check_same_thread=False.
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self._create_schema()
+        self._written_totals = None     # uid -> total as stored, loaded lazily
+        self._written_attempts = None   # team -> number of attempts stored
+
+    def _create_schema(self):
+        with self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS user_totals (
+                    user_id INTEGER PRIMARY KEY,
+                    total INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS attempts (
+                    team TEXT NOT NULL,
+                    attempt INTEGER NOT NULL,
+                    team_pos INTEGER NOT NULL,
+                    correct INTEGER NOT NULL,
+                    incorrect INTEGER NOT NULL,
+                    accuracy REAL,
+                    best_1hour INTEGER NOT NULL,
+                    longest INTEGER NOT NULL,
+                    record TEXT NOT NULL,
+                    PRIMARY KEY (team, attempt)
+                );
+                CREATE TABLE IF NOT EXISTS two_person_runs (
+                    team TEXT NOT NULL,
+                    attempt INTEGER NOT NULL,
+                    idx INTEGER NOT NULL,
+                    channel INTEGER,
+                    start_ts REAL NOT NULL,
+                    end_ts REAL NOT NULL,
+                    duration INTEGER NOT NULL,
+                    PRIMARY KEY (team, attempt, idx),
+                    FOREIGN KEY (team, attempt) REFERENCES attempts (team, attempt) ON DELETE CASCADE
+                );
+                CREATE TABLE IF NOT EXISTS two_person_runners (
+                    team TEXT NOT NULL,
+                    attempt INTEGER NOT NULL,
+                    idx INTEGER NOT NULL,
+                    pos INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    PRIMARY KEY (team, attempt, idx, pos),
+                    FOREIGN KEY (team, attempt, idx) REFERENCES two_person_runs (team, attempt, idx) ON DELETE CASCADE
+                );
+                CREATE INDEX IF NOT EXISTS two_person_runners_user ON two_person_runners (user_id);
+            """)
+            self.db.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('schema_version', ?)",
+                (str(self.SCHEMA_VERSION),)
+            )
+
+    def is_empty(self) -> bool:
+        row = self.db.execute(
+            "SELECT NOT EXISTS (SELECT 1 FROM user_totals) AND NOT EXISTS (SELECT 1 FROM attempts)"
+        ).fetchone()
+        return bool(row[0]) and self._meta("journal") is None
+
+    def _meta(self, key: str):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    # ---- load ----
+    def load(self):
+        if self.is_empty():
+            return None
+        totals = dict(self.db.execute("SELECT user_id, total FROM user_totals"))
+        history = {}
+        for team, record in self.db.execute(
+            "SELECT team, record FROM attempts ORDER BY team_pos, attempt"
+        ):
+            history.setdefault(team, []).append(json.loads(record))
+        self._written_totals = dict(totals)
+        self._written_attempts = {team: len(runs) for team, runs in history.items()}
+        return {
+            "total_counts_by_user": totals,
+            "team_accuracy_history": history,
+            "journal": self._meta("journal"),
+        }
+
+    def _load_written(self):
+        if self._written_totals is None:
+            self._written_totals = dict(self.db.execute("SELECT user_id, total FROM user_totals"))
+        if self._written_attempts is None:
+            self._written_attempts = dict(self.db.execute("SELECT team, COUNT(*) FROM attempts GROUP BY team"))
+
+    # ---- save ----
+    @staticmethod
+    def _attempt_row(team, attempt, team_pos, record):
+        two_runs = record.get("two_person_runs", []) or []
+        longest = max((int(r.get("duration", 0) or 0) for r in two_runs), default=0)
+        return (
+            team, attempt, team_pos,
+            int(record.get("correct", 0) or 0),
+            int(record.get("incorrect", 0) or 0),
+            record.get("accuracy"),
+            int(record.get("best_1hour", 0) or 0),
+            longest,
+            json.dumps(record, separators=(",", ":"), default=json_default),
+        )
+
+    @staticmethod
+    def _two_person_rows(team, attempt, record):
+        # (two_person_runs row, [two_person_runners rows]) per two-person run of an attempt
+        for idx, r in enumerate(record.get("two_person_runs", []) or []):
+            run_row = (team, attempt, idx, r.get("channel"), r["start"], r["end"], int(r.get("duration", 0) or 0))
+            runner_rows = [(team, attempt, idx, pos, uid) for pos, uid in enumerate(r["runners"])]
+            yield run_row, runner_rows
+
+    def _insert_two_person_runs(self, rows) -> int:
+        # inserts _two_person_rows() output; returns the number of rows written
+        run_rows, runner_rows = [], []
+        for run_row, runners in rows:
+            run_rows.append(run_row)
+            runner_rows.extend(runners)
+        self.db.executemany(
+            "INSERT INTO two_person_runs (team, attempt, idx, channel, start_ts, end_ts, duration) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            run_rows
+        )
+        self.db.executemany(
+            "INSERT INTO two_person_runners (team, attempt, idx, pos, user_id) VALUES (?, ?, ?, ?, ?)",
+            runner_rows
+        )
+        return len(run_rows) + len(runner_rows)
+
+    def save(self, payload: dict) -> int:
+        # returns the number of rows written
+        self._load_written()
+        totals = {int(uid): count for uid, count in payload["total_counts_by_user"].items()}
+        history = payload["team_accuracy_history"]
+
+        changed = [(uid, count) for uid, count in totals.items() if self._written_totals.get(uid) != count]
+        removed = [(uid,) for uid in self._written_totals.keys() - totals.keys()]
+
+        attempt_rows = []
+        two_person_rows = []
+        rewrite_teams = []
+        for team_pos, (team, runs) in enumerate(history.items()):
+            stored = self._written_attempts.get(team, 0)
+            if len(runs) < stored:
+                # history was edited by hand; store the team again from scratch
+                rewrite_teams.append((team,))
+                stored = 0
+            for attempt, record in enumerate(runs[stored:], start=stored + 1):
+                attempt_rows.append(self._attempt_row(team, attempt, team_pos, record))
+                two_person_rows.extend(self._two_person_rows(team, attempt, record))
+        rewrite_teams.extend((team,) for team in self._written_attempts.keys() - history.keys())
+
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO user_totals (user_id, total) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET total = excluded.total",
+                changed
+            )
+            self.db.executemany("DELETE FROM user_totals WHERE user_id = ?", removed)
+            self.db.executemany("DELETE FROM attempts WHERE team = ?", rewrite_teams)
+            self.db.executemany(
+                "INSERT INTO attempts (team, attempt, team_pos, correct, incorrect, accuracy, "
+                "best_1hour, longest, record) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                attempt_rows
+            )
+            two_person_written = self._insert_two_person_runs(two_person_rows)
+            self.db.execute(
+                "INSERT INTO meta (key, value) VALUES ('journal', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (json.dumps(payload.get("journal")),)
+            )
+
+        self._written_totals = totals
+        self._written_attempts = {team: len(runs) for team, runs in history.items()}
+        return len(changed) + len(removed) + len(attempt_rows) + two_person_written
+
+    # ---- migration ----
+    def migrate_from_json(self, json_path: str) -> bool:
+        # one-shot import of a run_data.json file into an empty database. the file is
+        # renamed to *.migrated afterwards so it is not imported again. returns whether it ran
+        if not os.path.exists(json_path) or not self.is_empty():
+            return False
+        data = JsonStorage(json_path).load()
+        self.save({
+            "total_counts_by_user": data.get("total_counts_by_user", {}),
+            "team_accuracy_history": data.get("team_accuracy_history", {}),
+            "journal": data.get("journal"),
+        })
+        os.replace(json_path, json_path + ".migrated")
+        return True
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,284 @@
+import itertools
+import json
+import random
+
+import pytest
+
+from engine import (
+    CountingEngine,
+    MessageEvent,
+    Outcome,
+    RunState,
+    SAMPLE_INTERVAL_SECONDS,
+    UserSnapshotStore,
+    best_series_window,
+    best_window,
+)
+from storage import json_default
+
+CH_A, CH_B = 1, 2
+BOT_CHANNEL, BOT_RUINED = 900, 901
+START = 1_700_000_000.0
+
+def make_engine(**kwargs) -> CountingEngine:
+    kwargs.setdefault("sequence_validation", True)
+    return CountingEngine(
+        (CH_A, CH_B),
+        team_of=lambda uid: "Team A" if uid < 100 else None,
+        mistake_bot_channel_id=BOT_CHANNEL,
+        mistake_bot_ruined_id=BOT_RUINED,
+        **kwargs,
+    )
+
+def count(ch, uid, number, ts, message_id=None):
+    return MessageEvent(ch, uid, False, str(number), ts, message_id)
+
+def report(ch, bot, ts, reply_to=None):
+    text = "RUINED IT at 10" if bot == BOT_RUINED else "10 of 11"
+    return MessageEvent(ch, bot, True, text, ts, None, reply_to)
+
+def roundtrip(data):
+    # as written to and read back from disk
+    return json.loads(json.dumps(data, default=json_default))
+
+def comparable(run: RunState):
+    # checkpoint view of a run without the inactivity deadlines, which are recomputed lazily
+    # and so depend on when process_inactivity happened to run
+    data = roundtrip(run.to_json())
+    for state in data["two_person_runs"].values():
+        state.pop("deadline", None)
+    return data
+
+# -------- LIVE INGEST / REPLAY --------
+def random_events(rng, duration):
+    # pairs counting in both channels, with wrong numbers, chatter, mistake-bot reports
+    # (replies and plain reports), handovers and idle gaps that end or warn two-person runs
+    message_ids = itertools.count(1)
+    pairs = [(1, 2), (3, 4), (5, 6), (7, 200)]
+    pair = {CH_A: pairs[0], CH_B: pairs[1]}
+    next_number = {CH_A: 1, CH_B: 1}
+    recent = {CH_A: [], CH_B: []}
+    events = []
+    t, n = START + 1, 0
+    while t < START + duration:
+        n += 1
+        ch = (CH_A, CH_B)[n % 2]
+        uid = pair[ch][(n // 2) % 2]
+        r = rng.random()
+        if r < 0.002:
+            t += rng.uniform(300, 900)
+        elif r < 0.006:
+            pair[ch] = rng.choice(pairs)
+        if r < 0.02:
+            reply_to = rng.choice(recent[ch][-4:]) if recent[ch] and rng.random() < 0.5 else None
+            events.append(report(ch, rng.choice((BOT_CHANNEL, BOT_RUINED)), t, reply_to))
+        elif r < 0.04:
+            events.append(MessageEvent(ch, uid, False, "nice one", t, next(message_ids)))
+        else:
+            number = next_number[ch]
+            if rng.random() < 0.01:
+                number += rng.choice((-1, 1, 10))
+            else:
+                next_number[ch] += 1
+            mid = next(message_ids)
+            recent[ch].append(mid)
+            events.append(count(ch, uid, number, t, mid))
+        t += rng.uniform(0.5, 2.0)
+    return events
+
+def ingest_live(engine, events, journal):
+    # what main.py does: minute_sampler ticks, on_message under the lock, journaled outcomes
+    run = engine.run
+    for ev in events:
+        while run.start_time + run.tick_count() * SAMPLE_INTERVAL_SECONDS <= ev.ts:
+            engine.sample_tick()
+        for kind, ch, data in engine.handle_message(ev):
+            if kind in ("count", "mistake", "wrong"):
+                journal.append({"seq": len(journal) + 1, "ts": ev.ts, "kind": kind, "ch": ch, "uid": data})
+
+def finish_live(engine, end_ts):
+    run = engine.run
+    while run.start_time + run.tick_count() * SAMPLE_INTERVAL_SECONDS <= end_ts:
+        engine.sample_tick()
+    engine.process_inactivity(end_ts)
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_replay_matches_live_ingest(seed):
+    events = random_events(random.Random(seed), 3 * 3600)
+    end_ts = events[-1].ts + 1200
+
+    live, journal = make_engine(), []
+    live.start_run(START)
+    ingest_live(live, events, journal)
+    finish_live(live, end_ts)
+    assert {"count", "mistake", "wrong"} <= {rec["kind"] for rec in journal}
+    assert live.run.two_person_history
+
+    replayed = make_engine()
+    replayed.start_run(START)
+    assert replayed.replay(roundtrip(journal), until_ts=end_ts) == len(journal)
+
+    assert comparable(replayed.run) == comparable(live.run)
+    assert replayed.totals == live.totals
+
+@pytest.mark.parametrize("seed", [4, 5])
+def test_checkpoint_round_trip(seed):
+    events = random_events(random.Random(seed), 3 * 3600)
+    split = len(events) // 2
+    end_ts = events[-1].ts + 1200
+
+    live, journal = make_engine(), []
+    live.start_run(START, CH_A)
+    ingest_live(live, events[:split], journal)
+    checkpoint = roundtrip(live.run.to_json())
+    checkpoint_seq = len(journal)
+    assert roundtrip(RunState.from_json(roundtrip(checkpoint)).to_json()) == checkpoint
+
+    ingest_live(live, events[split:], journal)
+    finish_live(live, end_ts)
+
+    # resume as main.restore_run does: the checkpoint plus the journal records after it
+    restored = make_engine()
+    restored.restore_run(checkpoint)
+    restored.replay(roundtrip(journal[checkpoint_seq:]), until_ts=end_ts)
+    assert comparable(restored.run) == comparable(live.run)
+    assert restored.run.channel_id == CH_A
+
+# -------- WINDOW ANALYSIS --------
+@pytest.mark.parametrize("seed", range(5))
+def test_best_series_window_matches_brute_force(seed):
+    rng = random.Random(seed)
+    store = UserSnapshotStore()
+    counts = {}
+    for _ in range(rng.randint(50, 400)):
+        # bursts and long quiet stretches; now and then a count is taken back
+        for uid in range(4):
+            if rng.random() < (0.6 if uid % 2 else 0.05):
+                step = -1 if counts.get(uid, 0) and rng.random() < 0.2 else rng.randint(1, 5)
+                counts[uid] = counts.get(uid, 0) + step
+                store.mark(uid)
+        store.sample(counts)
+
+    for uid, series in store.items():
+        dense = [series[i] for i in range(len(series))]
+        for window in (1, 2, 6, 37, len(series) - 1, len(series), len(series) + 3):
+            assert best_series_window(series, window) == best_window(dense, window), (uid, window)
+
+# -------- INACTIVITY --------
+def start_pair_run(engine, t0, n):
+    # users 1 and 2 alternating every 2s; the run starts with the 40th count, at t0 + 78
+    outcomes = []
+    for i in range(n):
+        outcomes += engine.handle_message(count(CH_A, 1 + i % 2, i + 1, t0 + 2 * i))
+    return outcomes
+
+def test_inactivity_warning_and_end_timing():
+    engine = make_engine()
+    engine.start_run(START)
+    t0 = START + 1000
+    outcomes = start_pair_run(engine, t0, 200)
+    assert [o for o in outcomes if o.kind == "run_started"] == [Outcome("run_started", CH_A, (1, 2))]
+
+    # the last 95 runner counts start at t0 + 210 (count 106) and the last one is at t0 + 398:
+    # fewer than 95 are left in the trailing 9 minutes at t0 + 750 and in 10 minutes at t0 + 810
+    assert engine.process_inactivity(t0 + 749.9) == []
+    assert engine.process_inactivity(t0 + 750) == [Outcome("run_warning", CH_A, None)]
+    assert engine.process_inactivity(t0 + 800) == []
+    assert engine.process_inactivity(t0 + 809.9) == []
+    [(kind, ch, rec)] = engine.process_inactivity(t0 + 810)
+    assert (kind, ch) == ("run_ended", CH_A)
+    assert rec == {"runners": (1, 2), "start": t0 + 78, "end": t0 + 810, "duration": 732}
+    assert CH_A not in engine.run.two_person_runs
+
+def test_inactivity_end_when_one_runner_stops():
+    engine = make_engine()
+    engine.start_run(START)
+    t0 = START + 1000
+    start_pair_run(engine, t0, 200)
+
+    # user 2's last count is at t0 + 398; user 1 keeps counting alone, fast enough that the
+    # combined count never drops, so the run ends 10 minutes after user 2 went quiet
+    outcomes = []
+    for i in range(1000):
+        outcomes += engine.handle_message(count(CH_A, 1, 201 + i, t0 + 400 + i))
+    ended = [o for o in outcomes if o.kind != "count"]
+    assert [o.kind for o in ended] == ["run_ended"]
+    assert ended[0].data["end"] == t0 + 998
+    assert CH_A not in engine.run.two_person_runs
+
+# -------- MISTAKES --------
+def test_wrong_number_is_charged_once():
+    engine = make_engine()
+    run = engine.start_run(START)
+    assert engine.handle_message(count(CH_A, 1, 1, START + 1, 11)) == [Outcome("count", CH_A, 1)]
+    engine.handle_message(count(CH_A, 2, 2, START + 2, 12))
+    assert engine.handle_message(count(CH_A, 1, 5, START + 3, 13)) == [Outcome("wrong", CH_A, 1)]
+    assert (run.correct, run.incorrect, run.counts_by_user[1]) == (2, 1, 1)
+
+    # the bots reporting the same wrong number, as a reply or not, charge nothing more
+    assert engine.handle_message(report(CH_A, BOT_RUINED, START + 4, reply_to=13)) == []
+    assert engine.handle_message(report(CH_A, BOT_CHANNEL, START + 4)) == []
+    assert (run.correct, run.incorrect) == (2, 1)
+
+    # after a wrong number the channel resyncs on whatever comes next
+    assert engine.handle_message(count(CH_A, 2, 40, START + 5, 14)) == [Outcome("count", CH_A, 2)]
+    assert engine.handle_message(count(CH_A, 1, 41, START + 6, 15)) == [Outcome("count", CH_A, 1)]
+
+def test_double_post_modes():
+    for mode, expected in (("allow", "count"), ("mistake", "wrong"), ("ignore", None)):
+        engine = make_engine(double_post=mode)
+        engine.start_run(START)
+        engine.handle_message(count(CH_A, 1, 1, START + 1, 1))
+        outcomes = engine.handle_message(count(CH_A, 1, 2, START + 2, 2))
+        assert [o.kind for o in outcomes] == ([expected] if expected else []), mode
+
+def test_bot_report_without_reply_charges_newest_count():
+    # sequence validation misses mistakes the bots catch (e.g. a count the bot rejects);
+    # a plain report charges the channel's newest count, and only once
+    engine = make_engine()
+    run = engine.start_run(START)
+    for i, uid in enumerate((1, 2, 1)):
+        engine.handle_message(count(CH_A, uid, i + 1, START + i, 10 + i))
+
+    assert engine.handle_message(report(CH_A, BOT_CHANNEL, START + 5)) == [Outcome("mistake", CH_A, 1)]
+    assert engine.handle_message(report(CH_A, BOT_RUINED, START + 5)) == []
+    assert dict(run.counts_by_user) == {1: 1, 2: 1}
+    assert (run.correct, run.incorrect) == (2, 1)
+    assert engine.totals[1] == 1
+
+    # the report also resyncs the channel
+    assert engine.handle_message(count(CH_A, 2, 1, START + 6, 20)) == [Outcome("count", CH_A, 2)]
+
+def test_bot_reply_charges_the_replied_count():
+    engine = make_engine()
+    run = engine.start_run(START)
+    for i, uid in enumerate((1, 2, 1)):
+        engine.handle_message(count(CH_A, uid, i + 1, START + i, 10 + i))
+
+    assert engine.handle_message(report(CH_A, BOT_RUINED, START + 5, reply_to=11)) == [Outcome("mistake", CH_A, 2)]
+    assert engine.handle_message(report(CH_A, BOT_CHANNEL, START + 5, reply_to=11)) == []
+    assert dict(run.counts_by_user) == {1: 2, 2: 0}
+    assert run.user_counts_by_channel[CH_A][2] == 0
+    assert run.incorrect == 1
+
+def test_bot_reports_outside_counts():
+    engine = make_engine()
+    run = engine.start_run(START)
+    # nothing counted in the channel yet
+    assert engine.handle_message(report(CH_B, BOT_CHANNEL, START + 1)) == []
+    # not a mistake report
+    engine.handle_message(count(CH_B, 1, 1, START + 2, 1))
+    assert engine.handle_message(MessageEvent(CH_B, BOT_CHANNEL, True, "hello", START + 3)) == []
+    # replies to counts older than the ring fall back to the newest count
+    assert engine.handle_message(report(CH_B, BOT_RUINED, START + 4, reply_to=12345)) == [Outcome("mistake", CH_B, 1)]
+    assert (run.correct, run.incorrect) == (0, 1)
+
+def test_bot_report_without_sequence_validation():
+    engine = make_engine(sequence_validation=False)
+    run = engine.start_run(START)
+    for i, uid in enumerate((1, 2)):
+        engine.handle_message(count(CH_A, uid, 7, START + i, 10 + i))
+    assert run.correct == 2
+    assert engine.handle_message(report(CH_A, BOT_CHANNEL, START + 3)) == [Outcome("mistake", CH_A, 2)]
+    assert engine.handle_message(report(CH_A, BOT_RUINED, START + 3)) == []
+    assert (run.correct, run.incorrect) == (1, 1)